@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Offline benchmarks of the download paths against local stand-in servers:
+#
+#     $ python benchmarks/harness.py --scenario default --save laptop
+#     $ python benchmarks/harness.py --scenario default --compare laptop
+
+import os
+import sys
+import time
+import shutil
+import logging
+import resource
+import tempfile
+import subprocess
+import json as jsonlib
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from standin import Profile, HTTPStandin, FTPStandin
+
+logger = logging.getLogger("biodownloader")
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+# CLI command and file formats of each group of IDs
+GROUPS = (("pdb", ("pdb", "mmcif", "bio")),
+          ("sifts", ("sifts",)),
+          ("uniprot", ("fasta", "gff", "txt")),
+          ("cath", ("cath",)),
+          ("pfam", ("pfam",)))
+
+SCENARIOS = {
+    "default": dict(ids=50, latency=0.02, sizes="lognormal:20000:1.0"),
+    "slow-network": dict(ids=20, latency=0.2, jitter=0.1,
+                         bandwidth=512 * 1024, sizes="lognormal:20000:1.0"),
+    "rate-limited": dict(ids=50, latency=0.02, rate_429=0.1,
+                         sizes="lognormal:20000:1.0"),
+    "large-files": dict(ids=5, latency=0.02, bandwidth=20 * 1024 ** 2,
+                        sizes="lognormal:4000000:0.5"),
+    "many-small": dict(ids=300, latency=0.005, sizes="fixed:2000"),
+}
+
+# metrics compared with a baseline, and whether higher is better
+COMPARED = (("files_per_s", True), ("mb_per_s", True),
+            ("peak_rss_mb", False), ("startup_ms", False))
+
+
+def generate_ids(group, n):
+    """
+    Synthetic IDs of the right shape for each group.
+
+    :param group: (str) one of the GROUPS commands
+    :param n: (int) number of IDs
+    :return: list of IDs
+    """
+
+    if group in ("pdb", "sifts"):
+        return ["{}{:03x}".format(1 + i // 4096, i % 4096) for i in range(n)]
+    elif group == "uniprot":
+        return ["P{:05d}".format(i) for i in range(n)]
+    elif group == "cath":
+        return ["1.10.8.{}_{}".format(10 + i // 100, i % 100) for i in range(n)]
+    elif group == "pfam":
+        return ["PF{:05d}".format(i) for i in range(n)]
+    raise ValueError("Unknown group {}...".format(group))
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+def _peak_rss_mb(who):
+    rss = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 1024.0 ** (2 if sys.platform == "darwin" else 1)
+
+
+def _downloaded(directory):
+    from biodownloader.index import artefact
+
+    count, size = 0, 0
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if artefact(filename) is not None:
+                count += 1
+                size += os.path.getsize(os.path.join(root, filename))
+    return count, size
+
+
+def _latencies(events):
+    # as seen by the client: to the first byte and through the transfer
+    latencies = []
+    if not os.path.exists(events):
+        return latencies
+    with open(events) as f:
+        for line in f:
+            event = jsonlib.loads(line)
+            if event["kind"] in ("request", "download") and \
+                    event.get("ttfb") is not None:
+                latencies.append(event["ttfb"] + (event.get("transfer") or 0))
+    return latencies
+
+
+def _reset():
+    # per process state (sessions, caches, retry budget, limiters, hedging
+    # and mirror latencies...) that would carry over from a previous run
+    from biodownloader import concurrency
+    from biodownloader.session import reset_session
+    from biodownloader.cache import close_caches
+    from biodownloader.retry import reset_retry_policy
+    from biodownloader.hedge import reset_hedging
+    from biodownloader.ratelimit import reset_rate_limiters
+    from biodownloader.mirrors import reset_mirrors
+    from biodownloader.metrics import reset_metrics
+    from biodownloader.index import close_indexes
+    from biodownloader.manifest import close_manifests
+
+    concurrency.disable()
+    reset_session()
+    close_caches()
+    reset_retry_policy()
+    reset_hedging()
+    reset_rate_limiters()
+    reset_mirrors()
+    reset_metrics()
+    close_indexes()
+    close_manifests()
+
+
+def _run_api(directory, http, ftp, groups, jobs, events):
+    from biodownloader.config import config
+    from biodownloader.proxy import route_through
+    from biodownloader.engine import generate_results, tally
+
+    saved = dict(vars(config))
+    try:
+        config.db_root = directory
+        config.metrics_events = events
+        route_through(http.url)
+        config.ftp_sifts = ftp.url + "/pub/databases/msd/sifts/xml/"
+        _reset()
+        started = time.time()
+        for ids, file_formats in groups:
+            tally(generate_results(ids, file_formats, jobs=jobs))
+        return time.time() - started
+    finally:
+        vars(config).update(saved)
+        _reset()
+
+
+def _run_cli(directory, http, groups, jobs, events):
+    # a process per group: the variadic IDs of a command would swallow
+    # the commands chained after it
+    commands = []
+    for n, (ids, file_formats) in enumerate(groups):
+        command = [c for c, formats in GROUPS if formats[0] in file_formats][0]
+        filename = os.path.join(os.path.dirname(directory),
+                                "ids-{}.list".format(n))
+        with open(filename, "w") as f:
+            f.write("\n".join(ids))
+        commands.append([sys.executable, "-m", "biodownloader.cli", command] +
+                        ["--" + f for f in file_formats] +
+                        ["--output", directory, "--jobs", str(jobs),
+                         "--cache-proxy", http.url, "--ids-from", filename,
+                         "--metrics-events", events])
+    started = time.time()
+    for args in commands:
+        subprocess.check_call(args, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    return time.time() - started
+
+
+def startup_seconds(runs=3):
+    """
+    Time `BioDownloader --help` takes in a new interpreter, best of runs:
+    what every invocation costs before a download starts.
+
+    :param runs: (int) number of runs
+    :return: (float) seconds
+    """
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    best = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.check_call([sys.executable, "-m", "biodownloader.cli",
+                               "--help"], cwd=root,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+        seconds = time.perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def run_benchmark(scenario="default", mode="api", jobs=8, file_formats=None,
+                  **overrides):
+    """
+    Downloads synthetic payloads for every group of IDs from local stand-in
+    servers, through the real download paths.
+
+    :param scenario: (str) one of SCENARIOS
+    :param mode: (str) 'api' runs engine.generate_results in this process,
+        'cli' runs the BioDownloader CLI in a subprocess
+    :param jobs: (int) files downloaded in parallel
+    :param file_formats: iterable of formats (defaults to all of them)
+    :param overrides: Profile settings and 'ids' overriding the scenario
+    :return: dict of metrics
+    """
+
+    settings = dict(SCENARIOS[scenario])
+    settings.update((k, v) for k, v in overrides.items() if v is not None)
+    n = settings.pop("ids")
+    profile = Profile(**settings)
+
+    groups = []
+    for group, formats in GROUPS:
+        formats = [f for f in formats if file_formats is None or f in file_formats]
+        if formats:
+            groups.append((generate_ids(group, n), formats))
+    expected = sum(len(ids) * len(formats) for ids, formats in groups)
+
+    workdir = tempfile.mkdtemp(prefix="biodownloader-bench-")
+    directory = os.path.join(workdir, "data")
+    events = os.path.join(workdir, "events.jsonl")
+    os.mkdir(directory)
+    http = HTTPStandin(profile)
+    ftp = FTPStandin(profile, stats=http.stats)
+    try:
+        if mode == "api":
+            seconds = _run_api(directory, http, ftp, groups, jobs, events)
+            rss = _peak_rss_mb(resource.RUSAGE_SELF)
+        elif mode == "cli":
+            seconds = _run_cli(directory, http, groups, jobs, events)
+            rss = _peak_rss_mb(resource.RUSAGE_CHILDREN)
+        else:
+            raise ValueError("Unknown mode {}...".format(mode))
+        files, size = _downloaded(directory)
+        latencies = _latencies(events)
+    finally:
+        http.close()
+        ftp.close()
+        shutil.rmtree(workdir)
+
+    stats = http.stats
+    return {"scenario": scenario, "mode": mode, "jobs": jobs,
+            "files": files, "failed": expected - files,
+            "seconds": round(seconds, 3),
+            "files_per_s": round(files / seconds, 2),
+            "mb_per_s": round(size / seconds / 1024 ** 2, 3),
+            "latency_p50_ms": _ms(percentile(latencies, 50)),
+            "latency_p99_ms": _ms(percentile(latencies, 99)),
+            "peak_rss_mb": round(rss, 1),
+            "requests": stats.requests, "throttled": stats.throttled}
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def save_baseline(name, report):
+    os.makedirs(BASELINES, exist_ok=True)
+    with open(os.path.join(BASELINES, name + ".json"), "w") as f:
+        jsonlib.dump(report, f, indent=2, sort_keys=True)
+
+
+def load_baseline(name):
+    with open(os.path.join(BASELINES, name + ".json")) as f:
+        return jsonlib.load(f)
+
+
+def compare(report, baseline, tolerance=0.1):
+    """
+    Compares a report with a baseline.
+
+    :param report: dict of metrics (see run_benchmark)
+    :param baseline: dict of metrics
+    :param tolerance: (float) relative change allowed before a regression
+    :return: list of tuples (metric, baseline, current, change, regressed)
+    """
+
+    rows = []
+    for metric, higher_is_better in COMPARED:
+        before, after = baseline.get(metric), report.get(metric)
+        if not before or after is None:
+            continue
+        change = (after - before) / float(before)
+        worse = -change if higher_is_better else change
+        rows.append((metric, before, after, change, worse > tolerance))
+    return rows
+
+
+@click.command(context_settings={'help_option_names': ['-h', '--help']})
+@click.option('--scenario', default='default', type=click.Choice(sorted(SCENARIOS)),
+              help='Stand-in server profile (default: default).')
+@click.option('--mode', default='api', type=click.Choice(['api', 'cli']),
+              help='In-process engine or the CLI in a subprocess.')
+@click.option('--jobs', default=8, type=click.IntRange(min=1),
+              help='Files downloaded in parallel (default: 8).')
+@click.option('--format', 'file_formats', multiple=True,
+              help='Only these file formats (repeatable).')
+@click.option('--ids', type=click.IntRange(min=1), help='IDs per source.')
+@click.option('--latency', type=float, help='Seconds before the first byte.')
+@click.option('--bandwidth', type=float,
+              help='Bytes per second per connection.')
+@click.option('--rate-429', 'rate_429', type=float,
+              help='Fraction of requests answered with a 429.')
+@click.option('--sizes', help=("Payload sizes: 'fixed:N', 'uniform:MIN:MAX' "
+                               "or 'lognormal:MEDIAN:SIGMA'."))
+@click.option('--save', help='Saves the report as a named baseline.')
+@click.option('--compare', 'against', help='Compares with a named baseline.')
+@click.option('--tolerance', default=0.1, type=float,
+              help='Relative change counted as a regression (default: 0.1).')
+def main(scenario, mode, jobs, file_formats, ids, latency, bandwidth, rate_429,
+         sizes, save, against, tolerance):
+    """
+    Benchmarks BioDownloader against local stand-in servers.
+    """
+
+    logging.getLogger("biodownloader").setLevel(logging.CRITICAL)
+    report = run_benchmark(scenario, mode=mode, jobs=jobs,
+                           file_formats=file_formats or None, ids=ids,
+                           latency=latency, bandwidth=bandwidth,
+                           rate_429=rate_429, sizes=sizes)
+    report["startup_ms"] = _ms(startup_seconds())
+    for key in sorted(report):
+        click.echo("{:16} {}".format(key, report[key]))
+    if save:
+        save_baseline(save, report)
+    if against:
+        rows = compare(report, load_baseline(against), tolerance=tolerance)
+        click.echo("")
+        for metric, before, after, change, regressed in rows:
+            click.echo("{:16} {:>10} -> {:<10} {:+.1%}{}".format(
+                metric, before, after, change, "  REGRESSION" if regressed else ""))
+        if any(row[-1] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
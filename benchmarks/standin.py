@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math
+import time
+import gzip
+import random
+import socket
+import hashlib
+import threading
+import json as jsonlib
+from collections import OrderedDict
+from socketserver import ThreadingMixIn, ThreadingTCPServer, StreamRequestHandler
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class Profile(object):
+    def __init__(self, latency=0.02, jitter=0.0, bandwidth=None, rate_429=0.0,
+                 retry_after=0, sizes="lognormal:20000:1.0", seed=0):
+        """
+        Behaviour of the stand-in servers.
+
+        :param latency: (float) seconds before the first byte of a response
+        :param jitter: (float) extra latency drawn uniformly from [0, jitter]
+        :param bandwidth: (float) bytes per second per connection, or None
+        :param rate_429: (float) fraction of requests answered with a 429
+        :param retry_after: (int) Retry-After of the 429 responses
+        :param sizes: (str) payload sizes in bytes, either 'fixed:N',
+            'uniform:MIN:MAX' or 'lognormal:MEDIAN:SIGMA'
+        :param seed: (int) seed of the payload sizes and 429s
+        """
+
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.sizes = sizes
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def size(self, path):
+        # the same path always gets the same size
+        rng = random.Random("{}:{}".format(self.seed, path))
+        kind, _, args = self.sizes.partition(":")
+        args = [float(a) for a in args.split(":") if a]
+        if kind == "fixed":
+            return int(args[0])
+        elif kind == "uniform":
+            return int(rng.uniform(args[0], args[1]))
+        elif kind == "lognormal":
+            return max(1, int(rng.lognormvariate(math.log(args[0]), args[1])))
+        raise ValueError("Unknown size distribution {}...".format(self.sizes))
+
+    def throttled(self):
+        with self._lock:
+            return self._random.random() < self.rate_429
+
+    def wait(self):
+        with self._lock:
+            extra = self._random.uniform(0, self.jitter) if self.jitter else 0
+        if self.latency + extra > 0:
+            time.sleep(self.latency + extra)
+
+
+def synthetic(path, size):
+    """
+    Deterministic text payload of about `size` bytes for a path, gzipped if
+    the path ends with .gz.
+
+    :param path: (str) request path
+    :param size: (int) size of the decompressed payload
+    :return: (bytes)
+    """
+
+    seed = hashlib.sha1(path.encode("utf-8")).hexdigest()
+    line = "{} {}\n".format(path.rsplit("/", 1)[-1], seed).encode("utf-8")
+    data = (line * (size // len(line) + 1))[:size]
+    if path.endswith(".gz"):
+        data = gzip.compress(data, compresslevel=1)
+    return data
+
+
+class _Payloads(object):
+    def __init__(self, profile, max_entries=256):
+        # recently generated payloads, so retries and ranges are cheap
+        self.profile = profile
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, path):
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+                return self._entries[path]
+        data = synthetic(path, self.profile.size(path))
+        with self._lock:
+            self._entries[path] = data
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return data
+
+
+class Stats(object):
+    def __init__(self):
+        """
+        Requests served by the stand-in servers.
+        """
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.bytes_sent = 0
+        self.latencies = []
+
+    def record(self, seconds, sent, throttled=False):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += sent
+            if throttled:
+                self.throttled += 1
+            else:
+                self.latencies.append(seconds)
+
+
+def _write(wfile, data, bandwidth):
+    # paced to the bandwidth of the profile
+    chunk = 16 * 1024
+    started = time.time()
+    for start in range(0, len(data), chunk):
+        wfile.write(data[start:start + chunk])
+        if bandwidth:
+            ahead = (start + chunk) / float(bandwidth) - (time.time() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+def _summary(path):
+    # PDBe summary API: a single preferred assembly
+    identifiers = [path.rstrip("/").rsplit("/", 1)[-1]]
+    return {i: [{"assemblies": [{"assembly_id": "1", "preferred": True}]}]
+            for i in identifiers if i and i != "summary"}
+
+
+class HTTPStandin(object):
+    def __init__(self, profile=None):
+        """
+        Threaded local HTTP server answering any GET with a synthetic
+        payload (see synthetic), and the PDBe summary API with JSON.
+        Paths are those of a serve-cache proxy (/<config key>/...), so
+        proxy.route_through points every source at it.
+
+        :param profile: Profile object
+        """
+
+        self.profile = profile or Profile()
+        self.stats = Stats()
+        self.payloads = _Payloads(self.profile)
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode("utf-8")
+                started = time.time()
+                standin.profile.wait()
+                ids = [i.strip() for i in body.split(",") if i.strip()]
+                data = {i: [{"assemblies": [{"assembly_id": "1",
+                                             "preferred": True}]}]
+                        for i in ids}
+                self._send(200, jsonlib.dumps(data).encode("utf-8"),
+                           "application/json", started)
+
+            def do_HEAD(self):
+                self.do_GET(body=False)
+
+            def do_GET(self, body=True):
+                started = time.time()
+                if standin.profile.throttled():
+                    self.send_response(429)
+                    self.send_header("Retry-After",
+                                     str(standin.profile.retry_after))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    standin.stats.record(time.time() - started, 0,
+                                         throttled=True)
+                    return
+                standin.profile.wait()
+                if "/api/" in self.path:
+                    data = jsonlib.dumps(_summary(self.path)).encode("utf-8")
+                    return self._send(200, data, "application/json", started,
+                                      body)
+                data = standin.payloads.get(self.path.split("?")[0])
+                start, end = 0, len(data) - 1
+                header = self.headers.get("Range")
+                status = 200
+                if header and header.startswith("bytes="):
+                    first, last = header[len("bytes="):].split("-")
+                    start = int(first)
+                    end = min(int(last), end) if last else end
+                    status = 206
+                self._send(status, data[start:end + 1], "text/plain", started,
+                           body, (start, end, len(data)))
+
+            def _send(self, status, data, content_type, started, body=True,
+                      content_range=None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("Accept-Ranges", "bytes")
+                if content_range is not None and status == 206:
+                    self.send_header("Content-Range", "bytes {}-{}/{}"
+                                     "".format(*content_range))
+                self.end_headers()
+                if body:
+                    _write(self.wfile, data, standin.profile.bandwidth)
+                standin.stats.record(time.time() - started,
+                                     len(data) if body else 0)
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            request_queue_size = 128
+
+        self.httpd = Server(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FTPStandin(object):
+    def __init__(self, profile=None, stats=None):
+        """
+        Minimal passive-mode FTP server (enough for urllib) answering any
+        RETR with a synthetic payload.
+
+        :param profile: Profile object
+        :param stats: Stats object shared with the HTTP stand-in
+        """
+
+        self.profile = profile or Profile()
+        self.stats = stats or Stats()
+        self.payloads = _Payloads(self.profile)
+        standin = self
+
+        class Handler(StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write((line + "\r\n").encode("utf-8"))
+
+            def handle(self):
+                cwd = "/"
+                passive = None
+                self.reply("220 BioDownloader stand-in")
+                for raw in self.rfile:
+                    command, _, argument = raw.decode("utf-8").strip().partition(" ")
+                    command = command.upper()
+                    if command == "USER":
+                        self.reply("331 Anonymous login ok")
+                    elif command == "PASS":
+                        self.reply("230 Logged in")
+                    elif command == "TYPE":
+                        self.reply("200 Type set")
+                    elif command == "CWD":
+                        cwd = argument if argument.startswith("/") else \
+                            cwd.rstrip("/") + "/" + argument
+                        self.reply("250 Directory changed")
+                    elif command == "PWD":
+                        self.reply('257 "{}"'.format(cwd))
+                    elif command in ("PASV", "EPSV"):
+                        passive = socket.socket()
+                        passive.bind(("127.0.0.1", 0))
+                        passive.listen(1)
+                        port = passive.getsockname()[1]
+                        if command == "EPSV":
+                            self.reply("229 Entering Extended Passive Mode "
+                                       "(|||{}|)".format(port))
+                        else:
+                            self.reply("227 Entering Passive Mode "
+                                       "(127,0,0,1,{},{})".format(port >> 8,
+                                                                 port & 255))
+                    elif command == "RETR" and passive is not None:
+                        started = time.time()
+                        path = cwd.rstrip("/") + "/" + argument
+                        standin.profile.wait()
+                        data = standin.payloads.get(path)
+                        self.reply("150 Opening data connection")
+                        connection, _ = passive.accept()
+                        with connection, connection.makefile("wb") as out:
+                            _write(out, data, standin.profile.bandwidth)
+                        passive.close()
+                        passive = None
+                        standin.stats.record(time.time() - started, len(data))
+                        self.reply("226 Transfer complete")
+                    elif command == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    else:
+                        self.reply("502 Not implemented")
+
+        class Server(ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.url = "ftp://127.0.0.1:{}".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -20,13 +20,12 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import sys
 import logging
 
+# the CLI sets up its own handler (see biodownloader.cli), applications
+# using the package configure logging themselves
 logging.getLogger("biodownloader").addHandler(logging.NullHandler())
 logging.captureWarnings(True)
-logging.basicConfig(stream=sys.stderr, level=logging.INFO,
-                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
 
 
 __author__ = "Fábio Madeira"
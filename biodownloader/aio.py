@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import asyncio
+import logging
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from biodownloader.config import config
+from biodownloader import fetchers
+from biodownloader.cache import CachedResponse
+from biodownloader.retry import get_retry_policy
+from biodownloader.ratelimit import reserve
+from biodownloader.metrics import get_metrics, Trace
+
+logger = logging.getLogger("biodownloader")
+
+_session = None
+
+# bytes gathered before they are written in a thread, rather than one
+# executor round trip per chunk
+WRITE_BUFFER_SIZE = 16 * fetchers.CHUNK_SIZE
+
+
+def get_session():
+    """
+    Gets the aiohttp session shared by every coroutine in this module.
+
+    A new session (and connection pool) is created the first time this is
+    called from a running event loop, or if the previous one was closed or
+    belongs to another loop.
+
+    :return: aiohttp.ClientSession
+    """
+
+    global _session
+
+    if aiohttp is None:
+        raise ImportError("biodownloader.aio requires aiohttp "
+                          "(pip install aiohttp)...")
+
+    loop = asyncio.get_running_loop()
+    if (_session is None or _session.closed or
+            getattr(_session, "_loop", loop) is not loop):
+        connector = aiohttp.TCPConnector(
+            limit=config.aio_pool_size,
+            limit_per_host=config.aio_pool_size_per_host)
+        timeout = aiohttp.ClientTimeout(total=None,
+                                        sock_connect=config.connect_timeout,
+                                        sock_read=config.read_timeout)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+
+async def close_session():
+    """
+    Closes the shared aiohttp session, if open.
+
+    :return: (side effects)
+    """
+
+    global _session
+
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def fetch_from_url_or_retry(url, json=True, header=None, post=False,
+                                  data=None, retry_in=None, wait=None,
+                                  n_retries=None, **params):
+    """
+    Async version of fetchers.fetch_from_url_or_retry.
+
+    :param url: url to be fetched as a string
+    :param json: json output
+    :param header: dictionary
+    :param post: boolean
+    :param data: dictionary: only if post is True
+    :param retry_in: http codes for retrying
+    :param wait: base of the backoff in seconds (config.retry_backoff)
+    :param n_retries: number of retry attempts (config.retry_max)
+    :param params: query string parameters
+    :return: CachedResponse object or None
+    """
+
+    if retry_in is None:
+        retry_in = ()
+    else:
+        assert type(retry_in) is tuple or type(retry_in) is list
+
+    if header is None:
+        header = {}
+    else:
+        assert type(header) is dict
+
+    if json:
+        header.update({"Content-Type": "application/json"})
+    else:
+        if "Content-Type" not in header:
+            header.update({"Content-Type": "text/plain"})
+
+    if post and data is None:
+        return None
+
+    session = get_session()
+    policy = get_retry_policy()
+    attempt = 0
+    while True:
+        logger.info("Querying %s ...", url)
+        await asyncio.sleep(reserve(url))
+        trace = Trace()
+        try:
+            if post:
+                assert type(data) is dict or type(data) is str
+                request = session.post(url, headers=header, data=data)
+            else:
+                request = session.get(url, headers=header, params=params)
+            async with request as r:
+                trace.responded(r.status, r.headers)
+                response = CachedResponse(str(r.url), r.status, dict(r.headers),
+                                          await r.read())
+            trace.finished(size=len(response.content))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            delay = policy.next_delay(attempt, error=e, max_retries=n_retries,
+                                      backoff=wait)
+            if delay is None:
+                get_metrics().record("request", url, trace=trace, ok=False,
+                                     retries=attempt, error=e)
+                raise
+        else:
+            if response.ok:
+                get_metrics().record("request", url, trace=trace,
+                                     retries=attempt)
+                return response
+            delay = policy.next_delay(attempt, status_code=response.status_code,
+                                      headers=response.headers,
+                                      retry_in=retry_in, max_retries=n_retries,
+                                      backoff=wait)
+            if delay is None:
+                logger.debug('%s: Unable to retrieve %s',
+                             response.status_code, url)
+                get_metrics().record("request", url, trace=trace, ok=False,
+                                     retries=attempt,
+                                     error="HTTP {}".format(
+                                         response.status_code))
+                return None
+        attempt += 1
+        logger.debug("Retrying %s in %.2f seconds...", url, delay)
+        await asyncio.sleep(delay)
+
+
+async def _in_thread(func, *args):
+    # blocking work (sqlite, the filesystem, gzip and zstd) runs in the
+    # default executor, so it never stalls the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+class _ThreadedStream(object):
+    def __init__(self, opener):
+        """
+        Async wrapper of a fetchers._OutputStream, which is opened, written
+        to and committed in the default executor. Chunks are gathered up to
+        WRITE_BUFFER_SIZE first, so the loop reading the response only waits
+        for the disk once per buffer. The stream is only opened with the
+        first buffer, so reading starts as soon as the response does:
+        aiohttp drops the bytes it holds if the server closes the connection
+        early, and those bytes could not be resumed from.
+
+        :param opener: callable returning the _OutputStream object
+        """
+
+        self.opener = opener
+        self.stream = None
+        self._buffer = []
+        self._buffered = 0
+
+    def __getattr__(self, name):
+        # e.g. size and decompress_seconds, once written
+        return getattr(self.stream, name)
+
+    async def __aenter__(self):
+        return self
+
+    async def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= WRITE_BUFFER_SIZE:
+            await _in_thread(self._flush)
+
+    def _flush(self):
+        if self.stream is None:
+            self.stream = self.opener()
+        buffer, self._buffer, self._buffered = self._buffer, [], 0
+        for data in buffer:
+            self.stream.write(data)
+
+    def _close(self, exc_type, exc_value, traceback):
+        # bytes received before a failure are written too, e.g. to resume
+        # from the .part file
+        try:
+            self._flush()
+        except BaseException:
+            if self.stream is not None:
+                self.stream.__exit__(*sys.exc_info())
+            raise
+        return self.stream.__exit__(exc_type, exc_value, traceback)
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return await _in_thread(self._close, exc_type, exc_value, traceback)
+
+
+class Downloader(fetchers.Downloader):
+    def __init__(self, *args, **kwargs):
+        """
+        Async version of fetchers.Downloader, with the same arguments. Call
+        `await run()` to download.
+        """
+
+        super().__init__(*args, **kwargs)
+
+    def _start(self):
+        # downloaded by run()
+        pass
+
+    async def run(self):
+        if not self.url.startswith("http"):
+            # aiohttp only speaks HTTP, e.g. SIFTS comes from the EBI FTP
+            await self._download_in_thread()
+        elif (self.override or self.refresh or
+                not await _in_thread(self._available)):
+            await self._download()
+            await _in_thread(self._record_artefact)
+            await _in_thread(self._remove_variants)
+        else:
+            logger.info("%s already available...", self.outputfile)
+            get_metrics().cache(self.url, "local", source=self._source())
+        return self
+
+    async def _download_in_thread(self):
+        # the synchronous Downloader does all of it, and records the
+        # download in the metrics and the index
+        downloader = await _in_thread(lambda: fetchers.Downloader(
+            self.url, self.outputfile_origin, decompress=self.decompress,
+            override=self.override, keep_compressed=self.keep_compressed,
+            refresh=self.refresh, max_retries=self.max_retries,
+            artefact=self.artefact, storage=self.storage))
+        self.not_modified = downloader.not_modified
+        self.error = downloader.error
+        self.trace = downloader.trace
+
+    async def _download(self):
+        policy = get_retry_policy()
+        attempt = 0
+        while True:
+            try:
+                await self._attempt()
+                self.error = None
+                self._record_metrics(retries=attempt)
+                return
+            except Exception as e:
+                self.error = e
+                delay = policy.next_delay(attempt, error=e,
+                                          max_retries=self.max_retries)
+                if delay is None:
+                    logger.debug("Unable to retrieve %s for %s", self.url, e)
+                    self._record_metrics(retries=attempt)
+                    return
+            attempt += 1
+            logger.debug("Retrying %s in %.2f seconds (%s)...", self.url, delay,
+                         self.error)
+            await asyncio.sleep(delay)
+
+    async def _attempt(self):
+        trace = self.trace = Trace()
+        offset = await _in_thread(self._partial_size)
+        response, offset = await self._request(offset=offset)
+        trace.responded(response.status, response.headers)
+        async with response:
+            response.raise_for_status()
+            if response.status == 304:
+                self.not_modified = True
+                logger.info("%s not modified...", self.outputfile)
+                trace.finished()
+                return
+            async with _ThreadedStream(
+                    lambda: self._output_stream(offset=offset)) as outfile:
+                async for chunk in response.content.iter_chunked(
+                        fetchers.CHUNK_SIZE):
+                    await outfile.write(chunk)
+            trace.finished(size=outfile.size,
+                           decompress=outfile.decompress_seconds)
+            await _in_thread(self._record_validators, response.headers)
+
+    async def _request(self, offset=0):
+        header = {"Accept-Encoding": "identity"}
+        if offset:
+            header["Range"] = "bytes={}-".format(offset)
+        else:
+            header.update(await _in_thread(self._conditional_header))
+        await asyncio.sleep(reserve(self.url))
+        response = await get_session().get(self.url, headers=header,
+                                           auto_decompress=False)
+        if offset:
+            content_range = response.headers.get("Content-Range", "")
+            if (response.status == 206 and
+                    content_range.startswith("bytes {}-".format(offset))):
+                logger.info("Resuming %s from byte %s", self.url, offset)
+                return response, offset
+            elif response.status == 200:
+                return response, 0
+            response.release()
+            return await self._request(offset=0)
+        return response, 0
+
+
+async def fetch_summary_properties_pdbe(identifier, retry_in=(429,)):
+    """
+    Queries the PDBe API to get summary properties.
+
+    :param identifier: PDB ID
+    :param retry_in: http code for retrying connections
+    :return: CachedResponse object
+    """
+
+    url_root = config.http_pdbe
+    url_enpoint = "api/pdb/entry/summary/"
+    url = url_root + url_enpoint + identifier
+    return await fetch_from_url_or_retry(url, json=True, retry_in=retry_in)
+
+
+async def get_preferred_assembly_id(identifier):
+    """
+    Gets the preferred assembly id for the given PDB ID, from the PDBe API.
+    Results are memoized for the whole run, with the synchronous
+    fetchers.get_preferred_assembly_id.
+
+    :param identifier: PDB ID
+    :return: (str)
+    """
+
+    pref_assembly = fetchers._memoized_assembly(identifier)
+    if pref_assembly is not None:
+        return pref_assembly
+    data = None
+    try:
+        data = await fetch_summary_properties_pdbe(identifier)
+    except Exception as e:
+        logger.critical("Something went wrong for %s... %s", identifier, e)
+    return fetchers._assembly_from_summary(identifier, data)
+
+
+async def _download(url, outputfile, override=False, artefact=None):
+    await _in_thread(fetchers._makedirs, os.path.dirname(outputfile))
+    downloader = Downloader(url=url, outputfile=outputfile,
+                            decompress=True, override=override,
+                            artefact=artefact)
+    return await downloader.run()
+
+
+async def download_structure_from_pdbe(identifier, pdb=False, bio=False,
+                                       override=False):
+    """
+    Downloads a structure from the PDBe to the filesystem.
+
+    :param identifier: (str) PDB ID
+    :param pdb: (boolean) PDB formatted if True, otherwise mmCIF format
+    :param bio: (boolean) if true downloads the preferred Biological Assembly
+    :param override: (boolean)
+    :return: Downloader object
+    """
+
+    pref = "1"
+    if bio and not pdb:
+        pref = await get_preferred_assembly_id(identifier)
+    url, outputfile = fetchers._structure_target(identifier, pdb=pdb, bio=bio,
+                                                 assembly_id=pref)
+    file_format = "pdb" if pdb else "bio" if bio else "mmcif"
+    return await _download(url, outputfile, override=override,
+                           artefact=("pdbe", identifier, file_format))
+
+
+async def download_sifts_from_ebi(identifier, override=False):
+    """
+    Downloads a SIFTS xml from the EBI FTP to the filesystem.
+
+    :param identifier: (str) PDB ID
+    :param override: (boolean)
+    :return: Downloader object
+    """
+
+    url, outputfile = fetchers._sifts_target(identifier)
+    return await _download(url, outputfile, override=override,
+                           artefact=("sifts", identifier, "sifts"))
+
+
+async def download_data_from_uniprot(identifier, file_format="fasta",
+                                     override=False):
+    """
+    Downloads a UniProt fasta, gff or txt to the filesystem.
+
+    :param identifier: (str) UniProt ID
+    :param file_format: (str) endpoint
+    :param override: (boolean)
+    :return: Downloader object
+    """
+
+    url, outputfile = fetchers._uniprot_target(identifier,
+                                               file_format=file_format)
+    return await _download(url, outputfile, override=override,
+                           artefact=("uniprot", identifier,
+                                     file_format.lstrip('.')))
+
+
+async def download_alignment_from_cath(identifier, max_sequences=200,
+                                       override=False):
+    """
+    Downloads a MSA in fasta format from CATH to the filesystem.
+
+    :param identifier: (str) CATH ID (<Superfamily>_<Funfam>)
+    :param max_sequences: (str) Maximum number of sequences (default = 200)
+    :param override: (boolean)
+    :return: Downloader object
+    """
+
+    url, outputfile = fetchers._cath_target(identifier,
+                                            max_sequences=max_sequences)
+    return await _download(url, outputfile, override=override,
+                           artefact=("cath", identifier, "cath"))
+
+
+async def download_alignment_from_pfam(identifier, alignment_size="seed",
+                                       override=False):
+    """
+    Downloads a MSA in Stockholm format from Pfam to the filesystem.
+
+    :param identifier: (str) PFam ID
+    :param alignment_size: (str) either "seed" or "full"
+    :param override: (boolean)
+    :return: Downloader object
+    """
+
+    url, outputfile = fetchers._pfam_target(identifier,
+                                            alignment_size=alignment_size)
+    return await _download(url, outputfile, override=override,
+                           artefact=("pfam", identifier, "pfam"))
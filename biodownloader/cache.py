@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+import json as jsonlib
+from collections import OrderedDict
+
+from biodownloader.config import config
+
+logger = logging.getLogger("biodownloader")
+
+_lock = threading.Lock()
+_caches = {}
+
+
+class CachedResponse(object):
+    def __init__(self, url, status_code, headers, content):
+        """
+        Decoded payload of an HTTP response, without the connection
+        machinery of requests.Response.
+
+        :param url: (str) Full web-address
+        :param status_code: (int) HTTP status code
+        :param headers: (dict) response headers
+        :param content: (bytes) response body
+        """
+
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @classmethod
+    def from_response(cls, response):
+        headers = {}
+        if "Content-Type" in response.headers:
+            headers["Content-Type"] = response.headers["Content-Type"]
+        return cls(response.url, response.status_code, headers, response.content)
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return jsonlib.loads(self.text)
+
+    def dumps(self, level=6):
+        """
+        :param level: (int) zlib compression level
+        :return: (bytes) compressed representation
+        """
+
+        meta = jsonlib.dumps([self.url, self.status_code, self.headers])
+        return zlib.compress(meta.encode("utf-8") + b"\n" + self.content, level)
+
+    @classmethod
+    def loads(cls, data):
+        meta, content = zlib.decompress(data).split(b"\n", 1)
+        url, status_code, headers = jsonlib.loads(meta.decode("utf-8"))
+        return cls(url, status_code, headers, content)
+
+
+class MemoryCache(object):
+    def __init__(self, max_entries=10000):
+        """
+        In-process LRU cache with per-entry expiry times.
+
+        :param max_entries: (int) entries kept before evicting the oldest
+        """
+
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires):
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskCache(object):
+    def __init__(self, path, max_size=256 * 1024 * 1024, level=6):
+        """
+        Single-file (sqlite) cache of compressed responses with expiry times.
+        The least recently used entries are evicted when the total
+        compressed size grows beyond max_size.
+
+        :param path: (str) sqlite filename
+        :param max_size: (int) size cap in bytes
+        :param level: (int) zlib compression level
+        """
+
+        self.path = path
+        self.max_size = max_size
+        self.level = level
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30,
+                                           check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, payload BLOB, size INTEGER, "
+                "expires REAL, accessed REAL)")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_accessed "
+                "ON entries (accessed)")
+        self._size = self._total_size()
+
+    def _total_size(self):
+        row = self._connection.execute("SELECT SUM(size) FROM entries").fetchone()
+        return row[0] or 0
+
+    def get(self, key):
+        """
+        :param key: (str) cache key
+        :return: CachedResponse or None if missing or expired
+        """
+
+        return self.lookup(key)[0]
+
+    def lookup(self, key):
+        """
+        :param key: (str) cache key
+        :return: tuple (CachedResponse, expiry time) or (None, None)
+        """
+
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT payload, expires FROM entries WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                return None, None
+            if row[1] < now:
+                self._connection.execute("DELETE FROM entries WHERE key = ?",
+                                         (key,))
+                return None, None
+            self._connection.execute(
+                "UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        return CachedResponse.loads(row[0]), row[1]
+
+    def set(self, key, value, expires):
+        """
+        :param key: (str) cache key
+        :param value: CachedResponse object
+        :param expires: (float) expiry time (seconds since the epoch)
+        :return: (side effects)
+        """
+
+        payload = value.dumps(level=self.level)
+        with self._lock, self._connection:
+            # a replaced entry no longer counts towards the size
+            row = self._connection.execute(
+                "SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, sqlite3.Binary(payload), len(payload), expires,
+                 time.time()))
+            self._size += len(payload) - (row[0] if row is not None else 0)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # expired entries first, then the least recently used ones
+        self._connection.execute("DELETE FROM entries WHERE expires < ?",
+                                 (time.time(),))
+        self._size = self._total_size()
+        target = int(self.max_size * 0.9)
+        if self._size > target:
+            rows = self._connection.execute(
+                "SELECT key, size FROM entries ORDER BY accessed")
+            evicted = []
+            for key, size in rows:
+                if self._size <= target:
+                    break
+                evicted.append((key,))
+                self._size -= size
+            self._connection.executemany("DELETE FROM entries WHERE key = ?",
+                                         evicted)
+            logger.debug("Evicted %s entries from %s", len(evicted), self.path)
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM entries")
+            self._size = 0
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class Cache(object):
+    def __init__(self, path, max_size=256 * 1024 * 1024, max_entries=10000):
+        """
+        Memory tier on top of a DiskCache, with per-endpoint time-to-live
+        (see config.cache_ttl).
+
+        :param path: (str) sqlite filename
+        :param max_size: (int) disk size cap in bytes
+        :param max_entries: (int) entries kept in memory
+        """
+
+        self.memory = MemoryCache(max_entries=max_entries)
+        self.disk = DiskCache(path, max_size=max_size)
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None:
+            value, expires = self.disk.lookup(key)
+            if value is not None:
+                self.memory.set(key, value, expires)
+        return value
+
+    def set(self, key, value, endpoint="default"):
+        expires = time.time() + _ttl(endpoint)
+        self.memory.set(key, value, expires)
+        self.disk.set(key, value, expires)
+
+    def clear(self):
+        self.memory.clear()
+        self.disk.clear()
+
+    def close(self):
+        self.disk.close()
+
+
+def _ttl(endpoint):
+    return config.cache_ttl.get(endpoint, config.cache_ttl["default"])
+
+
+def get_cache():
+    """
+    Gets the (per process) response Cache, stored in
+    <db_root>/<db_pickled>/<cache_file>.
+
+    :return: Cache object
+    """
+
+    directory = os.path.join(config.db_root, config.db_pickled)
+    path = os.path.abspath(os.path.join(directory, config.cache_file))
+    with _lock:
+        if path not in _caches:
+            os.makedirs(directory, exist_ok=True)
+            _caches[path] = Cache(path, max_size=config.cache_max_size,
+                                  max_entries=config.cache_memory_entries)
+        return _caches[path]
+
+
+def close_caches():
+    """
+    Closes every open Cache.
+
+    :return: (side effects)
+    """
+
+    with _lock:
+        for cache in _caches.values():
+            cache.close()
+        _caches.clear()
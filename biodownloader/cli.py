@@ -20,14 +20,82 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+# only click is imported up front, so that --help and the commands start
+# quickly: the HTTP stack and the download modules are imported by the
+# commands that use them
 import click
-import click_log
 import logging
 
 import biodownloader.version
+from biodownloader.storage import CODECS
 
 logger = logging.getLogger("biodownloader")
-click_log.basic_config(logger)
+
+LOG_COLORS = {
+    "error": dict(fg="red"),
+    "exception": dict(fg="red"),
+    "critical": dict(fg="red"),
+    "debug": dict(fg="blue"),
+    "warning": dict(fg="yellow"),
+}
+
+
+class ClickFormatter(logging.Formatter):
+    def format(self, record):
+        message = super(ClickFormatter, self).format(record)
+        level = record.levelname.lower()
+        if level in LOG_COLORS:
+            prefix = click.style("{}: ".format(level), **LOG_COLORS[level])
+            message = "\n".join(prefix + line
+                                 for line in message.splitlines())
+        return message
+
+
+class ClickHandler(logging.Handler):
+    def emit(self, record):
+        try:
+            click.echo(self.format(record), err=True)
+        except Exception:
+            self.handleError(record)
+
+
+def basic_config(logger):
+    """
+    Logs to stderr through click (levels other than INFO are prefixed).
+
+    :param logger: logging.Logger object
+    :return: logging.Logger object
+    """
+
+    handler = ClickHandler()
+    handler.setFormatter(ClickFormatter())
+    logger.handlers = [handler]
+    logger.propagate = False
+    return logger
+
+
+def verbosity_option(*names, **kwargs):
+    """
+    Adds a -v/--verbosity LVL option setting the level of the logger.
+    """
+
+    def set_level(ctx, param, value):
+        level = getattr(logging, value.upper(), None)
+        if not isinstance(level, int):
+            raise click.BadParameter("Must be CRITICAL, ERROR, WARNING, INFO "
+                                     "or DEBUG, not {}".format(value))
+        logger.setLevel(level)
+
+    kwargs.setdefault("default", "INFO")
+    kwargs.setdefault("metavar", "LVL")
+    kwargs.setdefault("expose_value", False)
+    kwargs.setdefault("help", "Either CRITICAL, ERROR, WARNING, INFO or DEBUG.")
+    kwargs.setdefault("is_eager", True)
+    kwargs.setdefault("callback", set_level)
+    return click.option(*(names or ("--verbosity", "-v")), **kwargs)
+
+
+basic_config(logger)
 
 
 # https://github.com/pallets/click/issues/108
@@ -45,10 +113,55 @@ common_options = [
                  default=False, is_flag=True, required=False),
     click.option('--output', 'output_dir', multiple=False, required=False,
                  help='Directory path to which the files will be written.'),
+    click.option('--refresh', 'refresh', multiple=False,
+                 help=('Re-downloads existing files only if the server '
+                       'reports them as changed.'),
+                 default=False, is_flag=True, required=False),
+    click.option('--keep-compressed', 'keep_compressed', multiple=False,
+                 help='Keeps the original .gz file next to the decompressed one.',
+                 default=False, is_flag=True, required=False),
+    click.option('--storage', 'storage', multiple=False, required=False,
+                 help=('Stores the files decompressed (plain), gzipped, as '
+                       'zstd (.zst) or as BGZF (.gz with random access).'),
+                 type=click.Choice(CODECS)),
+    click.option('--sharded', 'sharded', multiple=False,
+                 help=('Stores PDB, SIFTS and UniProt files in shard '
+                       'subdirectories (e.g. pa/2pah.cif, P00/P00439.fasta).'),
+                 default=False, is_flag=True, required=False),
+    click.option('--jobs', 'jobs', multiple=False, required=False,
+                 help='Number of files downloaded in parallel (default: 1).',
+                 default=1, type=click.IntRange(min=1)),
+    click.option('--hedge', 'hedge', multiple=False,
+                 help=('Sends a duplicate API request when a response is '
+                       'slower than usual and keeps the first answer.'),
+                 default=False, is_flag=True, required=False),
+    click.option('--ids-from', 'ids_from', multiple=False, required=False,
+                 help=('File with IDs (whitespace or comma separated), '
+                       'or - to read them from stdin.'),
+                 type=click.File('r')),
+    click.option('--rate-limit', 'rate_limit', multiple=False, required=False,
+                 help='Maximum requests per second to each data provider.',
+                 default=None, type=click.FloatRange(min=0, min_open=True)),
+    click.option('--rate-limit-dir', 'rate_limit_dir', multiple=False,
+                 required=False,
+                 help=('Directory of lock files sharing the rate limits with '
+                       'other BioDownloader processes.')),
+    click.option('--cache-proxy', 'cache_proxy', multiple=False,
+                 required=False,
+                 help=('Address of a BioDownloader serve-cache proxy to '
+                       'download through (e.g. http://node1:8008).')),
+    click.option('--metrics-textfile', 'metrics_textfile', multiple=False,
+                 required=False,
+                 help=('Writes request metrics to this file in the Prometheus '
+                       'text format (e.g. for the node_exporter textfile '
+                       'collector).')),
+    click.option('--metrics-events', 'metrics_events', multiple=False,
+                 required=False,
+                 help='Appends one JSON line per request to this file.'),
 ]
 
 common_arguments = [
-    click.argument('ids', nargs=-1, required=True),
+    click.argument('ids', nargs=-1, required=False),
 ]
 
 
@@ -77,39 +190,44 @@ def downloads():
               help=('Preferred BioUnit instead of the asymmetric unit. '
                     'This option only works paired with --mmcif'),
               default=False, is_flag=True, required=False)
-@click_log.simple_verbosity_option()
+@click.option('--mirrors', 'mirrors', multiple=False,
+              help=('Downloads from the fastest healthy wwPDB mirror (PDBe, '
+                    'RCSB or PDBj), failing over to the others on errors.'),
+              default=False, is_flag=True, required=False)
+@verbosity_option()
 @add_common(common_options)
 @add_common(common_arguments)
-def pdb(ids, pdb=False, mmcif=False, bio=False,
-        override=False, output_dir=None):
+def pdb(ids, pdb=False, mmcif=False, bio=False, mirrors=False, **kwargs):
     """
     Macromolecular structures from the PDBe.
 
-    Pass one or more accession IDs (e.g. '2pah' or '2pah 3kic').
+    Pass one or more accession IDs (e.g. '2pah' or '2pah 3kic'),
+    or a file of IDs with --ids-from.
     """
 
     file_downloader(ids, pdb=pdb, mmcif=mmcif, bio=bio, sifts=False,
                     fasta=False, gff=False, txt=False, cath=False, pfam=False,
-                    override=override, output_dir=output_dir)
+                    mirrors=mirrors, **kwargs)
 
 
 @downloads.command('sifts')
 @click.option('--sifts', 'sifts', multiple=False,
               help='SIFTS xml format (expects PDB ID).',
               default=False, is_flag=True, required=False)
-@click_log.simple_verbosity_option()
+@verbosity_option()
 @add_common(common_options)
 @add_common(common_arguments)
-def sifts(ids, sifts=False, override=False, output_dir=None):
+def sifts(ids, sifts=False, **kwargs):
     """
     SIFTS xml structure-sequence mappings from the EBI.
 
-    Pass one or more accession IDs (e.g. '2pah' or '2pah 3kic').
+    Pass one or more accession IDs (e.g. '2pah' or '2pah 3kic'),
+    or a file of IDs with --ids-from.
     """
 
     file_downloader(ids, pdb=False, mmcif=False, bio=False, sifts=sifts,
                     fasta=False, gff=False, txt=False, cath=False, pfam=False,
-                    override=override, output_dir=output_dir)
+                    **kwargs)
 
 
 @downloads.command('uniprot')
@@ -122,109 +240,372 @@ def sifts(ids, sifts=False, override=False, output_dir=None):
 @click.option('--txt', 'txt', multiple=False,
               help='UniProt record in txt format (expects UniProt ID).',
               default=False, is_flag=True, required=False)
-@click_log.simple_verbosity_option()
+@click.option('--batch', 'batch', multiple=False,
+              help=('Fetches many accessions per UniProt request and splits '
+                    'the response into one file per accession.'),
+              default=False, is_flag=True, required=False)
+@verbosity_option()
 @add_common(common_options)
 @add_common(common_arguments)
-def uniprot(ids, fasta=False, gff=False, txt=False,
-            override=False, output_dir=None):
+def uniprot(ids, fasta=False, gff=False, txt=False, batch=False, **kwargs):
     """
     Sequences (fasta) and sequence annotations in SwissProt (txt) or
     GFF (gff) format from the UniProt.
 
-    Pass one or more accession IDs (e.g. 'P00439' or 'P00439 P12345').
+    Pass one or more accession IDs (e.g. 'P00439' or 'P00439 P12345'),
+    or a file of IDs with --ids-from.
     """
 
     file_downloader(ids, pdb=False, mmcif=False, bio=False, sifts=False,
                     fasta=fasta, gff=gff, txt=txt, cath=False, pfam=False,
-                    override=override, output_dir=output_dir)
+                    batch=batch, **kwargs)
 
 
 @downloads.command('cath')
-@click_log.simple_verbosity_option()
+@verbosity_option()
 @add_common(common_options)
 @add_common(common_arguments)
 @click.option('--cath', 'cath', multiple=False,
               help=('CATH Funfam alignment in fasta format '
                     '(expects a CATH <Superfamily>_<Funfam> ID).'),
               default=False, is_flag=True, required=False)
-def cath(ids, cath=False, override=False, output_dir=None):
+def cath(ids, cath=False, **kwargs):
     """
     Multiple sequence alignments (fasta) from CATH.
 
-    Pass one or more accession IDs (e.g. '1.50.10.100_1318').
+    Pass one or more accession IDs (e.g. '1.50.10.100_1318'),
+    or a file of IDs with --ids-from.
     """
 
     file_downloader(ids, pdb=False, mmcif=False, bio=False, sifts=False,
                     fasta=False, gff=False, txt=False, cath=cath, pfam=False,
-                    override=override, output_dir=output_dir)
+                    **kwargs)
 
 
 @downloads.command('pfam')
-@click_log.simple_verbosity_option()
+@verbosity_option()
 @add_common(common_options)
 @add_common(common_arguments)
 @click.option('--pfam', 'pfam', multiple=False,
               help=('Pfam alignment in Stockholm format '
                     '(expects a Pfam ID).'),
               default=False, is_flag=True, required=False)
-def pfam(ids, pfam=False, override=False, output_dir=None):
+def pfam(ids, pfam=False, **kwargs):
     """
     Multiple sequence alignments (fasta) from Pfam.
 
-    Pass one or more accession IDs (e.g. 'PF08124').
+    Pass one or more accession IDs (e.g. 'PF08124'),
+    or a file of IDs with --ids-from.
     """
 
     file_downloader(ids, pdb=False, mmcif=False, bio=False, sifts=False,
                     fasta=False, gff=False, txt=False, cath=False, pfam=pfam,
-                    override=override, output_dir=output_dir)
+                    **kwargs)
+
+
+@downloads.command('rebuild-index')
+@verbosity_option()
+@click.option('--output', 'output_dir', multiple=False, required=False,
+              help='Directory path to which the files were written.')
+@click.option('--sharded', 'sharded', multiple=False,
+              help='Files are stored in shard subdirectories.',
+              default=False, is_flag=True, required=False)
+def rebuild_index(output_dir=None, sharded=False):
+    """
+    Rebuilds the index of downloaded files from a scan of the
+    download directories.
+    """
+
+    from biodownloader.config import config
+    from biodownloader.index import get_index, data_directories
+    if output_dir is not None:
+        config.db_root = output_dir
+    found = get_index().rebuild(data_directories(), shards=sharded)
+    click.echo("Indexed {} files...".format(found))
+
+
+@downloads.command('migrate-layout')
+@verbosity_option()
+@click.option('--output', 'output_dir', multiple=False, required=False,
+              help='Directory path to which the files were written.')
+@click.option('--flat', 'flat', multiple=False,
+              help='Moves sharded files back to flat directories.',
+              default=False, is_flag=True, required=False)
+def migrate_layout(output_dir=None, flat=False):
+    """
+    Moves downloaded PDB, SIFTS and UniProt files to shard
+    subdirectories, for use with --sharded.
+    """
+
+    from biodownloader.config import config
+    from biodownloader.layout import migrate
+    if output_dir is not None:
+        config.db_root = output_dir
+    moved = migrate(sharded=not flat)
+    click.echo("Moved {} files...".format(moved))
+
+
+@downloads.command('sync')
+@click.option('--pdb', 'pdb', multiple=False,
+              help='Structures in PDB format.',
+              default=False, is_flag=True, required=False)
+@click.option('--mmcif', 'mmcif', multiple=False,
+              help='Structures in mmCIF format (default).',
+              default=False, is_flag=True, required=False)
+@click.option('--bio', 'bio', multiple=False,
+              help='Preferred BioUnits in mmCIF format.',
+              default=False, is_flag=True, required=False)
+@click.option('--sifts', 'sifts', multiple=False,
+              help='SIFTS xml structure-sequence mappings.',
+              default=False, is_flag=True, required=False)
+@click.option('--lists', 'lists', multiple=False, required=False,
+              help=('Directory or url with the added.pdb, modified.pdb and '
+                    'obsolete.pdb lists (default: the latest wwPDB lists).'))
+@click.option('--dry-run', 'dry_run', multiple=False,
+              help='Lists the downloads without downloading or moving files.',
+              default=False, is_flag=True, required=False)
+@click.option('--output', 'output_dir', multiple=False, required=False,
+              help='Directory path to which the files are written.')
+@click.option('--sharded', 'sharded', multiple=False,
+              help='Files are stored in shard subdirectories.',
+              default=False, is_flag=True, required=False)
+@click.option('--keep-compressed', 'keep_compressed', multiple=False,
+              help='Keeps the original .gz file next to the decompressed one.',
+              default=False, is_flag=True, required=False)
+@click.option('--storage', 'storage', multiple=False, required=False,
+              help=('Stores the files decompressed (plain), gzipped, as zstd '
+                    '(.zst) or as BGZF (.gz with random access).'),
+              type=click.Choice(CODECS))
+@click.option('--jobs', 'jobs', multiple=False, required=False,
+              help='Number of files downloaded in parallel (default: 1).',
+              default=1, type=click.IntRange(min=1))
+@click.option('--metrics-textfile', 'metrics_textfile', multiple=False,
+              required=False,
+              help='Writes request metrics to this file (Prometheus format).')
+@click.option('--metrics-events', 'metrics_events', multiple=False,
+              required=False,
+              help='Appends one JSON line per request to this file.')
+@verbosity_option()
+def sync(pdb=False, mmcif=False, bio=False, sifts=False, lists=None,
+         dry_run=False, output_dir=None, sharded=False, keep_compressed=False,
+         storage=None, jobs=1, metrics_textfile=None, metrics_events=None):
+    """
+    Updates a local structure mirror from the wwPDB weekly lists.
+
+    New entries and modified ones already held are downloaded, obsolete
+    ones are moved to the obsolete directory.
+    """
+
+    from biodownloader.sync import sync as sync_entries
+    from biodownloader.metrics import report
+    requested = {"pdb": pdb, "mmcif": mmcif, "bio": bio, "sifts": sifts}
+    file_formats = [k for k in requested if requested[k]] or ["mmcif"]
+    _configure(output_dir=output_dir, keep_compressed=keep_compressed,
+               sharded=sharded, metrics_textfile=metrics_textfile,
+               metrics_events=metrics_events, storage=storage,
+               file_formats=file_formats)
+    result = sync_entries(file_formats, location=lists, jobs=jobs,
+                          dry_run=dry_run)
+    report()
+    if dry_run:
+        for identifier, file_format, override in result.downloads:
+            click.echo("Would download {} {} ({})".format(
+                identifier, file_format, "modified" if override else "added"))
+    failed = len([r for r in result.results if not r.ok])
+    click.echo("{} added, {} modified and {} obsolete entries ({} files "
+               "moved aside, {} downloads failed)...".format(
+                   len(result.added), len(result.modified),
+                   len(result.obsolete), len(result.moved), failed))
+
+
+@downloads.command('daemon')
+@verbosity_option()
+@click.option('--host', 'host', multiple=False, required=False,
+              help='Address to listen on (default: 127.0.0.1).')
+@click.option('--port', 'port', multiple=False, required=False,
+              help='Port to listen on (default: 8009).',
+              type=click.IntRange(min=0, max=65535))
+@click.option('--socket', 'socket_path', multiple=False, required=False,
+              help='Listens on a unix socket instead of a TCP port.')
+@click.option('--jobs', 'jobs', multiple=False, required=False,
+              help='Files of a request downloaded in parallel (default: 8).',
+              type=click.IntRange(min=1))
+@click.option('--output', 'output_dir', multiple=False, required=False,
+              help='Directory path to which the files will be written.')
+@click.option('--sharded', 'sharded', multiple=False,
+              help='Stores files in shard subdirectories.',
+              default=False, is_flag=True, required=False)
+@click.option('--keep-compressed', 'keep_compressed', multiple=False,
+              help='Keeps the original .gz file next to the decompressed one.',
+              default=False, is_flag=True, required=False)
+@click.option('--storage', 'storage', multiple=False, required=False,
+              help=('Stores the files decompressed (plain), gzipped, as zstd '
+                    '(.zst) or as BGZF (.gz with random access).'),
+              type=click.Choice(CODECS))
+@click.option('--cache-proxy', 'cache_proxy', multiple=False, required=False,
+              help='Address of a BioDownloader serve-cache proxy to '
+                   'download through.')
+@click.option('--metrics-textfile', 'metrics_textfile', multiple=False,
+              required=False,
+              help=('Rewrites request metrics to this file (Prometheus '
+                    'format) after every request.'))
+@click.option('--metrics-events', 'metrics_events', multiple=False,
+              required=False,
+              help='Appends one JSON line per request to this file.')
+def daemon(host=None, port=None, socket_path=None, jobs=None, output_dir=None,
+           sharded=False, keep_compressed=False, storage=None,
+           cache_proxy=None, metrics_textfile=None, metrics_events=None):
+    """
+    Runs a download service with an HTTP API, e.g.
+
+        $ curl 'localhost:8009/download?id=2pah&format=mmcif'
+
+    Concurrent requests for the same file share one download.
+    """
+
+    from biodownloader.daemon import serve
+    _configure(output_dir=output_dir, keep_compressed=keep_compressed,
+               sharded=sharded, cache_proxy=cache_proxy,
+               metrics_textfile=metrics_textfile, metrics_events=metrics_events,
+               storage=storage)
+    serve(host=host, port=port, path=socket_path, jobs=jobs)
+
+
+@downloads.command('serve-cache')
+@verbosity_option()
+@click.option('--host', 'host', multiple=False, required=False,
+              help='Address to listen on (default: 127.0.0.1).')
+@click.option('--port', 'port', multiple=False, required=False,
+              help='Port to listen on (default: 8008).',
+              type=click.IntRange(min=0, max=65535))
+@click.option('--cache-dir', 'cache_dir', multiple=False, required=False,
+              help='Directory of the cached files (default: OUTPUT/proxy-cache).')
+@click.option('--max-size', 'max_size', multiple=False, required=False,
+              help='Size cap of the cache in GiB (default: 50).',
+              type=click.FloatRange(min=0, min_open=True))
+@click.option('--output', 'output_dir', multiple=False, required=False,
+              help='Directory path under which the cache is kept.')
+def serve_cache(host=None, port=None, cache_dir=None, max_size=None,
+                output_dir=None):
+    """
+    Runs a read-through caching proxy for the data providers.
+
+    Point other nodes at it with --cache-proxy http://HOST:PORT.
+    """
+
+    from biodownloader.config import config
+    from biodownloader.proxy import serve
+    if output_dir is not None:
+        config.db_root = output_dir
+    if max_size is not None:
+        max_size = int(max_size * 1024 ** 3)
+    serve(host=host, port=port, directory=cache_dir, max_size=max_size)
+
+
+def _configure(output_dir=None, keep_compressed=False, refresh=False,
+               hedge=False, mirrors=False, sharded=False, cache_proxy=None,
+               rate_limit=None, rate_limit_dir=None, metrics_textfile=None,
+               metrics_events=None, storage=None, file_formats=None):
+    # config changes shared by the commands, see file_downloader
+    from biodownloader.config import config
+    if output_dir is not None:
+        config.db_root = output_dir
+    if keep_compressed:
+        config.keep_compressed = True
+    if refresh:
+        config.refresh = True
+    if hedge:
+        config.hedge_requests = True
+    if mirrors:
+        config.structure_mirrors = True
+    if sharded:
+        config.sharded_layout = True
+    if cache_proxy is not None:
+        from biodownloader.proxy import route_through
+        route_through(cache_proxy)
+    if rate_limit is not None:
+        burst = max(1, int(rate_limit))
+        config.rate_limits = {key: (rate_limit, burst) for key in
+                              ("http_pdbe", "http_uniprot", "http_uniprot_stream",
+                               "http_cath", "http_pfam", "ftp_sifts")}
+    if rate_limit_dir is not None:
+        config.rate_limit_dir = rate_limit_dir
+    if rate_limit is not None or rate_limit_dir is not None:
+        from biodownloader.ratelimit import reset_rate_limiters
+        reset_rate_limiters()
+    if metrics_textfile is not None:
+        config.metrics_textfile = metrics_textfile
+    if metrics_events is not None:
+        config.metrics_events = metrics_events
+    if storage is not None and file_formats:
+        # only the sources of this command (chained commands can store
+        # their files differently)
+        from biodownloader.engine import FORMAT_SOURCES
+        config.storage_codecs = dict(config.storage_codecs, **{
+            FORMAT_SOURCES[f]: storage for f in file_formats})
+    elif storage is not None:
+        config.storage_codec = storage
 
 
 def file_downloader(ids, pdb=False, mmcif=False, bio=False, sifts=False,
                     fasta=False, gff=False, txt=False, cath=False, pfam=False,
-                    override=False, output_dir=None):
+                    override=False, output_dir=None, jobs=1,
+                    keep_compressed=False, refresh=False, batch=False,
+                    rate_limit=None, rate_limit_dir=None, hedge=False,
+                    mirrors=False, ids_from=None, sharded=False,
+                    cache_proxy=None, metrics_textfile=None,
+                    metrics_events=None, storage=None):
+    """
+    Downloads every requested format for each ID.
+
+    :param ids: iterable of accession IDs
+    :param jobs: (int) number of files downloaded in parallel
+    :param keep_compressed: (boolean) keeps .gz files next to decompressed ones
+    :param refresh: (boolean) conditionally re-downloads existing files
+    :param batch: (boolean) fetches UniProt formats in batches of IDs
+    :param rate_limit: (float) requests per second to each provider host
+    :param rate_limit_dir: (str) directory sharing the rate limits between
+        processes
+    :param hedge: (boolean) hedges slow GET requests
+    :param mirrors: (boolean) downloads structures from the wwPDB mirrors
+    :param ids_from: file object with more IDs, read as they are needed
+    :param sharded: (boolean) stores files in shard subdirectories
+    :param cache_proxy: (str) address of a serve-cache proxy
+    :param metrics_textfile: (str) Prometheus textfile written at the end
+    :param metrics_events: (str) JSON-lines file of the requests made
+    :param storage: (str) storage codec of the requested formats, plain,
+        gzip, zstd or bgzf
+    :return: DownloadTally of the files downloaded and failed
+    """
+
+    requested = {"pdb": pdb, "mmcif": mmcif, "bio": bio, "sifts": sifts,
+                 "fasta": fasta, "gff": gff, "txt": txt, "cath": cath,
+                 "pfam": pfam}
+    file_formats = [k for k in requested if requested[k]]
+
     # Modify config if necessary
-    if output_dir is not None:
-        from biodownloader.config import config
-        config.db_root = output_dir
+    _configure(output_dir=output_dir, keep_compressed=keep_compressed,
+               refresh=refresh, hedge=hedge, mirrors=mirrors, sharded=sharded,
+               cache_proxy=cache_proxy, rate_limit=rate_limit,
+               rate_limit_dir=rate_limit_dir, metrics_textfile=metrics_textfile,
+               metrics_events=metrics_events, storage=storage,
+               file_formats=file_formats)
 
     # Download relevant information
-    for pid in ids:
-
-        if pdb:
-            from biodownloader.fetchers import download_structure_from_pdbe
-            download_structure_from_pdbe(pid, pdb=True,
-                                         override=override)
-        if mmcif:
-            from biodownloader.fetchers import download_structure_from_pdbe
-            download_structure_from_pdbe(pid, pdb=False, bio=False,
-                                         override=override)
-        if bio:
-            from biodownloader.fetchers import download_structure_from_pdbe
-            download_structure_from_pdbe(pid, pdb=False, bio=True,
-                                         override=override)
-        if sifts:
-            from biodownloader.fetchers import download_sifts_from_ebi
-            download_sifts_from_ebi(pid, override=override)
-
-        if fasta:
-            from biodownloader.fetchers import download_data_from_uniprot
-            download_data_from_uniprot(pid, file_format="fasta",
-                                       override=override)
-        if gff:
-            from biodownloader.fetchers import download_data_from_uniprot
-            download_data_from_uniprot(pid, file_format="gff",
-                                       override=override)
-        if txt:
-            from biodownloader.fetchers import download_data_from_uniprot
-            download_data_from_uniprot(pid, file_format="txt",
-                                       override=override)
-        if cath:
-            from biodownloader.fetchers import download_alignment_from_cath
-            download_alignment_from_cath(pid, max_sequences=20000,
-                                         override=override)
-        if pfam:
-            from biodownloader.fetchers import download_alignment_from_pfam
-            download_alignment_from_pfam(pid, override=override)
+    if not ids and ids_from is None:
+        raise click.UsageError("Pass one or more IDs, or --ids-from FILE...")
+    from itertools import chain
+    from biodownloader.ids import read_ids, normalise, unique
+    from biodownloader.engine import generate_results, tally
+    from biodownloader.metrics import report
+    if ids_from is not None:
+        ids = chain(ids, read_ids(ids_from))
+    ids = unique(normalise(ids, file_formats))
+    # counted as they complete, rather than kept for the whole input
+    counts = tally(generate_results(ids, file_formats, jobs=jobs,
+                                    override=override, batch=batch))
+    report()
+    return counts
 
 
 if __name__ == '__main__':
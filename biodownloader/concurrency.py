@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from biodownloader.config import config
+from biodownloader.retry import _transient
+
+logger = logging.getLogger("biodownloader")
+
+_lock = threading.Lock()
+_limits = None
+# limits scoped to a thread (see scope)
+_local = threading.local()
+_unset = object()
+
+
+class AIMDLimiter(object):
+    def __init__(self, name, maximum, minimum=1, initial=None, decrease=0.5,
+                 latency_factor=2.0, cooldown=1.0):
+        """
+        Concurrency limit that grows additively (by about one slot per
+        `limit` healthy responses) and shrinks multiplicatively on
+        congestion (429/500/503 responses, timeouts and connection errors).
+        Responses slower than latency_factor times the usual latency stop
+        the growth.
+
+        :param name: (str) host name, used in the logs
+        :param maximum: (int) upper bound of the limit
+        :param minimum: (int) lower bound of the limit
+        :param initial: (int) starting limit (defaults to minimum)
+        :param decrease: (float) factor applied to the limit on congestion
+        :param latency_factor: (float) latency (vs. the average) still
+            considered healthy
+        :param cooldown: (float) seconds between two decreases, so a burst
+            of failures from requests already in flight counts once
+        """
+
+        self.name = name
+        self.maximum = max(1, int(maximum))
+        self.minimum = max(1, min(int(minimum), self.maximum))
+        self.limit = float(min(max(initial or self.minimum, self.minimum),
+                               self.maximum))
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.latency = None
+        self._decreased = None
+        self._condition = threading.Condition()
+        logger.info("Concurrency limit for %s: %s", self.name, int(self.limit))
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, congested=False, latency=None):
+        """
+        :param congested: (boolean) the server signalled congestion
+        :param latency: (float) seconds until the response headers arrived,
+            None if there was no response
+        :return: (side effects)
+        """
+
+        with self._condition:
+            self.in_flight -= 1
+            previous = int(self.limit)
+            if congested:
+                now = time.monotonic()
+                if self._decreased is None or now - self._decreased >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._decreased = now
+            elif latency is not None:
+                if (self.latency is None or
+                        latency <= self.latency_factor * self.latency):
+                    self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+                    self.latency = (latency if self.latency is None else
+                                    0.95 * self.latency + 0.05 * latency)
+                else:
+                    self.latency = 0.95 * self.latency + 0.05 * latency
+            if int(self.limit) != previous:
+                logger.info("Concurrency limit for %s: %s", self.name,
+                            int(self.limit))
+            self._condition.notify_all()
+
+
+class Limits(object):
+    def __init__(self, maximum):
+        """
+        One AIMDLimiter per host, each between config.concurrency_min and
+        maximum (usually the number of worker threads).
+
+        :param maximum: (int) upper bound of every limit
+        """
+
+        self.maximum = maximum
+        self._lock = threading.Lock()
+        self._limiters = {}
+
+    def get(self, url):
+        """
+        :param url: (str) Full web-address
+        :return: AIMDLimiter object of the host in url
+        """
+
+        host = _host(url)
+        with self._lock:
+            if host not in self._limiters:
+                self._limiters[host] = AIMDLimiter(
+                    host, maximum=self.maximum,
+                    minimum=config.concurrency_min,
+                    initial=config.concurrency_initial,
+                    decrease=config.concurrency_decrease,
+                    latency_factor=config.concurrency_latency_factor)
+            return self._limiters[host]
+
+
+class Slot(object):
+    def __init__(self):
+        """
+        Outcome of a request made while holding a concurrency slot.
+        """
+
+        self.started = time.monotonic()
+        self.status_code = None
+        self.latency = None
+
+    def responded(self, status_code=None):
+        """
+        :param status_code: (int) HTTP status code of the response, if any
+        :return: (side effects)
+        """
+
+        self.status_code = status_code
+        self.latency = time.monotonic() - self.started
+
+
+def _host(url):
+    return urlparse(url).netloc.lower()
+
+
+def enable(maximum):
+    """
+    Turns on the per-host limits of the process (see Limits), except for
+    threads with limits of their own (see scope).
+
+    :param maximum: (int) upper bound of every limit
+    :return: (side effects)
+    """
+
+    global _limits
+
+    with _lock:
+        _limits = Limits(maximum)
+
+
+def disable():
+    global _limits
+
+    with _lock:
+        _limits = None
+
+
+@contextmanager
+def scope(limits):
+    """
+    Uses limits of its own (e.g. the daemon's) for the requests made by
+    the current thread, whatever enable and disable do to the process.
+
+    :param limits: Limits object, or None for no limits
+    :return: (side effects)
+    """
+
+    previous = getattr(_local, "limits", _unset)
+    _local.limits = limits
+    try:
+        yield limits
+    finally:
+        _local.limits = previous
+
+
+def get_concurrency_limiter(url):
+    """
+    Gets the AIMDLimiter of the host in url.
+
+    :param url: (str) Full web-address
+    :return: AIMDLimiter object or None if the limits are not enabled
+    """
+
+    limits = getattr(_local, "limits", _unset)
+    if limits is _unset:
+        with _lock:
+            limits = _limits
+    if limits is None:
+        return None
+    return limits.get(url)
+
+
+@contextmanager
+def slot(url):
+    """
+    Holds one of the host's concurrency slots for a request. Call
+    Slot.responded when the response headers arrive.
+
+    :param url: (str) Full web-address
+    :return: Slot object
+    """
+
+    limiter = get_concurrency_limiter(url)
+    current = Slot()
+    if limiter is None:
+        yield current
+        return
+    limiter.acquire()
+    current.started = time.monotonic()
+    try:
+        yield current
+    except Exception as e:
+        status_code = current.status_code
+        response = getattr(e, "response", None)
+        if response is not None:
+            status_code = getattr(response, "status_code", status_code)
+        if status_code is not None:
+            congested = status_code in config.concurrency_congestion_statuses
+        else:
+            congested = _transient(e)
+        limiter.release(congested=congested, latency=current.latency)
+        raise
+    else:
+        congested = (current.status_code in
+                     config.concurrency_congestion_statuses)
+        limiter.release(congested=congested, latency=current.latency)
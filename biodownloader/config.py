@@ -34,11 +34,15 @@ config_defaults["db_uniprot"] = "."
 config_defaults["db_cath"] = "."
 # Pfam dir
 config_defaults["db_pfam"] = "."
-# Pickled objects
+# Cached API responses
 config_defaults["db_pickled"] = "."
+# Obsolete structures moved aside by sync
+config_defaults["db_obsolete"] = "obsolete"
 
 # UniProt HTTP
 config_defaults["http_uniprot"] = "http://www.uniprot.org/uniprot/"
+# UniProt stream endpoint (multi-entry queries)
+config_defaults["http_uniprot_stream"] = "https://rest.uniprot.org/uniprotkb/stream"
 # PDBe HTTP
 config_defaults["http_pdbe"] = "http://www.ebi.ac.uk/pdbe/"
 # CATH HTTP
@@ -47,6 +51,175 @@ config_defaults["http_cath"] = "http://www.cathdb.info/version/v4_1_0/"
 config_defaults["ftp_sifts"] = "ftp://ftp.ebi.ac.uk/pub/databases/msd/sifts/xml/"
 # Pfam HTTP
 config_defaults["http_pfam"] = "http://pfam.xfam.org/"
+# wwPDB weekly status lists (added.pdb, modified.pdb and obsolete.pdb)
+config_defaults["http_wwpdb_status"] = "https://files.wwpdb.org/pub/pdb/data/status/latest/"
+
+# wwPDB mirrors of the structure files (biodownloader.mirrors): url templates
+# per file format, with {id}, {mid} (middle two characters of the PDB ID),
+# {assembly_id} and {http_pdbe}; .gz files are decompressed to the same
+# local filenames as the PDBe ones, so every mirror of a format must serve
+# the same file (e.g. the archive mmCIF, not the PDBe _updated.cif one)
+config_defaults["mirrors"] = {
+    "structures": {
+        "pdbe": {
+            "pdb": "{http_pdbe}entry-files/download/pdb{id}.ent",
+            "mmcif": "{http_pdbe}entry-files/download/{id}.cif",
+            "bio": "{http_pdbe}static/entry/download/{id}-assembly-{assembly_id}.cif.gz"},
+        "rcsb": {
+            "pdb": "https://files.rcsb.org/download/{id}.pdb",
+            "mmcif": "https://files.rcsb.org/download/{id}.cif",
+            "bio": "https://files.rcsb.org/download/{id}-assembly{assembly_id}.cif.gz"},
+        "pdbj": {
+            "pdb": "https://data.pdbj.org/pub/pdb/data/structures/divided/pdb/{mid}/pdb{id}.ent.gz",
+            "mmcif": "https://data.pdbj.org/pub/pdb/data/structures/divided/mmCIF/{mid}/{id}.cif.gz",
+            "bio": "https://data.pdbj.org/pub/pdb/data/biounit/mmCIF/divided/{mid}/{id}-assembly{assembly_id}.cif.gz"}}}
+# download structures from the fastest healthy mirror instead of the PDBe only
+config_defaults["structure_mirrors"] = False
+# measure the latency of the mirrors when first used
+config_defaults["mirror_probe"] = True
+# retries on a mirror before failing over to the next one
+config_defaults["mirror_retries"] = 1
+# consecutive failures before a mirror is skipped, and for how long (seconds)
+config_defaults["mirror_max_failures"] = 3
+config_defaults["mirror_cooldown"] = 300
+
+# recently seen IDs remembered when dropping duplicates (biodownloader.ids)
+config_defaults["ids_dedup_window"] = 100000
+
+# PDB IDs per PDBe summary request when resolving preferred assemblies
+config_defaults["pdbe_batch_size"] = 200
+# UniProt accessions per stream request in batch mode
+config_defaults["uniprot_batch_size"] = 100
+
+# API response cache (biodownloader.cache), stored in db_root/db_pickled
+config_defaults["cache_file"] = "biodownloader_cache.sqlite"
+# compressed size cap of the cache file (bytes)
+config_defaults["cache_max_size"] = 256 * 1024 * 1024
+# responses also kept in memory
+config_defaults["cache_memory_entries"] = 10000
+# time-to-live per endpoint (seconds)
+config_defaults["cache_ttl"] = {"default": 7 * 24 * 3600,
+                                "pdbe_summary": 30 * 24 * 3600}
+
+# keep the original .gz next to the decompressed file
+config_defaults["keep_compressed"] = False
+
+# codec the downloaded files are stored with (biodownloader.storage): plain
+# (decompressed), gzip (.gz, kept as received if served gzipped), zstd (.zst,
+# requires zstandard) or bgzf (.gz in blocks, for random access), and the
+# codec of particular sources, e.g. {"pdbe": "zstd", "uniprot": "bgzf"}
+config_defaults["storage_codec"] = "plain"
+config_defaults["storage_codecs"] = {}
+# compression level of gzip and bgzf, level and threads of zstd (-1 is one
+# thread per CPU)
+config_defaults["gzip_level"] = 6
+config_defaults["zstd_level"] = 3
+config_defaults["zstd_threads"] = -1
+
+# record ETag/Last-Modified/size of downloads in a per-directory manifest
+config_defaults["manifest"] = True
+# re-download existing files only if the server reports them as changed
+config_defaults["refresh"] = False
+
+# index of the downloaded files (biodownloader.index), checked instead of
+# the filesystem for files that are already available
+config_defaults["index"] = True
+# sqlite file of the index (defaults to db_root/.biodownloader-index.sqlite)
+config_defaults["index_file"] = None
+
+# PDB, SIFTS and UniProt files in shard subdirectories (biodownloader.layout),
+# e.g. pa/2pah.cif and P00/P00439.fasta
+config_defaults["sharded_layout"] = False
+
+# parallel byte-range downloads (1 disables them)
+config_defaults["range_connections"] = 4
+# only for files at least this large (bytes)
+config_defaults["range_min_size"] = 64 * 1024 * 1024
+
+# HTTP connection pools (biodownloader.session)
+# number of per-host pools kept alive
+config_defaults["http_pool_connections"] = 10
+# connections kept alive per host
+config_defaults["http_pool_maxsize"] = 10
+# block when a host pool is exhausted instead of opening extra connections
+config_defaults["http_pool_block"] = False
+# FTP connections kept open per thread
+config_defaults["ftp_max_connections"] = 4
+
+# timeouts (seconds) for connecting and between received bytes
+config_defaults["connect_timeout"] = 10
+config_defaults["read_timeout"] = 60
+
+# hedged API GETs (biodownloader.hedge, not file downloads): send a duplicate
+# request if there is no response after the given percentile of the host's
+# recent latencies
+config_defaults["hedge_requests"] = False
+config_defaults["hedge_percentile"] = 95
+# delay used until enough latencies are known (seconds)
+config_defaults["hedge_delay"] = 1.0
+config_defaults["hedge_min_samples"] = 20
+# shortest delay before a duplicate request (seconds)
+config_defaults["hedge_min_delay"] = 0.05
+# threads sending hedged requests, grown to two per request in progress
+config_defaults["hedge_workers"] = 32
+
+# retries (biodownloader.retry)
+# retries per request
+config_defaults["retry_max"] = 10
+# base of the exponential backoff (seconds)
+config_defaults["retry_backoff"] = 1
+# maximum wait between retries, including Retry-After (seconds)
+config_defaults["retry_backoff_cap"] = 60
+# retries shared by every request of a run
+config_defaults["retry_budget"] = 1000
+# HTTP status codes retried by Downloader
+config_defaults["retry_statuses"] = (429, 500, 502, 503, 504)
+
+# adaptive per-host concurrency (biodownloader.concurrency), capped by --jobs
+config_defaults["adaptive_concurrency"] = True
+# starting and lowest number of requests in flight per host
+config_defaults["concurrency_initial"] = 2
+config_defaults["concurrency_min"] = 1
+# factor applied to the limit when a host signals congestion
+config_defaults["concurrency_decrease"] = 0.5
+# slower responses (vs. the average latency) stop the limit from growing
+config_defaults["concurrency_latency_factor"] = 2.0
+# HTTP status codes treated as congestion
+config_defaults["concurrency_congestion_statuses"] = (429, 500, 503)
+
+# rate limits (biodownloader.ratelimit)
+# (requests per second, burst) per host, keyed on the config key of the
+# host, e.g. {"http_pdbe": (10, 20)}; hosts not listed are not limited
+config_defaults["rate_limits"] = {}
+# directory of lock files sharing the limits between processes
+config_defaults["rate_limit_dir"] = None
+
+# serve-cache read-through proxy (biodownloader.proxy): listening address,
+# cache directory (defaults to <db_root>/proxy-cache), size cap in bytes and
+# seconds before a cached response is revalidated upstream
+config_defaults["proxy_host"] = "127.0.0.1"
+config_defaults["proxy_port"] = 8008
+config_defaults["proxy_dir"] = None
+config_defaults["proxy_max_size"] = 50 * 1024 ** 3
+config_defaults["proxy_ttl"] = 24 * 3600
+
+# download daemon (biodownloader.daemon): HTTP address, or a unix socket
+# path used instead if set, and number of downloads run in parallel
+config_defaults["daemon_host"] = "127.0.0.1"
+config_defaults["daemon_port"] = 8009
+config_defaults["daemon_socket"] = None
+config_defaults["daemon_jobs"] = 8
+# seconds for the daemon to regain a spent retry budget
+config_defaults["daemon_retry_window"] = 3600
+
+# download metrics (biodownloader.metrics): Prometheus textfile written at
+# the end of a run, and JSON-lines file every request is appended to
+config_defaults["metrics_textfile"] = None
+config_defaults["metrics_events"] = None
+
+# asyncio connection pool (biodownloader.aio)
+config_defaults["aio_pool_size"] = 100
+config_defaults["aio_pool_size_per_host"] = 20
 
 
 class Config(object):
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import socket
+import logging
+import http.client
+import socketserver
+import json as jsonlib
+from functools import partial
+from urllib.parse import urlsplit, parse_qs
+from socketserver import ThreadingMixIn
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from biodownloader import retry, concurrency
+from biodownloader.config import config
+from biodownloader.engine import FILE_FORMATS, FORMAT_SOURCES, download_task
+from biodownloader.ids import normalise
+from biodownloader.singleflight import SingleFlight
+from biodownloader.metrics import get_metrics
+
+logger = logging.getLogger("biodownloader")
+
+
+class DownloadService(object):
+    def __init__(self, jobs=8, retry_policy=None):
+        """
+        Runs the download_* functions for a long-lived process, so sessions,
+        caches and the index stay warm between requests. Concurrent
+        requests for the same (format, id) share a single download.
+
+        Downloads use the service's own retry budget, regained over
+        config.daemon_retry_window, and per-host concurrency limits (if
+        config.adaptive_concurrency), so other runs in the same process
+        neither spend nor tear them down.
+
+        :param jobs: (int) downloads of a multi-file request run in parallel
+        :param retry_policy: RetryPolicy object (defaults to one with the
+            config.retry_* settings)
+        """
+
+        self.jobs = jobs
+        self.flights = SingleFlight()
+        self.retry_policy = retry_policy or retry.RetryPolicy(
+            window=config.daemon_retry_window)
+        self.limits = (concurrency.Limits(jobs)
+                       if config.adaptive_concurrency else None)
+        self._executor = ThreadPoolExecutor(max_workers=jobs)
+
+    def download(self, identifier, file_format, override=False):
+        """
+        Downloads a single (ID, format) pair, or waits for the download
+        already in progress. An override request joins a download in
+        progress too, as two transfers would write the same file.
+
+        :param identifier: (str) accession ID
+        :param file_format: (str) one of engine.FILE_FORMATS
+        :param override: (boolean)
+        :return: dict (id, format, ok, error, path)
+        """
+
+        identifier = next(normalise([identifier], [file_format]))
+        key = (FORMAT_SOURCES[file_format], identifier, file_format)
+        return self.flights.do(key, partial(self._download, identifier,
+                                            file_format, override))
+
+    def download_many(self, ids, file_formats, override=False):
+        """
+        Downloads every requested format for each ID, in parallel.
+
+        :return: list of dict (see download)
+        """
+
+        futures = [self._executor.submit(self.download, identifier,
+                                         file_format, override)
+                   for identifier in ids for file_format in file_formats]
+        return [future.result() for future in futures]
+
+    def _download(self, identifier, file_format, override=False):
+        result = {"id": identifier, "format": file_format, "ok": False,
+                  "error": None, "path": None}
+        try:
+            with retry.scope(self.retry_policy), \
+                    concurrency.scope(self.limits):
+                downloader = download_task(identifier, file_format,
+                                           override=override)
+        except Exception as e:
+            result["error"] = str(e)
+            return result
+        error = getattr(downloader, "error", None)
+        result["ok"] = error is None
+        result["error"] = None if error is None else str(error)
+        result["path"] = os.path.abspath(downloader.outputfile)
+        return result
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug("%s - " + format, self.address_string(), *args)
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def _json(self, status, data):
+        content = jsonlib.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        if parts.path == "/health":
+            return self._json(200, {"ok": True,
+                                    "in_flight": len(self.server.service.flights)})
+        elif parts.path == "/metrics":
+            content = get_metrics().textfile().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        elif parts.path == "/download":
+            override = query.get("override", ["false"])[0].lower()
+            return self._download(query.get("id", []), query.get("format", []),
+                                  override in ("1", "true", "yes"))
+        self._json(404, {"error": "Unknown path {}".format(parts.path)})
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            data = jsonlib.loads(self.rfile.read(length).decode("utf-8") or "{}")
+        except ValueError as e:
+            return self._json(400, {"error": "Invalid JSON: {}".format(e)})
+        if parts.path != "/download":
+            return self._json(404, {"error": "Unknown path {}".format(parts.path)})
+        # a single "id" and "format", or lists of "ids" and "formats"
+        ids = list(data.get("ids", []))
+        if "id" in data:
+            ids.append(data["id"])
+        file_formats = list(data.get("formats", []))
+        if "format" in data:
+            file_formats.append(data["format"])
+        self._download(ids, file_formats, bool(data.get("override", False)))
+
+    def _download(self, ids, file_formats, override=False):
+        if not ids or not file_formats:
+            return self._json(400, {"error": "Expected one or more IDs and "
+                                             "file formats..."})
+        unknown = [f for f in file_formats if f not in FILE_FORMATS]
+        if unknown:
+            return self._json(400, {"error": "File format {} is not currently "
+                                             "implemented...".format(unknown[0])})
+        results = self.server.service.download_many(ids, file_formats,
+                                                    override=override)
+        if config.metrics_textfile:
+            get_metrics().write_textfile(config.metrics_textfile)
+        self._json(200, {"results": results})
+
+
+class DaemonServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        """
+        Threaded HTTP server of a DownloadService, on a TCP address or a
+        unix socket.
+
+        :param address: tuple (host, port) or (str) unix socket path
+        :param service: DownloadService object
+        """
+
+        if isinstance(address, str):
+            self.address_family = socket.AF_UNIX
+        HTTPServer.__init__(self, address, DaemonHandler)
+        self.service = service
+
+    def server_bind(self):
+        if self.address_family != socket.AF_UNIX:
+            return HTTPServer.server_bind(self)
+        if os.path.exists(self.server_address):
+            # left behind by a daemon that did not shut down
+            os.remove(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = "localhost", 0
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        if self.address_family == socket.AF_UNIX and \
+                os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def _address(host=None, port=None, path=None):
+    if path is not None or (host is None and port is None and
+                            config.daemon_socket is not None):
+        return path or config.daemon_socket
+    return (host or config.daemon_host,
+            config.daemon_port if port is None else port)
+
+
+def make_server(host=None, port=None, path=None, jobs=None):
+    """
+    Builds a download daemon, not yet serving.
+
+    :param host: (str) address to listen on (defaults to config.daemon_host)
+    :param port: (int) port (defaults to config.daemon_port, 0 picks one)
+    :param path: (str) unix socket path, used instead of host and port
+        (defaults to config.daemon_socket)
+    :param jobs: (int) parallel downloads per request (defaults to
+        config.daemon_jobs)
+    :return: DaemonServer object
+    """
+
+    service = DownloadService(jobs=jobs or config.daemon_jobs)
+    return DaemonServer(_address(host, port, path), service)
+
+
+def serve(host=None, port=None, path=None, jobs=None):
+    """
+    Runs a download daemon until interrupted (see make_server).
+
+    :return: (side effects)
+    """
+
+    server = make_server(host=host, port=port, path=path, jobs=jobs)
+    logger.info("Serving downloads on %s ...", server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        http.client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def submit(ids, file_formats, override=False, address=None):
+    """
+    Asks a running daemon to download every requested format for each ID,
+    and waits for the results.
+
+    :param ids: iterable of accession IDs
+    :param file_formats: iterable of file formats
+    :param override: (boolean)
+    :param address: (str) http://host:port or a unix socket path (defaults
+        to config.daemon_socket, or config.daemon_host and daemon_port)
+    :return: list of dict (id, format, ok, error, path)
+    """
+
+    if address is None:
+        address = _address()
+        if not isinstance(address, str):
+            address = "http://{}:{}".format(*address)
+    if address.startswith("http://"):
+        parts = urlsplit(address)
+        connection = http.client.HTTPConnection(parts.hostname, parts.port)
+    else:
+        connection = _UnixConnection(address)
+    body = jsonlib.dumps({"ids": list(ids), "formats": list(file_formats),
+                          "override": override})
+    try:
+        connection.request("POST", "/download", body=body,
+                           headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        data = jsonlib.loads(response.read().decode("utf-8"))
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise ValueError(data.get("error", response.reason))
+    return data["results"]
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+from functools import partial
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger("biodownloader")
+
+# file formats in the order they are downloaded for each ID
+FILE_FORMATS = ("pdb", "mmcif", "bio", "sifts", "fasta",
+                "gff", "txt", "cath", "pfam")
+# formats that can be fetched in batches
+UNIPROT_FORMATS = ("fasta", "gff", "txt")
+# source (data provider) of each format, as recorded in the index
+FORMAT_SOURCES = {"pdb": "pdbe", "mmcif": "pdbe", "bio": "pdbe",
+                  "sifts": "sifts", "fasta": "uniprot", "gff": "uniprot",
+                  "txt": "uniprot", "cath": "cath", "pfam": "pfam"}
+
+DownloadResult = namedtuple("DownloadResult",
+                            ["identifier", "file_format", "ok", "error"])
+# files downloaded and failed, see tally
+DownloadTally = namedtuple("DownloadTally", ["done", "failed"])
+
+
+def download_task(identifier, file_format, override=False):
+    """
+    Downloads a single (ID, format) pair with the matching download_* function.
+
+    :param identifier: (str) accession ID
+    :param file_format: (str) one of FILE_FORMATS
+    :param override: (boolean)
+    :return: Downloader object
+    """
+
+    from biodownloader import fetchers
+
+    if file_format == "pdb":
+        return fetchers.download_structure_from_pdbe(identifier, pdb=True,
+                                                     override=override)
+    elif file_format == "mmcif":
+        return fetchers.download_structure_from_pdbe(identifier, pdb=False,
+                                                     bio=False, override=override)
+    elif file_format == "bio":
+        return fetchers.download_structure_from_pdbe(identifier, pdb=False,
+                                                     bio=True, override=override)
+    elif file_format == "sifts":
+        return fetchers.download_sifts_from_ebi(identifier, override=override)
+    elif file_format in ("fasta", "gff", "txt"):
+        return fetchers.download_data_from_uniprot(identifier,
+                                                   file_format=file_format,
+                                                   override=override)
+    elif file_format == "cath":
+        return fetchers.download_alignment_from_cath(identifier,
+                                                     max_sequences=20000,
+                                                     override=override)
+    elif file_format == "pfam":
+        return fetchers.download_alignment_from_pfam(identifier,
+                                                     override=override)
+    else:
+        raise ValueError("File format {} is not currently implemented..."
+                         "".format(file_format))
+
+
+def generate_tasks(ids, file_formats):
+    """
+    Generates (ID, format) pairs lazily, keeping the per-ID format order.
+
+    :param ids: iterable of accession IDs
+    :param file_formats: iterable of file formats
+    :return: generator of tuples
+    """
+
+    file_formats = [f for f in FILE_FORMATS if f in file_formats]
+    for identifier in ids:
+        for file_format in file_formats:
+            yield identifier, file_format
+
+
+def resolve_assemblies(ids, batch_size=None):
+    """
+    Passes IDs through unchanged, resolving the preferred assemblies of each
+    batch of IDs with one PDBe request before they are yielded, so bio
+    downloads are driven from the memoized table.
+
+    :param ids: iterable of PDB IDs
+    :param batch_size: (int) IDs per request (defaults to
+        config.pdbe_batch_size)
+    :return: generator of PDB IDs
+    """
+
+    from biodownloader.config import config
+    from biodownloader.fetchers import get_preferred_assembly_ids
+
+    if batch_size is None:
+        batch_size = config.pdbe_batch_size
+
+    batch = []
+    for identifier in ids:
+        batch.append(identifier)
+        if len(batch) >= batch_size:
+            get_preferred_assembly_ids(batch, batch_size=batch_size)
+            for i in batch:
+                yield i
+            batch = []
+    if batch:
+        get_preferred_assembly_ids(batch, batch_size=batch_size)
+        for i in batch:
+            yield i
+
+
+def _run_task(identifier, file_format, override=False):
+    try:
+        downloader = download_task(identifier, file_format, override=override)
+    except Exception as e:
+        return [DownloadResult(identifier, file_format, False, e)]
+    error = getattr(downloader, "error", None)
+    return [DownloadResult(identifier, file_format, error is None, error)]
+
+
+def _run_batch(identifiers, file_format, override=False):
+    from biodownloader.fetchers import download_data_from_uniprot_batch
+
+    try:
+        missing = download_data_from_uniprot_batch(identifiers,
+                                                   file_format=file_format,
+                                                   override=override)
+    except Exception as e:
+        return [DownloadResult(i, file_format, False, e) for i in identifiers]
+    missing = set(missing)
+    return [DownloadResult(i, file_format, i not in missing,
+                           LookupError("Not returned by UniProt")
+                           if i in missing else None)
+            for i in identifiers]
+
+
+def _generate_jobs(ids, file_formats, override=False, batch=False):
+    """
+    Generates the callables run by the worker pool, each returning a list
+    of DownloadResult. In batch mode, UniProt formats are grouped into
+    batches of config.uniprot_batch_size IDs.
+    """
+
+    from biodownloader.config import config
+
+    batched = []
+    if batch:
+        batched = [f for f in FILE_FORMATS
+                   if f in file_formats and f in UNIPROT_FORMATS]
+    single = [f for f in FILE_FORMATS if f in file_formats and f not in batched]
+
+    pending = []
+    for identifier in ids:
+        for file_format in single:
+            yield partial(_run_task, identifier, file_format, override=override)
+        if batched:
+            pending.append(identifier)
+            if len(pending) >= config.uniprot_batch_size:
+                for file_format in batched:
+                    yield partial(_run_batch, pending, file_format,
+                                  override=override)
+                pending = []
+    for file_format in batched if pending else ():
+        yield partial(_run_batch, pending, file_format, override=override)
+
+
+def _report(results):
+    for result in results:
+        if result.ok:
+            logger.debug("Done %s (%s)", result.identifier, result.file_format)
+        else:
+            logger.warning("Failed %s (%s): %s", result.identifier,
+                           result.file_format, result.error)
+
+
+def generate_results(ids, file_formats, jobs=1, override=False, batch=False):
+    """
+    Downloads every (ID, format) pair through a bounded pool of worker
+    threads, yielding the results as they complete.
+
+    IDs are consumed lazily and at most 2 * jobs tasks are in flight at any
+    time, so `ids` can be a generator, and nothing is kept once a result has
+    been yielded. The on-disk layout is the same as calling the download_*
+    functions one by one. For bio downloads, the preferred assemblies are
+    resolved in batches (see resolve_assemblies). With
+    config.adaptive_concurrency, the requests in flight to each host are
+    further limited by biodownloader.concurrency, up to jobs.
+
+    :param ids: iterable of accession IDs
+    :param file_formats: iterable of file formats (see FILE_FORMATS)
+    :param jobs: (int) number of worker threads
+    :param override: (boolean)
+    :param batch: (boolean) fetches UniProt formats with one request per
+        batch of IDs (see fetchers.download_data_from_uniprot_batch)
+    :return: generator of DownloadResult in completion order
+    """
+
+    if jobs < 1:
+        raise ValueError("Expected a positive number of jobs but got {}..."
+                         "".format(jobs))
+
+    done = failed = 0
+    if "bio" in file_formats:
+        ids = resolve_assemblies(ids)
+    tasks = _generate_jobs(ids, file_formats, override=override, batch=batch)
+    if jobs == 1:
+        completed = (task() for task in tasks)
+    else:
+        completed = _run_pool(tasks, jobs)
+    for results in completed:
+        _report(results)
+        for result in results:
+            if result.ok:
+                done += 1
+            else:
+                failed += 1
+            yield result
+
+    logger.info("Downloaded %s of %s files (%s failed)...",
+                done, done + failed, failed)
+
+
+def _run_pool(tasks, jobs):
+    # results of each task as it completes
+    from biodownloader import concurrency
+    from biodownloader.config import config
+
+    if config.adaptive_concurrency:
+        # jobs is the ceiling, each host gets what it can sustain
+        concurrency.enable(jobs)
+    pending = set()
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for task in tasks:
+                if len(pending) >= 2 * jobs:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                pending.add(executor.submit(task))
+            for future in pending:
+                yield future.result()
+    finally:
+        concurrency.disable()
+
+
+def tally(results):
+    """
+    Counts the results of generate_results as they are consumed, without
+    keeping them.
+
+    :param results: iterable of DownloadResult
+    :return: DownloadTally
+    """
+
+    done = failed = 0
+    for result in results:
+        if result.ok:
+            done += 1
+        else:
+            failed += 1
+    return DownloadTally(done, failed)
+
+
+def download_files(ids, file_formats, jobs=1, override=False, batch=False):
+    """
+    Downloads every (ID, format) pair, see generate_results. Every result is
+    kept, so long inputs (e.g. from --ids-from) are better consumed with
+    generate_results.
+
+    :param ids: iterable of accession IDs
+    :param file_formats: iterable of file formats (see FILE_FORMATS)
+    :param jobs: (int) number of worker threads
+    :param override: (boolean)
+    :param batch: (boolean) fetches UniProt formats with one request per
+        batch of IDs (see fetchers.download_data_from_uniprot_batch)
+    :return: list of DownloadResult in completion order
+    """
+
+    if jobs < 1:
+        raise ValueError("Expected a positive number of jobs but got {}..."
+                         "".format(jobs))
+    return list(generate_results(ids, file_formats, jobs=jobs,
+                                 override=override, batch=batch))
@@ -22,22 +22,57 @@
 
 import os
 import time
-import gzip
-import pickle
+import zlib
 import shutil
 import logging
+import threading
 import requests
+import json as jsonlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from biodownloader.config import config
+from biodownloader.session import get_session, get_ftp_opener
+from biodownloader.manifest import get_manifest, close_manifest
+from biodownloader.cache import get_cache, CachedResponse
+from biodownloader.retry import get_retry_policy
+from biodownloader.ratelimit import throttle
+from biodownloader.concurrency import slot as concurrency_slot
+from biodownloader.hedge import hedged_get
+from biodownloader.mirrors import get_mirror_registry
+from biodownloader.index import get_index
+from biodownloader.layout import local_path
+from biodownloader.metrics import get_metrics, Trace
+from biodownloader.storage import (storage_codec, stored_path, stored_variant,
+                                   storage_writer, variants)
 
 logger = logging.getLogger("biodownloader")
 
+CHUNK_SIZE = 64 * 1024
+PARTIAL_SUFFIX = ".part"
+
+
+def _timeout():
+    return config.connect_timeout, config.read_timeout
+
+
+def _get(url, hedge=True, **kwargs):
+    # small GETs are idempotent and cheap to send twice, so they can be
+    # hedged (see biodownloader.hedge); streamed file downloads are not,
+    # as a duplicate would double the bandwidth of a slow transfer
+    if config.hedge_requests and hedge:
+        return hedged_get(url, timeout=_timeout(), **kwargs)
+    return get_session().get(url, timeout=_timeout(), **kwargs)
+
 
 def fetch_from_url_or_retry(url, json=True, header=None, post=False, data=None,
-                            retry_in=None, wait=1, n_retries=10, stream=False, **params):
+                            retry_in=None, wait=None, n_retries=None, stream=False,
+                            **params):
     """
     Fetch an url using Requests or retry fetching it if the server is
-    complaining with retry_in error. There is a limit to the number of retries.
+    complaining with retry_in error, or the connection failed with a
+    transient network error. Retries follow the shared RetryPolicy
+    (exponential backoff with jitter, Retry-After and a retry budget).
 
     Retry code examples: 429, 500 and 503
 
@@ -47,8 +82,8 @@ def fetch_from_url_or_retry(url, json=True, header=None, post=False, data=None,
     :param post: boolean
     :param data: dictionary: only if post is True
     :param retry_in: http codes for retrying
-    :param wait: sleeping between tries in seconds
-    :param n_retries: number of retry attempts
+    :param wait: base of the backoff in seconds (config.retry_backoff)
+    :param n_retries: number of retry attempts (config.retry_max)
     :param stream: boolean
     :param params: request.get kwargs.
     :return: url content
@@ -70,56 +105,97 @@ def fetch_from_url_or_retry(url, json=True, header=None, post=False, data=None,
         if "Content-Type" not in header:
             header.update({"Content-Type": "text/plain"})
 
-    logger.info("Querying %s ...", url)
     if post:
-        if data is not None:
-            assert type(data) is dict or type(data) is str
-            response = requests.post(url, headers=header, data=data)
-        else:
+        if data is None:
             return None
-    else:
-        response = requests.get(url, headers=header, params=params, stream=stream)
-
-    if response.ok:
-        return response
-    elif response.status_code in retry_in and n_retries >= 0:
-        time.sleep(wait)
-        return fetch_from_url_or_retry(url, json, header, post, data, retry_in, wait,
-                                       (n_retries - 1), stream, **params)
-    else:
+        assert type(data) is dict or type(data) is str
+
+    policy = get_retry_policy()
+    attempt = 0
+    while True:
+        logger.info("Querying %s ...", url)
+        trace = Trace()
         try:
-            response.raise_for_status()
-        except requests.exceptions.HTTPError as e:
-            logger.debug('%s: Unable to retrieve %s for %s',
-                         response.status_code, url, e)
+            with concurrency_slot(url) as slot:
+                throttle(url)
+                if post:
+                    response = get_session().post(url, headers=header, data=data,
+                                                  timeout=_timeout())
+                else:
+                    response = _get(url, headers=header, params=params,
+                                    stream=stream, hedge=not stream)
+                slot.responded(response.status_code)
+            trace.responded(response.status_code, response.headers,
+                            elapsed=response.elapsed.total_seconds())
+            trace.finished(size=0 if stream else len(response.content))
+        except requests.exceptions.RequestException as e:
+            delay = policy.next_delay(attempt, error=e, max_retries=n_retries,
+                                      backoff=wait)
+            if delay is None:
+                get_metrics().record("request", url, trace=trace, ok=False,
+                                     retries=attempt, error=e)
+                raise
+        else:
+            if response.ok:
+                get_metrics().record("request", url, trace=trace,
+                                     retries=attempt)
+                return response
+            delay = policy.next_delay(attempt, status_code=response.status_code,
+                                      headers=response.headers,
+                                      retry_in=retry_in, max_retries=n_retries,
+                                      backoff=wait)
+            if delay is None:
+                try:
+                    response.raise_for_status()
+                except requests.exceptions.HTTPError as e:
+                    logger.debug('%s: Unable to retrieve %s for %s',
+                                 response.status_code, url, e)
+                    get_metrics().record("request", url, trace=trace, ok=False,
+                                         retries=attempt, error=e)
+                return None
+            response.close()
+        attempt += 1
+        logger.debug("Retrying %s in %.2f seconds...", url, delay)
+        time.sleep(delay)
 
 
 class Fetcher(object):
-    def __init__(self, url, cached=False, cache_output=None, **kwargs):
+    def __init__(self, url, cached=False, cache_output=None,
+                 cache_endpoint="default", **kwargs):
         """
         :param url: (str) Full web-address
-        :param cached: (boolean) if True, stores a pickle file locally
-        :param cache_output: (str) file name if 'cached=True'
+        :param cached: (boolean) if True, stores the response payload in the
+            local cache (see biodownloader.cache)
+        :param cache_output: (str) cache key if 'cached=True'
+        :param cache_endpoint: (str) config.cache_ttl key setting how long
+            the cached payload is kept
         """
 
         self.url = url
         self.cached = cached
         self.cache_output = cache_output
-        self.pickled = os.path.join(config.db_root, config.db_pickled,
-                                    self.cache_output)
+        self.cache_endpoint = cache_endpoint
         self.kwargs = kwargs
         self.response = None
         self._fetch()
 
     def _fetch(self):
 
-        if self.cached and os.path.isfile(self.pickled):
-            self.response = pickle.load(open(self.pickled, 'rb'))
+        if self.cached:
+            cache = get_cache()
+            self.response = cache.get(self.cache_output)
+            get_metrics().cache(self.url, "miss" if self.response is None
+                                else "hit")
+            if self.response is None:
+                response = fetch_from_url_or_retry(self.url, **self.kwargs)
+                if response is not None and response.ok:
+                    self.response = CachedResponse.from_response(response)
+                    cache.set(self.cache_output, self.response,
+                              endpoint=self.cache_endpoint)
+                else:
+                    self.response = response
         else:
             self.response = fetch_from_url_or_retry(self.url, **self.kwargs)
-            if self.cached:
-                with open(self.pickled, 'wb') as output:
-                    pickle.dump(self.response, output, -1)
         return self.response
 
 
@@ -128,7 +204,7 @@ def fetch_summary_properties_pdbe(identifier, cached=False, retry_in=(429,)):
     Queries the PDBe API to get summary properties.
 
     :param identifier: PDB ID
-    :param cached: (boolean) if True, stores a json file locally
+    :param cached: (boolean) if True, caches the json payload locally
     :param retry_in: http code for retrying connections
     :return: response object
     """
@@ -137,51 +213,445 @@ def fetch_summary_properties_pdbe(identifier, cached=False, retry_in=(429,)):
     url_enpoint = "api/pdb/entry/summary/"
     url = url_root + url_enpoint + identifier
     b = Fetcher(url=url, cached=cached,
-                cache_output="{}_sp.pkl".format(identifier),
-                json=True, retry_in=retry_in)
+                cache_output="{}_sp".format(identifier),
+                cache_endpoint="pdbe_summary", json=True, retry_in=retry_in)
     return b.response
 
 
-def get_preferred_assembly_id(identifier):
+def fetch_summary_properties_pdbe_batch(identifiers, retry_in=(429,)):
+    """
+    Queries the PDBe API to get summary properties for many entries at once,
+    POSTing the comma-separated PDB IDs.
+
+    :param identifiers: list of PDB IDs
+    :param retry_in: http code for retrying connections
+    :return: response object
+    """
+
+    url_root = config.http_pdbe
+    url_enpoint = "api/pdb/entry/summary/"
+    url = url_root + url_enpoint
+    return fetch_from_url_or_retry(url, json=False, post=True,
+                                   data=",".join(identifiers),
+                                   retry_in=retry_in)
+
+
+# preferred assemblies resolved so far in this run
+_preferred_assemblies = {}
+_preferred_assemblies_lock = threading.Lock()
+
+
+def _preferred_assembly(entries):
+    """
+    Picks the preferred assembly out of the summary entries of a PDB ID.
+
+    :param entries: list of summary dictionaries (PDBe API)
+    :return: (str)
+    """
+
+    nassemblies = entries[0]["assemblies"]
+    pref_assembly = "1"
+    if len(nassemblies) > 1:
+        for entry in nassemblies:
+            if entry["preferred"]:
+                pref_assembly = entry["assembly_id"]
+                break
+    else:
+        pref_assembly = nassemblies[0]["assembly_id"]
+    return str(pref_assembly)
+
+
+def get_preferred_assembly_id(identifier, cached=False):
     """
     Gets the preferred assembly id for the given PDB ID, from the PDBe API.
+    Results are memoized for the whole run (see get_preferred_assembly_ids).
 
     :param identifier: PDB ID
+    :param cached: (boolean) if True, caches the summary payload locally
     :return: (str)
     """
 
+    pref_assembly = _memoized_assembly(identifier)
+    if pref_assembly is not None:
+        return pref_assembly
+
     # getting the preferred biological assembly from the PDBe API
-    pref_assembly = "1"
+    data = None
     try:
-        data = fetch_summary_properties_pdbe(identifier)
+        data = fetch_summary_properties_pdbe(identifier, cached=cached)
     except Exception as e:
         logger.critical("Something went wrong for %s... %s", identifier, e)
+    return _assembly_from_summary(identifier, data)
+
+
+def _memoized_assembly(identifier):
+    with _preferred_assemblies_lock:
+        return _preferred_assemblies.get(identifier.lower())
+
+
+def _assembly_from_summary(identifier, response):
+    """
+    Picks the preferred assembly of a PDB ID out of its summary response,
+    and memoizes it for the whole run (shared with biodownloader.aio).
+
+    :param identifier: PDB ID
+    :param response: summary response (see fetch_summary_properties_pdbe),
+        or None if the request failed
+    :return: (str) "1" if the response does not say
+    """
+
+    if response is None:
+        return "1"
     try:
-        if data is not None:
-            data = data.json()
-            nassemblies = data[identifier][0]["assemblies"]
-            if len(nassemblies) > 1:
-                for entry in nassemblies:
-                    if entry["preferred"]:
-                        pref_assembly = entry["assembly_id"]
-                        break
-            else:
-                pref_assembly = data[identifier][0]["assemblies"][0]["assembly_id"]
+        pref_assembly = _preferred_assembly(response.json()[identifier])
     except Exception as e:
-        pref_assembly = "1"
         logger.critical("Something went wrong for %s... %s", identifier, e)
+        return "1"
+    with _preferred_assemblies_lock:
+        _preferred_assemblies[identifier.lower()] = pref_assembly
+    return pref_assembly
+
+
+def get_preferred_assembly_ids(identifiers, batch_size=None, cached=False):
+    """
+    Gets the preferred assembly ids for many PDB IDs, from the PDBe API,
+    with one request per batch of IDs. Results are memoized for the whole
+    run, so get_preferred_assembly_id (and thus bio downloads) use them
+    without further requests. Entries the API does not know default to "1".
+
+    :param identifiers: iterable of PDB IDs
+    :param batch_size: (int) IDs per request (defaults to
+        config.pdbe_batch_size)
+    :param cached: (boolean) if True, caches each summary payload locally
+    :return: (dict) PDB ID -> assembly id (str)
+    """
+
+    if batch_size is None:
+        batch_size = config.pdbe_batch_size
+
+    identifiers = list(identifiers)
+    with _preferred_assemblies_lock:
+        missing = [i for i in identifiers
+                   if i.lower() not in _preferred_assemblies]
+    missing = list(OrderedDict.fromkeys(i.lower() for i in missing))
+
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        try:
+            response = fetch_summary_properties_pdbe_batch(batch)
+            if response is None:
+                continue
+            data = response.json()
+        except Exception as e:
+            logger.critical("Something went wrong for %s... %s",
+                            ",".join(batch), e)
+            continue
+        resolved = {}
+        for identifier in batch:
+            try:
+                resolved[identifier] = _preferred_assembly(data[identifier])
+            except Exception:
+                resolved[identifier] = "1"
+            if cached and identifier in data:
+                get_cache().set("{}_sp".format(identifier), CachedResponse(
+                    config.http_pdbe + "api/pdb/entry/summary/" + identifier,
+                    200, {"Content-Type": "application/json"},
+                    jsonlib.dumps({identifier: data[identifier]}).encode()),
+                    endpoint="pdbe_summary")
+        with _preferred_assemblies_lock:
+            _preferred_assemblies.update(resolved)
+        logger.info("Resolved preferred assemblies for %s entries...",
+                    len(batch))
+
+    with _preferred_assemblies_lock:
+        return {i: _preferred_assemblies.get(i.lower(), "1")
+                for i in identifiers}
+
+
+class GunzipWriter(object):
+    def __init__(self, outfile):
+        """
+        File-like object that gunzips whatever is written to it into outfile.
+
+        Output is produced in CHUNK_SIZE pieces, so memory use is bounded
+        however well the payload compresses. Concatenated gzip members are
+        supported, as in the gzip module.
+
+        :param outfile: binary file object for the decompressed data
+        """
+
+        self.outfile = outfile
+        self.seconds = 0.0
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._started = False
+
+    def write(self, data):
+        started = time.perf_counter()
+        try:
+            self._write(data)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+    def _write(self, data):
+        while True:
+            chunk = self._decompressor.decompress(data, CHUNK_SIZE)
+            if chunk:
+                self._started = True
+                self.outfile.write(chunk)
+            if self._decompressor.eof:
+                # next gzip member, ignoring trailing zero padding
+                data = self._decompressor.unused_data.lstrip(b"\x00")
+                if not data:
+                    break
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                data = self._decompressor.unconsumed_tail
+                if not data and len(chunk) < CHUNK_SIZE:
+                    break
+
+    def close(self):
+        if not self._decompressor.eof and (self._started or
+                                           self._decompressor.unconsumed_tail):
+            raise EOFError("Compressed file ended before the "
+                           "end-of-stream marker was reached")
+
+
+class _OutputStream(object):
+    def __init__(self, outputfile=None, decompressed=None, offset=0,
+                 gunzip=True, codec="plain"):
+        """
+        Writes a download to its destination(s) as it arrives.
+
+        Data goes to '<filename>.part' files that are atomically renamed to
+        their final names once the transfer is complete. If the transfer
+        fails, the .part file holding the bytes as received is kept so the
+        download can be resumed; everything else is removed.
+
+        :param outputfile: (str) filename for the bytes as received
+        :param decompressed: (str) filename for the gunzipped bytes, stored
+            with the codec
+        :param offset: (int) bytes already in the outputfile .part file
+            (appended to, and replayed into the decompressed file)
+        :param gunzip: (boolean) False if the bytes received are not gzipped
+        :param codec: (str) storage codec of the decompressed file
+            (see biodownloader.storage)
+        """
+
+        self.filenames = [f for f in (outputfile, decompressed) if f]
+        self.outputfile = outputfile
+        self.size = 0
+        self._files = []
+        self._writers = []
+        self._encoders = []
+        if decompressed:
+            plain = open(decompressed + PARTIAL_SUFFIX, 'wb')
+            self._files.append(plain)
+            try:
+                writer = storage_writer(codec, plain)
+            except Exception:
+                # e.g. zstd without the zstandard package
+                plain.close()
+                os.remove(decompressed + PARTIAL_SUFFIX)
+                raise
+            if writer is None:
+                writer = plain
+            else:
+                self._encoders.append(writer)
+            self._writers.append(GunzipWriter(writer) if gunzip else writer)
+        if outputfile:
+            if offset and self._writers:
+                try:
+                    with open(outputfile + PARTIAL_SUFFIX, 'rb') as partial:
+                        for chunk in iter(lambda: partial.read(CHUNK_SIZE), b""):
+                            self._writers[0].write(chunk)
+                except zlib.error:
+                    self._files[0].close()
+                    os.remove(decompressed + PARTIAL_SUFFIX)
+                    os.remove(outputfile + PARTIAL_SUFFIX)
+                    raise
+            raw = open(outputfile + PARTIAL_SUFFIX, 'ab' if offset else 'wb')
+            raw.truncate(offset)
+            self._files.append(raw)
+            self._writers.append(raw)
+
+    def write(self, data):
+        self.size += len(data)
+        for writer in self._writers:
+            writer.write(data)
+
+    @property
+    def decompress_seconds(self):
+        """
+        Time spent gunzipping, or None if the data is stored as received.
+        """
+
+        gunzip = [w for w in self._writers if isinstance(w, GunzipWriter)]
+        return gunzip[0].seconds if gunzip else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        failed = exc_type is not None
+        corrupted = exc_type is not None and issubclass(exc_type, (EOFError,
+                                                                   zlib.error))
+        try:
+            if not failed:
+                for writer in self._writers:
+                    if isinstance(writer, GunzipWriter):
+                        writer.close()
+                for encoder in self._encoders:
+                    encoder.close()
+        except Exception:
+            failed = corrupted = True
+            raise
+        finally:
+            for f in self._files:
+                f.close()
+            for filename in self.filenames:
+                partial = filename + PARTIAL_SUFFIX
+                if not failed:
+                    os.replace(partial, filename)
+                elif (corrupted or filename != self.outputfile) and \
+                        os.path.exists(partial):
+                    os.remove(partial)
+
+
+_directories = set()
+
+
+def _makedirs(directory):
+    # once per directory, rather than one mkdir call per file
+    if directory not in _directories:
+        os.makedirs(directory, exist_ok=True)
+        _directories.add(directory)
+
+
+def _open_partial(opener, filename):
+    """
+    Opens the .part file(s) of a download, making its directory again if
+    it was removed after _makedirs saw it (e.g. an emptied shard directory
+    deleted while the daemon runs).
+
+    :param opener: callable opening the file(s)
+    :param filename: (str) a filename in the directory
+    :return: what opener returns
+    """
+
+    try:
+        return opener()
+    except FileNotFoundError:
+        directory = os.path.dirname(filename)
+        if not directory:
+            raise
+        logger.debug("%s was removed, making it again...", directory)
+        _directories.discard(directory)
+        # its manifest went with it
+        close_manifest(directory)
+        _makedirs(directory)
+        return opener()
+
+
+def _available(outputfile, artefact=None):
+    """
+    Checks whether a file is already available, stored with any codec, from
+    the index if it knows the artefact, otherwise from the filesystem (and
+    then indexes it). Files the index knows are still checked for, as they
+    may have been removed behind its back.
+
+    :param outputfile: (str) Output filename
+    :param artefact: tuple (source, id, format) or None
+    :return: (boolean)
+    """
+
+    if artefact is not None and config.index:
+        index = get_index()
+        entry = index.get(*artefact)
+        if entry is not None and entry["path"] in [os.path.abspath(p)
+                                                   for p in variants(outputfile)]:
+            if entry["status"] != "ok":
+                return False
+            if os.path.exists(entry["path"]):
+                return True
+            logger.debug("%s was removed, dropping it from the index...",
+                         entry["path"])
+            index.remove(*artefact)
+        elif entry is None and index.complete:
+            return False
+        path = stored_variant(outputfile)
+        if path is not None:
+            _record_artefact(path, artefact)
+        return path is not None
+    return stored_variant(outputfile) is not None
+
+
+def _remove_variants(outputfile, keep=()):
+    """
+    Removes the copies of a file stored with other codecs (e.g. before the
+    storage codec was changed), so an override replaces every variant.
 
-    bio_best = str(pref_assembly)
-    return bio_best
+    :param outputfile: (str) Output filename
+    :param keep: filenames that were just written
+    :return: (side effects)
+    """
+
+    for path in variants(outputfile):
+        if path not in keep and os.path.exists(path):
+            os.remove(path)
+            if config.manifest:
+                get_manifest(os.path.dirname(path) or ".").remove(
+                    os.path.basename(path))
+            logger.info("Removed %s, replaced by %s...", path,
+                        ", ".join(keep))
+
+
+def _record_artefact(outputfile, artefact, failed=False):
+    """
+    Records a downloaded (or failed) file in the index.
+
+    :param outputfile: (str) Output filename
+    :param artefact: tuple (source, id, format)
+    :param failed: (boolean) the download failed
+    :return: (side effects)
+    """
+
+    if not config.index:
+        return
+    index = get_index()
+    path = os.path.abspath(outputfile)
+    try:
+        stat = os.stat(outputfile)
+    except OSError:
+        index.update(*artefact, path=path, status="failed")
+    else:
+        if failed:
+            # e.g. a refresh that failed, the previous file is still there
+            return
+        index.update(*artefact, path=path, size=stat.st_size,
+                     mtime=stat.st_mtime)
 
 
 class Downloader(object):
-    def __init__(self, url, outputfile, decompress=True, override=False):
+    def __init__(self, url, outputfile, decompress=True, override=False,
+                 keep_compressed=None, refresh=None, max_retries=None,
+                 artefact=None, storage=None):
         """
         :param url: (str) Full web-address
         :param outputfile: (str) Output filename
-        :param decompress: (boolean) Decompresses the file
+        :param decompress: (boolean) Decompresses the file (otherwise it is
+            stored as received)
         :param override: (boolean) Overrides any existing file, if available
+        :param keep_compressed: (boolean) Keeps the .gz file next to the
+            decompressed one (defaults to config.keep_compressed)
+        :param refresh: (boolean) Re-downloads an existing file only if the
+            server reports it changed (defaults to config.refresh)
+        :param max_retries: (int) retries of a failed download (defaults to
+            config.retry_max)
+        :param artefact: tuple (source, id, format) the file is recorded as
+            in the index (see biodownloader.index)
+        :param storage: (str) codec the file is stored with, plain, gzip,
+            zstd or bgzf (defaults to the codec of the artefact source, see
+            biodownloader.storage)
         """
 
         self.url = url
@@ -189,50 +659,376 @@ class Downloader(object):
         self.outputfile_origin = outputfile
         self.decompress = decompress
         self.override = override
+        self.keep_compressed = keep_compressed
+        self.refresh = refresh
+        self.max_retries = max_retries
+        self.artefact = artefact
+        self.storage = storage
+        self.error = None
+        self.not_modified = False
+        self.trace = None
+
+        if self.keep_compressed is None:
+            self.keep_compressed = config.keep_compressed
+        if self.refresh is None:
+            self.refresh = config.refresh
+        self._storage_paths()
+        self._start()
+
+    def _start(self):
+        # downloads as soon as it is created (see aio.Downloader)
+        self.run()
+
+    def run(self):
+        """
+        Downloads the file, unless it is already available.
+
+        :return: self
+        """
+
+        if self.override or self.refresh or not self._available():
+            self._download()
+            self._record_artefact()
+            self._remove_variants()
+        else:
+            logger.info("%s already available...", self.outputfile)
+            get_metrics().cache(self.url, "local", source=self._source())
+        return self
 
+    def _storage_paths(self):
+        """
+        Works out the filename of the decompressed file (plainfile) and of
+        the file stored with the storage codec (outputfile).
+
+        :return: (side effects)
+        """
+
+        self.outputfile_origin = os.path.normpath(self.outputfile_origin)
+        self.outputfile = self.outputfile_origin
         if self.decompress:
             if self.outputfile_origin.endswith('.gz'):
                 self.outputfile = self.outputfile_origin.rstrip('.gz')
+            if self.storage is None:
+                self.storage = storage_codec(self._source())
+        else:
+            self.storage = "plain"
+        self.plainfile = self.outputfile
+        self.outputfile = stored_path(self.plainfile, self.storage)
 
-        if not os.path.exists(self.outputfile) or self.override:
-            self._download()
-            if self.outputfile_origin.endswith('.gz') and self.decompress:
-                self._decompress()
+    def _keeps_origin(self):
+        """
+        Whether the bytes as received are written to outputfile_origin,
+        in which case the download can be resumed and fetched in ranges.
+
+        :return: (boolean)
+        """
+
+        if self.storage == "bgzf":
+            # always written in blocks, even if served gzipped
+            return False
+        return (self.outputfile == self.outputfile_origin or
+                (self.keep_compressed and
+                 self.outputfile_origin != self.plainfile))
+
+    def _available(self):
+        return _available(self.plainfile, self.artefact)
+
+    def _remove_variants(self):
+        if self.error is None and not self.not_modified:
+            keep = [self.outputfile]
+            if self._keeps_origin():
+                keep.append(self.outputfile_origin)
+            _remove_variants(self.plainfile, keep=keep)
+
+    def _record_artefact(self):
+        if self.artefact is not None:
+            _record_artefact(self.outputfile, self.artefact,
+                             failed=self.error is not None)
+
+    def _source(self):
+        return self.artefact[0] if self.artefact is not None else None
+
+    def _record_metrics(self, retries=0):
+        get_metrics().record("download", self.url, source=self._source(),
+                             trace=self.trace, ok=self.error is None,
+                             retries=retries, error=self.error)
+
+    def _manifest(self):
+        return get_manifest(os.path.dirname(self.outputfile) or ".")
+
+    def _conditional_header(self):
+        """
+        Validators for a conditional GET of a file that is already available,
+        in refresh mode. Files without recorded validators, or whose size no
+        longer matches the manifest, are downloaded unconditionally.
+
+        :return: (dict) request headers
+        """
+
+        if (not self.refresh or self.override or not config.manifest or
+                not os.path.exists(self.outputfile)):
+            return {}
+        entry = self._manifest().get(os.path.basename(self.outputfile))
+        if entry is None or entry["size"] != os.path.getsize(self.outputfile):
+            return {}
+        header = {}
+        if entry["etag"]:
+            header["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            header["If-Modified-Since"] = entry["last_modified"]
+        return header
+
+    def _record_validators(self, headers):
+        """
+        Stores the ETag, Last-Modified and size of the downloaded file in the
+        manifest of its directory.
+
+        :param headers: response headers
+        :return: (side effects)
+        """
+
+        if not config.manifest:
+            return
+        self._manifest().update(os.path.basename(self.outputfile), url=self.url,
+                                etag=headers.get("ETag"),
+                                last_modified=headers.get("Last-Modified"),
+                                size=os.path.getsize(self.outputfile))
+
+    def _output_stream(self, offset=0):
+        """
+        Opens the destination file(s). Gzipped payloads are decompressed on
+        the fly, rather than written to disk and decompressed afterwards,
+        and recompressed with the storage codec the same way.
+
+        :param offset: (int) resume after this many bytes (see _partial_size)
+        :return: _OutputStream object
+        """
+
+        gunzip = self.outputfile_origin != self.plainfile
+        if self.outputfile == self.outputfile_origin and self._keeps_origin():
+            kwargs = dict(outputfile=self.outputfile, offset=offset)
+        elif self._keeps_origin():
+            kwargs = dict(outputfile=self.outputfile_origin,
+                          decompressed=self.outputfile, offset=offset,
+                          gunzip=gunzip, codec=self.storage)
         else:
-            logger.info("%s already available...", self.outputfile)
+            kwargs = dict(decompressed=self.outputfile, gunzip=gunzip,
+                          codec=self.storage)
+        return _open_partial(lambda: _OutputStream(**kwargs), self.outputfile)
 
-    def _download(self):
+    def _partial_size(self):
+        """
+        Size of the bytes kept from a previous, interrupted transfer.
+        Only files stored as received can be resumed.
+
+        :return: (int)
+        """
+
+        if not self._keeps_origin():
+            return 0
+        partial = self.outputfile_origin + PARTIAL_SUFFIX
+        if os.path.exists(partial):
+            return os.path.getsize(partial)
+        return 0
+
+    def _request(self, offset=0):
+        """
+        Opens a streamed GET, asking for the bytes after offset if resuming.
+        Payloads are requested without transfer encoding so that byte
+        offsets refer to the file itself.
+
+        :return: tuple (requests.Response, offset the body starts at)
+        """
+
+        header = {"Accept-Encoding": "identity"}
+        if offset:
+            header["Range"] = "bytes={}-".format(offset)
+        else:
+            header.update(self._conditional_header())
+        throttle(self.url)
+        response = _get(self.url, headers=header, stream=True, hedge=False)
+        if offset:
+            content_range = response.headers.get("Content-Range", "")
+            if (response.status_code == 206 and
+                    content_range.startswith("bytes {}-".format(offset))):
+                logger.info("Resuming %s from byte %s", self.url, offset)
+                return response, offset
+            elif response.status_code == 200:
+                # server ignored the range, this is the whole file
+                return response, 0
+            response.close()
+            logger.debug("Unable to resume %s (%s), restarting...",
+                         self.url, response.status_code)
+            return self._request(offset=0)
+        return response, 0
+
+    def _ranged_size(self, response, offset=0):
+        """
+        Size of the file if it can be fetched as parallel byte ranges:
+        the server must advertise Accept-Ranges and a Content-Length of at
+        least config.range_min_size, and the file must be stored as received.
+
+        :return: (int) 0 if the file should be streamed
+        """
+
+        if (offset or response.status_code != 200 or
+                config.range_connections < 2 or not hasattr(os, "pwrite")):
+            return 0
+        if not self._keeps_origin():
+            return 0
+        if response.headers.get("Accept-Ranges", "").lower() != "bytes":
+            return 0
+        try:
+            size = int(response.headers.get("Content-Length", 0))
+        except ValueError:
+            return 0
+        if size < config.range_min_size:
+            return 0
+        return size
+
+    def _download_ranges(self, response, size):
+        """
+        Fetches the file as config.range_connections byte ranges over
+        separate connections, written in place into a preallocated .part
+        file. The already open response provides the first range.
+
+        On failure, the .part file is truncated to the bytes received
+        contiguously from the start, so the download can be resumed.
+
+        :return: _OutputStream object that committed the file
+        """
+
+        step = -(-size // config.range_connections)
+        ranges = [(start, min(start + step, size) - 1)
+                  for start in range(0, size, step)]
+        written = [0] * len(ranges)
+        partial = self.outputfile_origin + PARTIAL_SUFFIX
+        logger.info("Fetching %s in %s ranges...", self.url, len(ranges))
+
+        def fetch(index):
+            start, end = ranges[index]
+            if index == 0:
+                r = response
+            else:
+                header = {"Accept-Encoding": "identity",
+                          "Range": "bytes={}-{}".format(start, end)}
+                throttle(self.url)
+                r = get_session().get(self.url, headers=header, stream=True,
+                                      timeout=_timeout())
+                if (r.status_code != 206 or not r.headers.get(
+                        "Content-Range", "").startswith("bytes {}-".format(start))):
+                    r.close()
+                    raise IOError("Unable to fetch bytes {}-{} of {} ({})"
+                                  "".format(start, end, self.url, r.status_code))
+            with r:
+                position = start
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    chunk = chunk[:end + 1 - position]
+                    os.pwrite(fd, chunk, position)
+                    position += len(chunk)
+                    written[index] += len(chunk)
+                    if position > end:
+                        break
+            if position != end + 1:
+                raise IOError("Incomplete range {}-{} of {}"
+                              "".format(start, end, self.url))
+
+        fd = _open_partial(lambda: os.open(
+            partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666), partial)
         try:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [executor.submit(fetch, i) for i in range(len(ranges))]
+                for future in futures:
+                    future.result()
+        except Exception:
+            prefix = 0
+            for (start, end), n in zip(ranges, written):
+                prefix += n
+                if n != end - start + 1:
+                    break
+            os.ftruncate(fd, prefix)
+            raise
+        finally:
+            os.close(fd)
+
+        # commits the .part file (decompressing it if needed)
+        with self._output_stream(offset=size) as outfile:
+            pass
+        return outfile
+
+    def _download(self):
+        # retried downloads resume from the .part file left behind
+        policy = get_retry_policy()
+        attempt = 0
+        while True:
             try:
-                import urllib.request
-                from urllib.error import URLError, HTTPError
-                with urllib.request.urlopen(self.url) as response, \
-                        open(self.outputfile_origin, 'wb') as outfile:
-                    shutil.copyfileobj(response, outfile)
-            except (AttributeError, ImportError):
-                import urllib
-                urllib.urlretrieve(self.url, self.outputfile_origin)
-        except (URLError, HTTPError, IOError, Exception) as e:
-            logger.debug("Unable to retrieve %s for %s", self.url, e)
-
-    def _decompress(self):
-        with gzip.open(self.outputfile_origin, 'rb') as infile, \
-                open(self.outputfile, 'wb') as outfile:
-            shutil.copyfileobj(infile, outfile)
-            os.remove(self.outputfile_origin)
-            logger.info("Decompressed %s to %s",
-                        self.outputfile_origin, self.outputfile)
-
-
-def download_structure_from_pdbe(identifier, pdb=False, bio=False, override=False):
+                self._attempt()
+                self.error = None
+                self._record_metrics(retries=attempt)
+                return
+            except Exception as e:
+                self.error = e
+                delay = policy.next_delay(attempt, error=e,
+                                          max_retries=self.max_retries)
+                if delay is None:
+                    logger.debug("Unable to retrieve %s for %s", self.url, e)
+                    self._record_metrics(retries=attempt)
+                    return
+            attempt += 1
+            logger.debug("Retrying %s in %.2f seconds (%s)...", self.url, delay,
+                         self.error)
+            time.sleep(delay)
+
+    def _attempt(self):
+        trace = self.trace = Trace()
+        with concurrency_slot(self.url) as slot:
+            if self.url.startswith("http"):
+                response, offset = self._request(offset=self._partial_size())
+                slot.responded(response.status_code)
+                trace.responded(response.status_code, response.headers,
+                                elapsed=response.elapsed.total_seconds())
+                with response:
+                    response.raise_for_status()
+                    if response.status_code == 304:
+                        self.not_modified = True
+                        logger.info("%s not modified...", self.outputfile)
+                        trace.finished()
+                        return
+                    size = self._ranged_size(response, offset=offset)
+                    if size:
+                        outfile = self._download_ranges(response, size)
+                        trace.finished(size=size,
+                                       decompress=outfile.decompress_seconds)
+                    else:
+                        with self._output_stream(offset=offset) as outfile:
+                            for chunk in response.iter_content(
+                                    chunk_size=CHUNK_SIZE):
+                                outfile.write(chunk)
+                        trace.finished(size=outfile.size,
+                                       decompress=outfile.decompress_seconds)
+                    self._record_validators(response.headers)
+            else:
+                throttle(self.url)
+                with get_ftp_opener().open(
+                        self.url, timeout=config.read_timeout) as response, \
+                        self._output_stream() as outfile:
+                    slot.responded()
+                    trace.responded()
+                    shutil.copyfileobj(response, outfile, CHUNK_SIZE)
+                trace.finished(size=outfile.size,
+                               decompress=outfile.decompress_seconds)
+                self._record_validators({})
+
+
+def _structure_target(identifier, pdb=False, bio=False, assembly_id="1"):
     """
-    Downloads a structure from the PDBe to the filesystem.
+    Builds the PDBe url and output filename for a structure.
 
-    :param identifier: (str) PDB ID
-    :param pdb: (boolean) PDB formatted if True, otherwise mmCIF format
-    :param bio: (boolean) if true downloads the preferred Biological Assembly
-    :param override: (boolean)
-    :return: (side effects)
+    :return: tuple (url, outputfile)
     """
 
     if pdb:
@@ -243,8 +1039,7 @@ def download_structure_from_pdbe(identifier, pdb=False, bio=False, override=Fals
         else:
             filename = "{}.cif".format(identifier)
 
-    outputfile = os.path.join(config.db_root, config.db_pdbx, filename)
-    os.makedirs(os.path.join(config.db_root, config.db_pdbx), exist_ok=True)
+    outputfile = local_path(config.db_pdbx, filename, "pdbe", identifier)
 
     if pdb:
         url_endpoint = "entry-files/download/pdb{}.ent".format(identifier)
@@ -253,9 +1048,8 @@ def download_structure_from_pdbe(identifier, pdb=False, bio=False, override=Fals
             # atom lines only?
             # url_endpoint = ("static/entry/download/"
             #                "{}-assembly-{}_atom_site.cif.gz".format(identifier, pref))
-            pref = get_preferred_assembly_id(identifier=identifier)
             url_endpoint = ("static/entry/download/"
-                            "{}-assembly-{}.cif.gz".format(identifier, pref))
+                            "{}-assembly-{}.cif.gz".format(identifier, assembly_id))
         else:
             # original mmCIF?
             # url_endpoint = "entry-files/download/{}.cif".format(pdbid)
@@ -263,110 +1057,364 @@ def download_structure_from_pdbe(identifier, pdb=False, bio=False, override=Fals
 
     url_root = config.http_pdbe
     url = url_root + url_endpoint
-    Downloader(url=url, outputfile=outputfile,
-               decompress=True, override=override)
-    return
+    return url, outputfile
 
 
-def download_sifts_from_ebi(identifier, override=False):
+def _sifts_target(identifier):
     """
-    Downloads a SIFTS xml from the EBI FTP to the filesystem.
+    Builds the EBI FTP url and output filename for a SIFTS xml.
 
-    :param identifier: (str) PDB ID
-    :param override: (boolean)
-    :return: (side effects)
+    :return: tuple (url, outputfile)
     """
 
     filename = "{}.xml.gz".format(identifier)
-    outputfile = os.path.join(config.db_root, config.db_sifts, filename)
-    os.makedirs(os.path.join(config.db_root, config.db_sifts), exist_ok=True)
+    outputfile = local_path(config.db_sifts, filename, "sifts", identifier)
 
     url_root = config.ftp_sifts
     url_endpoint = "{}.xml.gz".format(identifier)
     url = url_root + url_endpoint
-    Downloader(url=url, outputfile=outputfile,
-               decompress=True, override=override)
-    return
+    return url, outputfile
 
 
-def download_data_from_uniprot(identifier, file_format="fasta", override=False):
+def _uniprot_target(identifier, file_format="fasta"):
     """
-    Downloads a UniProt fasta, gff or txt to the filesystem.
+    Builds the UniProt url and output filename for a fasta, gff or txt.
 
-    :param identifier: (str) UniProt ID
-    :param file_format: (str) endpoint
-    :param override: (boolean)
-    :return: (side effects)
+    :return: tuple (url, outputfile)
     """
 
     file_format = file_format.lstrip('.')
     if file_format in ['txt', 'fasta', 'gff']:
         filename = "{}.{}".format(identifier, file_format)
-        outputfile = os.path.join(config.db_root, config.db_uniprot, filename)
-        os.makedirs(os.path.join(config.db_root, config.db_uniprot), exist_ok=True)
+        outputfile = local_path(config.db_uniprot, filename, "uniprot",
+                                identifier)
 
         url_root = config.http_uniprot
         url_endpoint = "{}.{}".format(identifier, file_format)
         url = url_root + url_endpoint
-        Downloader(url=url, outputfile=outputfile,
-                   decompress=True, override=override)
+        return url, outputfile
     else:
         raise ValueError("File format {} is not currently implemented..."
                          "".format(file_format))
-    return
 
 
-def download_alignment_from_cath(identifier, max_sequences=200, override=False):
+def _cath_target(identifier, max_sequences=200):
     """
-    Downloads a MSA in fasta format from CATH to the filesystem.
+    Builds the CATH url and output filename for a Funfam alignment.
 
-    :param identifier: (str) CATH ID (<Superfamily>_<Funfam>)
-    :param max_sequences: (str) Maximum number of sequences (default = 200)
-    :param override: (boolean)
-    :return: (side effects)
+    :return: tuple (url, outputfile)
     """
 
     if '_' in identifier:
         filename = "{}.fasta".format(identifier)
         superfamily, funfam = identifier.split('_')[0], identifier.split('_')[1]
         outputfile = os.path.join(config.db_root, config.db_cath, filename)
-        os.makedirs(os.path.join(config.db_root, config.db_cath), exist_ok=True)
 
         url_root = config.http_cath
         url_endpoint = ("superfamily/{}/funfam/{}/files/seed_alignment.fasta"
                         "?max_sequences={}".format(superfamily, funfam,
                                                    max_sequences))
         url = url_root + url_endpoint
-        Downloader(url=url, outputfile=outputfile,
-                   decompress=True, override=override)
+        return url, outputfile
     else:
         raise ValueError("Expected CATH  ID but got {}..."
                          "".format(identifier))
-    return
 
 
-def download_alignment_from_pfam(identifier, alignment_size="seed",
-                                 override=False):
+def _pfam_target(identifier, alignment_size="seed"):
     """
-    Downloads a MSA in Stockholm format from Pfam to the filesystem.
+    Builds the Pfam url and output filename for a Stockholm alignment.
 
-    :param identifier: (str) PFam ID
-    :param alignment_size: (str) either "seed" or "full"
-    :param override: (boolean)
-    :return: (side effects)
+    :return: tuple (url, outputfile)
     """
 
     filename = "{}.sth".format(identifier)
     outputfile = os.path.join(config.db_root, config.db_pfam, filename)
-    os.makedirs(os.path.join(config.db_root, config.db_pfam), exist_ok=True)
 
     url_root = config.http_pfam
     url_endpoint = ("family/{}/alignment/{}"
                     "".format(identifier, alignment_size))
     url = url_root + url_endpoint
-    Downloader(url=url, outputfile=outputfile,
-               decompress=True, override=override)
-    return
+    return url, outputfile
+
+
+def download_structure_from_pdbe(identifier, pdb=False, bio=False, override=False,
+                                 assembly_id=None):
+    """
+    Downloads a structure from the PDBe to the filesystem.
+
+    :param identifier: (str) PDB ID
+    :param pdb: (boolean) PDB formatted if True, otherwise mmCIF format
+    :param bio: (boolean) if true downloads the preferred Biological Assembly
+    :param override: (boolean)
+    :param assembly_id: (str) assembly to download if bio is True
+        (defaults to the preferred one)
+    :return: Downloader object
+    """
+
+    pref = "1"
+    if bio and not pdb:
+        pref = assembly_id or get_preferred_assembly_id(identifier=identifier)
+    url, outputfile = _structure_target(identifier, pdb=pdb, bio=bio,
+                                        assembly_id=pref)
+    _makedirs(os.path.dirname(outputfile))
+    file_format = "pdb" if pdb else "bio" if bio else "mmcif"
+    if config.structure_mirrors:
+        return _download_from_mirrors("structures", file_format, outputfile,
+                                      identifier, assembly_id=pref,
+                                      override=override)
+    return Downloader(url=url, outputfile=outputfile,
+                      decompress=True, override=override,
+                      artefact=("pdbe", identifier, file_format))
+
+
+def _download_from_mirrors(resource, file_format, outputfile, identifier,
+                           assembly_id="1", override=False):
+    """
+    Downloads a file from the best ranked mirror of a resource, failing
+    over to the next mirror on errors (see biodownloader.mirrors).
+
+    :param resource: (str) key in config.mirrors
+    :param file_format: (str) key in the mirror url templates
+    :param outputfile: (str) Output filename (shared by every mirror)
+    :param identifier: (str) accession ID
+    :param assembly_id: (str) assembly, for bio
+    :param override: (boolean)
+    :return: Downloader object of the last mirror tried
+    """
+
+    registry = get_mirror_registry(resource)
+    artefact = ("pdbe", identifier, file_format)
+    downloader = None
+    for mirror in registry.ranked():
+        url = mirror.url(file_format, identifier, assembly_id=assembly_id)
+        if url is None:
+            continue
+        origin = outputfile
+        if url.endswith(".gz") and not outputfile.endswith(".gz"):
+            # decompressed to the same local filename
+            origin = outputfile + ".gz"
+        if (downloader is None and not (override or config.refresh) and
+                _available(outputfile, artefact)):
+            return Downloader(url=url, outputfile=origin, artefact=artefact)
+        downloader = Downloader(url=url, outputfile=origin, decompress=True,
+                                override=override,
+                                max_retries=config.mirror_retries,
+                                artefact=artefact)
+        trace = downloader.trace
+        if downloader.error is None:
+            # time to first byte, comparable with the probe round trips
+            # whatever the size of the file
+            registry.record(mirror, ok=True,
+                            latency=trace.ttfb if trace is not None else None)
+            return downloader
+        if trace is not None and trace.status == 404:
+            # missing entry, not a failing mirror
+            logger.debug("%s not found on %s...", outputfile, mirror.name)
+            continue
+        registry.record(mirror, ok=False)
+        logger.warning("Unable to retrieve %s from %s (%s)...", outputfile,
+                       mirror.name, downloader.error)
+        # a partial file from one mirror can't be resumed from another
+        for partial in (origin, downloader.outputfile):
+            if os.path.exists(partial + PARTIAL_SUFFIX):
+                os.remove(partial + PARTIAL_SUFFIX)
+    return downloader
+
+
+def download_sifts_from_ebi(identifier, override=False):
+    """
+    Downloads a SIFTS xml from the EBI FTP to the filesystem.
+
+    :param identifier: (str) PDB ID
+    :param override: (boolean)
+    :return: Downloader object
+    """
+
+    url, outputfile = _sifts_target(identifier)
+    _makedirs(os.path.dirname(outputfile))
+    return Downloader(url=url, outputfile=outputfile,
+                      decompress=True, override=override,
+                      artefact=("sifts", identifier, "sifts"))
+
+
+def download_data_from_uniprot(identifier, file_format="fasta", override=False):
+    """
+    Downloads a UniProt fasta, gff or txt to the filesystem.
+
+    :param identifier: (str) UniProt ID
+    :param file_format: (str) endpoint
+    :param override: (boolean)
+    :return: Downloader object
+    """
+
+    url, outputfile = _uniprot_target(identifier, file_format=file_format)
+    _makedirs(os.path.dirname(outputfile))
+    return Downloader(url=url, outputfile=outputfile,
+                      decompress=True, override=override,
+                      artefact=("uniprot", identifier, file_format.lstrip('.')))
+
+
+def _split_uniprot_records(lines, file_format="fasta"):
+    """
+    Splits a streamed multi-entry UniProt response into its entries.
+
+    :param lines: iterable of lines (bytes, without line breaks)
+    :param file_format: (str) fasta, txt or gff
+    :return: generator of tuples (list of accessions, entry as bytes)
+    """
+
+    accessions = []
+    record = []
+    header = []
+    for line in lines:
+        if file_format == "fasta":
+            if line.startswith(b">") and record:
+                yield accessions, b"".join(record)
+                accessions, record = [], []
+            if line.startswith(b">"):
+                fields = line[1:].split(b"|")
+                accessions = [fields[1] if len(fields) > 1 else fields[0]]
+            record.append(line + b"\n")
+        elif file_format == "txt":
+            if line.startswith(b"AC   "):
+                accessions.extend(a.strip() for a in line[5:].split(b";")
+                                  if a.strip())
+            record.append(line + b"\n")
+            if line.startswith(b"//"):
+                yield accessions, b"".join(record)
+                accessions, record = [], []
+        else:
+            if line.startswith(b"##gff-version"):
+                header = [line + b"\n"]
+                continue
+            if line.startswith(b"##sequence-region"):
+                accession = line.split()[1]
+            elif line.startswith(b"#") or not line.strip():
+                if record:
+                    record.append(line + b"\n")
+                continue
+            else:
+                accession = line.split(b"\t")[0]
+            if accessions and accession != accessions[0]:
+                yield accessions, b"".join(header + record)
+                accessions, record = [], []
+            accessions = [accession]
+            record.append(line + b"\n")
+    if record and accessions:
+        if file_format == "gff":
+            record = header + record
+        yield accessions, b"".join(record)
+
+
+def download_data_from_uniprot_batch(identifiers, file_format="fasta",
+                                     override=False, batch_size=None):
+    """
+    Downloads UniProt fasta, gff or txt entries for many accessions, with
+    one request to the UniProt stream endpoint per batch of accessions. The
+    response is split into the same per-accession files written by
+    download_data_from_uniprot.
+
+    :param identifiers: iterable of UniProt IDs
+    :param file_format: (str) endpoint
+    :param override: (boolean)
+    :param batch_size: (int) accessions per request (defaults to
+        config.uniprot_batch_size)
+    :return: list of UniProt IDs that UniProt did not return
+    """
+
+    if batch_size is None:
+        batch_size = config.uniprot_batch_size
+
+    file_format = file_format.lstrip('.')
+    codec = storage_codec("uniprot")
+    targets = OrderedDict()
+    for identifier in identifiers:
+        url, outputfile = _uniprot_target(identifier, file_format=file_format)
+        if override or not _available(outputfile, ("uniprot", identifier,
+                                                   file_format)):
+            targets[identifier.upper()] = (identifier, outputfile)
+        else:
+            logger.info("%s already available...", outputfile)
+            get_metrics().cache(url, "local", source="uniprot")
+
+    missing = []
+    pending = list(targets)
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        found = set()
+        query = " OR ".join("accession:{}".format(i) for i in batch)
+        response = fetch_from_url_or_retry(config.http_uniprot_stream,
+                                           json=False, stream=True,
+                                           retry_in=(429, 500, 503),
+                                           query=query, format=file_format)
+        if response is not None:
+            try:
+                with response:
+                    records = _split_uniprot_records(response.iter_lines(),
+                                                     file_format=file_format)
+                    for accessions, record in records:
+                        for accession in accessions:
+                            accession = accession.decode("utf-8").upper()
+                            if accession in targets and accession not in found:
+                                identifier, outputfile = targets[accession]
+                                stored = stored_path(outputfile, codec)
+                                _makedirs(os.path.dirname(outputfile))
+                                with _OutputStream(decompressed=stored,
+                                                   gunzip=False,
+                                                   codec=codec) as outfile:
+                                    outfile.write(record)
+                                _record_artefact(stored, ("uniprot", identifier,
+                                                          file_format))
+                                _remove_variants(outputfile, keep=[stored])
+                                found.add(accession)
+                                break
+            except Exception as e:
+                logger.debug("Unable to retrieve %s for %s",
+                             config.http_uniprot_stream, e)
+        for accession in batch:
+            if accession not in found:
+                missing.append(targets[accession][0])
+
+    if missing:
+        logger.warning("UniProt did not return %s entries: %s", len(missing),
+                       ", ".join(missing))
+    return missing
+
+
+def download_alignment_from_cath(identifier, max_sequences=200, override=False):
+    """
+    Downloads a MSA in fasta format from CATH to the filesystem.
+
+    :param identifier: (str) CATH ID (<Superfamily>_<Funfam>)
+    :param max_sequences: (str) Maximum number of sequences (default = 200)
+    :param override: (boolean)
+    :return: Downloader object
+    """
+
+    url, outputfile = _cath_target(identifier, max_sequences=max_sequences)
+    _makedirs(os.path.dirname(outputfile))
+    return Downloader(url=url, outputfile=outputfile,
+                      decompress=True, override=override,
+                      artefact=("cath", identifier, "cath"))
+
+
+def download_alignment_from_pfam(identifier, alignment_size="seed",
+                                 override=False):
+    """
+    Downloads a MSA in Stockholm format from Pfam to the filesystem.
+
+    :param identifier: (str) PFam ID
+    :param alignment_size: (str) either "seed" or "full"
+    :param override: (boolean)
+    :return: Downloader object
+    """
+
+    url, outputfile = _pfam_target(identifier, alignment_size=alignment_size)
+    _makedirs(os.path.dirname(outputfile))
+    return Downloader(url=url, outputfile=outputfile,
+                      decompress=True, override=override,
+                      artefact=("pfam", identifier, "pfam"))
 
 
 if __name__ == '__main__':
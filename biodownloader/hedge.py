@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+from urllib.parse import urlparse
+from concurrent.futures import (ThreadPoolExecutor, wait, FIRST_COMPLETED,
+                                TimeoutError as FuturesTimeoutError)
+
+from biodownloader.config import config
+from biodownloader.session import get_session
+from biodownloader.ratelimit import throttle
+
+logger = logging.getLogger("biodownloader")
+
+_lock = threading.Lock()
+_trackers = {}
+_executor = None
+_workers = 0
+# hedged_get calls in progress
+_callers = 0
+
+
+class LatencyTracker(object):
+    def __init__(self, size=200):
+        """
+        Latencies of the most recent responses from a host, up to their
+        headers (so whether the body was read or streamed does not count).
+
+        :param size: (int) number of responses kept
+        """
+
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, latency):
+        with self._lock:
+            self._samples.append(latency)
+
+    def percentile(self, percentile):
+        """
+        :param percentile: (float) between 0 and 100
+        :return: (float) latency in seconds, None without samples
+        """
+
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = int(round(percentile / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+
+def _host(url):
+    return urlparse(url).netloc.lower()
+
+
+def get_latency_tracker(url):
+    """
+    Gets the (per process) LatencyTracker of the host in url.
+
+    :param url: (str) Full web-address
+    :return: LatencyTracker object
+    """
+
+    host = _host(url)
+    with _lock:
+        if host not in _trackers:
+            _trackers[host] = LatencyTracker()
+        return _trackers[host]
+
+
+def hedge_delay(url):
+    """
+    Seconds to wait for a response before sending a duplicate request:
+    the config.hedge_percentile of the host's recent latencies, or
+    config.hedge_delay until config.hedge_min_samples have been seen.
+
+    :param url: (str) Full web-address
+    :return: (float)
+    """
+
+    tracker = get_latency_tracker(url)
+    if len(tracker) < config.hedge_min_samples:
+        return config.hedge_delay
+    return max(config.hedge_min_delay,
+               tracker.percentile(config.hedge_percentile))
+
+
+def _submit(func, *args):
+    """
+    Sends func to the pool of hedged requests, which has two threads (a
+    primary and its hedge) per request in progress, and at least
+    config.hedge_workers. A pool too small for the requests in progress is
+    replaced by one twice as large, so primaries never queue behind each
+    other.
+
+    :return: Future object
+    """
+
+    global _executor, _workers
+
+    with _lock:
+        workers = max(config.hedge_workers, 2 * _callers)
+        if _executor is None or _workers < workers:
+            previous = _executor
+            _workers = max(workers, 2 * _workers)
+            _executor = ThreadPoolExecutor(max_workers=_workers)
+            if previous is not None:
+                # its requests in progress are still answered
+                previous.shutdown(wait=False)
+        return _executor.submit(func, *args)
+
+
+def _close(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+def hedged_get(url, **kwargs):
+    """
+    GET with the shared session that sends a duplicate request if there is
+    no response hedge_delay(url) after the request was sent, and returns
+    whichever response arrives first (the other one is closed). Only for
+    idempotent requests.
+
+    :param url: (str) Full web-address
+    :param kwargs: requests.Session.get kwargs
+    :return: requests.Response
+    """
+
+    global _callers
+
+    with _lock:
+        _callers += 1
+    try:
+        return _hedged_get(url, **kwargs)
+    finally:
+        with _lock:
+            _callers -= 1
+
+
+def _hedged_get(url, **kwargs):
+    tracker = get_latency_tracker(url)
+    sent = []
+    started = threading.Event()
+
+    def send(hedge):
+        if hedge:
+            throttle(url)
+        else:
+            sent.append(time.monotonic())
+            started.set()
+        response = get_session().get(url, **kwargs)
+        tracker.add(response.elapsed.total_seconds())
+        return response
+
+    delay = hedge_delay(url)
+    primary = _submit(send, False)
+    # the delay runs from when the request is sent, not submitted
+    started.wait()
+    try:
+        return primary.result(timeout=max(0, sent[0] + delay -
+                                          time.monotonic()))
+    except FuturesTimeoutError:
+        pass
+
+    logger.debug("No response from %s after %.2f seconds, hedging...",
+                 url, delay)
+    pending = {primary, _submit(send, True)}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                for other in pending:
+                    other.add_done_callback(_close)
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def reset_hedging():
+    """
+    Forgets the recorded latencies and stops the hedging threads.
+
+    :return: (side effects)
+    """
+
+    global _executor, _workers
+
+    with _lock:
+        _trackers.clear()
+        executor, _executor, _workers = _executor, None, 0
+    if executor is not None:
+        executor.shutdown(wait=False)
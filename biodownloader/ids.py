@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+import logging
+from collections import OrderedDict
+
+from biodownloader.config import config
+
+logger = logging.getLogger("biodownloader")
+
+# IDs are separated by whitespace or commas, '#' starts a comment
+_separators = re.compile(r"[\s,]+")
+
+# accession shapes, matched whatever the case: PDB IDs, UniProt accessions
+# (with an optional isoform) and Pfam family accessions
+_pdb_id = re.compile(r"[0-9][A-Z0-9]{3}$", re.I)
+_uniprot_ac = re.compile(r"([OPQ][0-9][A-Z0-9]{3}[0-9]|"
+                         r"[A-NR-Z][0-9]([A-Z][A-Z0-9]{2}[0-9]){1,2})"
+                         r"(-[0-9]+)?$", re.I)
+_pfam_ac = re.compile(r"PF[0-9]{5}$", re.I)
+
+# accession shape of the IDs of each file format, by case
+_lower = {"pdb": _pdb_id, "mmcif": _pdb_id, "bio": _pdb_id, "sifts": _pdb_id}
+_upper = {"fasta": _uniprot_ac, "gff": _uniprot_ac, "txt": _uniprot_ac,
+          "pfam": _pfam_ac}
+
+
+def read_ids(lines):
+    """
+    Reads IDs lazily from an iterable of lines (e.g. an open file or
+    stdin), one or more per line.
+
+    :param lines: iterable of lines
+    :return: generator of IDs
+    """
+
+    for line in lines:
+        line = line.split("#", 1)[0]
+        for identifier in _separators.split(line):
+            if identifier:
+                yield identifier
+
+
+def normalise(ids, file_formats):
+    """
+    Normalises the case of the IDs shaped like accessions: PDB IDs are
+    lower case, UniProt and Pfam accessions upper case. Other IDs, e.g.
+    Pfam family names (Pkinase) or CATH IDs, are left as they are.
+
+    :param ids: iterable of IDs
+    :param file_formats: iterable of file formats
+    :return: generator of IDs
+    """
+
+    file_formats = set(file_formats)
+    for shapes, case in ((_lower, str.lower), (_upper, str.upper)):
+        if file_formats and file_formats.issubset(shapes):
+            patterns = {shapes[f] for f in file_formats}
+            return (case(i) if any(p.match(i) for p in patterns) else i
+                    for i in ids)
+    return iter(ids)
+
+
+def unique(ids, window=None):
+    """
+    Drops duplicated IDs while keeping the input order, remembering only the
+    most recently seen IDs so memory stays bounded. A duplicate further
+    apart than the window is passed through again, and then found on disk.
+
+    :param ids: iterable of IDs
+    :param window: (int) IDs remembered (defaults to config.ids_dedup_window)
+    :return: generator of IDs
+    """
+
+    if window is None:
+        window = config.ids_dedup_window
+
+    seen = OrderedDict()
+    duplicates = 0
+    for identifier in ids:
+        if identifier in seen:
+            seen.move_to_end(identifier)
+            duplicates += 1
+            continue
+        seen[identifier] = None
+        if len(seen) > window:
+            seen.popitem(last=False)
+        yield identifier
+    if duplicates:
+        logger.info("Skipped %s duplicated IDs...", duplicates)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+from biodownloader.config import config
+from biodownloader.storage import strip_suffix
+
+logger = logging.getLogger("biodownloader")
+
+INDEX_NAME = ".biodownloader-index.sqlite"
+
+_lock = threading.Lock()
+_indexes = {}
+
+# local filenames of each (source, format), see the fetchers.*_target helpers
+_suffixes = (("_bio.cif", "pdbe", "bio"),
+             (".cif", "pdbe", "mmcif"),
+             (".pdb", "pdbe", "pdb"),
+             (".xml", "sifts", "sifts"),
+             (".gff", "uniprot", "gff"),
+             (".txt", "uniprot", "txt"),
+             (".sth", "pfam", "pfam"),
+             (".fasta", None, None))
+
+
+def artefact(filename):
+    """
+    Works out which artefact a downloaded file is from its name, stored
+    with any codec (e.g. 2pah.cif, 2pah.cif.gz or 2pah.cif.zst).
+
+    :param filename: (str) basename of the file
+    :return: tuple (source, id, format) or None if not a known artefact
+    """
+
+    filename = strip_suffix(filename)
+    for suffix, source, file_format in _suffixes:
+        if filename.endswith(suffix) and len(filename) > len(suffix):
+            identifier = filename[:-len(suffix)]
+            if source is None:
+                # CATH IDs are <Superfamily>_<Funfam>, UniProt IDs have no '_'
+                if "_" in identifier:
+                    source, file_format = "cath", "cath"
+                else:
+                    source, file_format = "uniprot", "fasta"
+            return source, identifier, file_format
+    return None
+
+
+class Index(object):
+    def __init__(self, path):
+        """
+        Downloaded artefacts keyed by (source, id, format), with their path,
+        size, mtime and status, stored in a sqlite file. Once the index has
+        been rebuilt from a directory scan it is complete: artefacts missing
+        from it are not on disk, and need no stat to find out.
+
+        :param path: (str) sqlite filename
+        """
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30,
+                                           check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS artefacts ("
+                "source TEXT, id TEXT, format TEXT, path TEXT, size INTEGER, "
+                "mtime REAL, status TEXT, updated REAL, "
+                "PRIMARY KEY (source, id, format))")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, "
+                "value TEXT)")
+
+    @property
+    def complete(self):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM meta WHERE key = 'scanned'").fetchone()
+        return row is not None
+
+    def get(self, source, identifier, file_format):
+        """
+        :param source: (str) e.g. pdbe, sifts, uniprot, cath or pfam
+        :param identifier: (str) accession ID
+        :param file_format: (str) one of engine.FILE_FORMATS
+        :return: dict or None
+        """
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT path, size, mtime, status, updated FROM artefacts "
+                "WHERE source = ? AND id = ? AND format = ?",
+                (source, identifier, file_format)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("path", "size", "mtime", "status", "updated"), row))
+
+    def update(self, source, identifier, file_format, path, size=None,
+               mtime=None, status="ok"):
+        """
+        Records (or replaces) an artefact.
+
+        :param source: (str) e.g. pdbe, sifts, uniprot, cath or pfam
+        :param identifier: (str) accession ID
+        :param file_format: (str) one of engine.FILE_FORMATS
+        :param path: (str) absolute filename
+        :param size: (int) size in bytes
+        :param mtime: (float) modification time
+        :param status: (str) ok or failed
+        :return: (side effects)
+        """
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO artefacts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (source, identifier, file_format, path, size, mtime, status,
+                 time.time()))
+
+    def remove(self, source, identifier, file_format):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM artefacts WHERE source = ? AND id = ? AND "
+                "format = ?", (source, identifier, file_format))
+
+    def rebuild(self, directories, shards=None):
+        """
+        Replaces the index with the artefacts found in a scan of the
+        given directories, in one transaction.
+
+        :param directories: iterable of directories
+        :param shards: (boolean) also scans their shard subdirectories
+            (defaults to config.sharded_layout, see biodownloader.layout)
+        :return: (int) number of artefacts found
+        """
+
+        if shards is None:
+            shards = config.sharded_layout
+        rows = {}
+        for directory in sorted(set(os.path.abspath(d) for d in directories)):
+            if os.path.isdir(directory):
+                for row in _scan(directory, shards):
+                    # the decompressed file rather than the .gz kept next
+                    # to it (see config.keep_compressed)
+                    key = row[:3]
+                    if key not in rows or len(row[3]) < len(rows[key][3]):
+                        rows[key] = row
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM artefacts")
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO artefacts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows.values())
+            self._connection.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('scanned', ?)",
+                (str(time.time()),))
+        logger.info("Indexed %s files in %s", len(rows), self.path)
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def _shard_directory(entry):
+    # PDB-style ('pa') or UniProt ('P00') shards, not e.g. the obsolete
+    # directory files are moved aside to (see biodownloader.sync)
+    from biodownloader.layout import UNIPROT_SHARD_LENGTH
+
+    obsolete = os.path.abspath(os.path.join(config.db_root,
+                                            config.db_obsolete))
+    return (len(entry.name) in (2, UNIPROT_SHARD_LENGTH) and
+            entry.name.isalnum() and
+            os.path.abspath(entry.path) != obsolete)
+
+
+def _scan(directory, shards=False):
+    subdirectories = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if shards and _shard_directory(entry):
+                    subdirectories.append(entry.path)
+                continue
+            key = artefact(entry.name)
+            if key is None or not entry.is_file():
+                continue
+            stat = entry.stat()
+            yield key + (entry.path, stat.st_size, stat.st_mtime, "ok",
+                         time.time())
+    for subdirectory in subdirectories:
+        for row in _scan(subdirectory):
+            yield row
+
+
+def index_path():
+    if config.index_file is not None:
+        return os.path.abspath(config.index_file)
+    return os.path.abspath(os.path.join(config.db_root, INDEX_NAME))
+
+
+def data_directories():
+    """
+    :return: list of the directories files are downloaded to
+    """
+
+    return sorted(set(os.path.abspath(os.path.join(config.db_root, d))
+                      for d in (config.db_pdbx, config.db_sifts,
+                                config.db_uniprot, config.db_cath,
+                                config.db_pfam)))
+
+
+def get_index():
+    """
+    Gets the (per process) Index, stored in config.index_file or
+    <db_root>/.biodownloader-index.sqlite.
+
+    :return: Index object
+    """
+
+    path = index_path()
+    with _lock:
+        if path not in _indexes:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _indexes[path] = Index(path)
+        return _indexes[path]
+
+
+def close_indexes():
+    """
+    Closes every open Index.
+
+    :return: (side effects)
+    """
+
+    with _lock:
+        for index in _indexes.values():
+            index.close()
+        _indexes.clear()
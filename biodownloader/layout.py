@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import logging
+
+from biodownloader.config import config
+from biodownloader.index import (artefact, get_index, data_directories,
+                                 _shard_directory)
+from biodownloader.manifest import (MANIFEST_NAME, get_manifest,
+                                    close_manifests)
+
+logger = logging.getLogger("biodownloader")
+
+# sources stored in shards and the config key of their directory
+SHARDED_SOURCES = (("pdbe", "db_pdbx"),
+                   ("sifts", "db_sifts"),
+                   ("uniprot", "db_uniprot"))
+# characters of a UniProt accession naming its shard
+UNIPROT_SHARD_LENGTH = 3
+
+
+def shard(source, identifier):
+    """
+    Gets the shard subdirectory of an artefact, PDB-style (the middle two
+    characters, e.g. 'pa' for 2pah) for structures and SIFTS, and the
+    accession prefix (e.g. 'P00' for P00439) for UniProt.
+
+    :param source: (str) e.g. pdbe, sifts or uniprot
+    :param identifier: (str) accession ID
+    :return: (str) subdirectory or None if the source is not sharded
+    """
+
+    if source in ("pdbe", "sifts"):
+        return identifier[1:3].lower()
+    elif source == "uniprot":
+        return identifier[:UNIPROT_SHARD_LENGTH].upper()
+    return None
+
+
+def local_path(directory, filename, source, identifier):
+    """
+    Builds the output filename of an artefact, in its shard if
+    config.sharded_layout is set.
+
+    :param directory: (str) directory under config.db_root (e.g. db_pdbx)
+    :param filename: (str) basename of the file
+    :param source: (str) e.g. pdbe, sifts or uniprot
+    :param identifier: (str) accession ID
+    :return: (str) filename
+    """
+
+    subdirectory = shard(source, identifier) if config.sharded_layout else None
+    if subdirectory:
+        return os.path.join(config.db_root, directory, subdirectory, filename)
+    return os.path.join(config.db_root, directory, filename)
+
+
+def _artefact(filename):
+    # compressed variants and interrupted .part files move with their
+    # artefact (artefact recognises the .gz and .zst suffixes)
+    from biodownloader.fetchers import PARTIAL_SUFFIX
+
+    if filename.endswith(PARTIAL_SUFFIX):
+        filename = filename[:-len(PARTIAL_SUFFIX)]
+    return artefact(filename)
+
+
+def _candidates(directory, sharded):
+    # flat files to shard, or sharded files to flatten
+    if sharded:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    yield entry.path
+    else:
+        with os.scandir(directory) as entries:
+            subdirectories = [e.path for e in entries
+                              if e.is_dir() and _shard_directory(e)]
+        for subdirectory in subdirectories:
+            with os.scandir(subdirectory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        yield entry.path
+
+
+def move_validators(source, target):
+    """
+    Moves the manifest entry of a file that was moved to another directory.
+
+    :param source: (str) previous filename
+    :param target: (str) new filename
+    :return: (side effects)
+    """
+
+    directory = os.path.dirname(source)
+    if not os.path.isfile(os.path.join(directory, MANIFEST_NAME)):
+        return
+    filename = os.path.basename(source)
+    entry = get_manifest(directory).get(filename)
+    if entry is not None:
+        get_manifest(os.path.dirname(target)).update(
+            filename, url=entry["url"], etag=entry["etag"],
+            last_modified=entry["last_modified"], size=entry["size"])
+        get_manifest(directory).remove(filename)
+
+
+def migrate(sharded=True):
+    """
+    Moves the PDB, SIFTS and UniProt files under config.db_root to the
+    sharded layout (or back to flat directories), along with their
+    manifest entries, and rebuilds the index. Files whose target already
+    exists are left in place.
+
+    :param sharded: (boolean) to the sharded layout if True, otherwise flat
+    :return: (int) number of files moved
+    """
+
+    moved = 0
+    emptied = set()
+    for source, key in SHARDED_SOURCES:
+        directory = os.path.abspath(os.path.join(config.db_root,
+                                                 getattr(config, key)))
+        if not os.path.isdir(directory):
+            continue
+        for path in list(_candidates(directory, sharded)):
+            found = _artefact(os.path.basename(path))
+            if found is None or found[0] != source:
+                continue
+            subdirectory = shard(source, found[1])
+            if sharded:
+                target = os.path.join(directory, subdirectory,
+                                      os.path.basename(path))
+            elif os.path.basename(os.path.dirname(path)) == subdirectory:
+                target = os.path.join(directory, os.path.basename(path))
+            else:
+                # not in its shard, e.g. another data directory
+                continue
+            if os.path.exists(target):
+                logger.warning("%s already exists, leaving %s in place...",
+                               target, path)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+            move_validators(path, target)
+            emptied.add(os.path.dirname(path))
+            moved += 1
+    close_manifests()
+    if not sharded:
+        for subdirectory in emptied:
+            _remove_empty_shard(subdirectory)
+    logger.info("Moved %s files to the %s layout", moved,
+                "sharded" if sharded else "flat")
+    if config.index:
+        get_index().rebuild(data_directories(), shards=sharded)
+    return moved
+
+
+def _remove_empty_shard(directory):
+    if os.listdir(directory) == [MANIFEST_NAME]:
+        os.remove(os.path.join(directory, MANIFEST_NAME))
+    try:
+        os.rmdir(directory)
+    except OSError:
+        # still holds files that were not moved
+        pass
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger("biodownloader")
+
+MANIFEST_NAME = ".biodownloader-manifest.sqlite"
+
+_lock = threading.Lock()
+_manifests = {}
+
+
+class Manifest(object):
+    def __init__(self, path):
+        """
+        HTTP validators (ETag, Last-Modified) and sizes of the files
+        downloaded to a directory, stored in a sqlite sidecar file.
+
+        :param path: (str) sqlite filename
+        """
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30,
+                                           check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "filename TEXT PRIMARY KEY, url TEXT, etag TEXT, "
+                "last_modified TEXT, size INTEGER, fetched REAL)")
+
+    def get(self, filename):
+        """
+        :param filename: (str) basename of the downloaded file
+        :return: dict or None
+        """
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT url, etag, last_modified, size, fetched FROM files "
+                "WHERE filename = ?", (filename,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("url", "etag", "last_modified", "size", "fetched"), row))
+
+    def update(self, filename, url=None, etag=None, last_modified=None,
+               size=None):
+        """
+        Records (or replaces) the validators of a downloaded file.
+
+        :param filename: (str) basename of the downloaded file
+        :param url: (str) Full web-address
+        :param etag: (str) ETag response header
+        :param last_modified: (str) Last-Modified response header
+        :param size: (int) size of the file as stored
+        :return: (side effects)
+        """
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                (filename, url, etag, last_modified, size, time.time()))
+
+    def remove(self, filename):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM files WHERE filename = ?",
+                                     (filename,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def get_manifest(directory):
+    """
+    Gets the (per process) Manifest of a download directory.
+
+    :param directory: (str) directory holding the downloaded files
+    :return: Manifest object
+    """
+
+    path = os.path.abspath(os.path.join(directory, MANIFEST_NAME))
+    with _lock:
+        if path not in _manifests:
+            _manifests[path] = Manifest(path)
+        return _manifests[path]
+
+
+def close_manifest(directory):
+    """
+    Closes the Manifest of a directory, if open, e.g. once the directory
+    was removed (the next get_manifest makes a new one).
+
+    :param directory: (str) directory holding the downloaded files
+    :return: (side effects)
+    """
+
+    path = os.path.abspath(os.path.join(directory, MANIFEST_NAME))
+    with _lock:
+        manifest = _manifests.pop(path, None)
+    if manifest is not None:
+        manifest.close()
+
+
+def close_manifests():
+    """
+    Closes every open Manifest.
+
+    :return: (side effects)
+    """
+
+    with _lock:
+        for manifest in _manifests.values():
+            manifest.close()
+        _manifests.clear()
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import time
+import logging
+import threading
+import json as jsonlib
+from urllib.parse import urlparse
+
+from biodownloader.config import config
+
+logger = logging.getLogger("biodownloader")
+
+# upper bounds (seconds) of the timing histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120, 300)
+# timings measured per request (see Trace)
+TIMINGS = ("ttfb", "transfer", "decompress")
+# cache lookup results: response cache or serve-cache proxy hits and
+# misses, and files already available on disk
+CACHE_RESULTS = ("hit", "miss", "local")
+
+COUNTERS = (
+    ("requests_total", "Requests by kind (request or download), source, "
+                       "host and final status."),
+    ("failures_total", "Requests that failed after their retries."),
+    ("retries_total", "Retried attempts."),
+    ("bytes_total", "Bytes received."),
+    ("cache_total", "Cache lookups by result (hit, miss or local)."),
+)
+HISTOGRAMS = (
+    ("ttfb_seconds", "Time to the response headers."),
+    ("transfer_seconds", "Time receiving the response body."),
+    ("decompress_seconds", "Time spent gunzipping the response body."),
+)
+
+_lock = threading.Lock()
+_metrics = None
+
+
+def _host(url):
+    return urlparse(url).netloc.lower()
+
+
+def source_of(url):
+    """
+    Names the data provider of an url after the longest http_* or ftp_*
+    config url it starts with (e.g. 'pdbe' for config.http_pdbe).
+
+    :param url: (str) Full web-address
+    :return: (str) 'other' if the url is not a provider url
+    """
+
+    source, longest = "other", 0
+    for key, value in vars(config).items():
+        if (key.startswith(("http_", "ftp_")) and isinstance(value, str) and
+                len(value) > longest and url.startswith(value)):
+            source, longest = key.split("_", 1)[1], len(value)
+    return source
+
+
+class Trace(object):
+    def __init__(self):
+        """
+        Timings of one attempt at a request: time to first byte, transfer
+        and decompression time, plus what the response reported.
+        """
+
+        self.started = time.perf_counter()
+        self.status = None
+        self.ttfb = None
+        self.transfer = None
+        self.decompress = None
+        self.size = 0
+        self.cache = None
+        self._responded = None
+
+    def responded(self, status=None, headers=None, elapsed=None):
+        """
+        :param status: (int) HTTP status code
+        :param headers: response headers, with X-Cache if served by a
+            serve-cache proxy
+        :param elapsed: (float) seconds to the response headers, if known
+            better than from when the trace started (e.g. requests'
+            Response.elapsed excludes the rate limiting waits)
+        :return: (side effects)
+        """
+
+        self._responded = time.perf_counter()
+        self.ttfb = elapsed if elapsed is not None else \
+            self._responded - self.started
+        self.status = status
+        if headers is not None and headers.get("X-Cache"):
+            self.cache = headers.get("X-Cache").lower()
+
+    def finished(self, size=0, decompress=None):
+        """
+        :param size: (int) bytes received
+        :param decompress: (float) seconds spent decompressing them
+        :return: (side effects)
+        """
+
+        if self._responded is not None:
+            self.transfer = time.perf_counter() - self._responded
+        self.size = size
+        self.decompress = decompress
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    def __init__(self):
+        """
+        Per-request measurements aggregated by source and host, exported as
+        a Prometheus textfile (see write_textfile). Every event is also
+        appended to the JSON-lines file at config.metrics_events, if set.
+        """
+
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._events_path = None
+        self._events = None
+
+    def _count(self, name, labels, value=1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def _emit(self, event):
+        path = config.metrics_events
+        if path != self._events_path:
+            if self._events is not None:
+                self._events.close()
+            self._events = open(path, "a") if path else None
+            self._events_path = path
+        if self._events is not None:
+            self._events.write(jsonlib.dumps(event) + "\n")
+            self._events.flush()
+
+    def record(self, kind, url, source=None, trace=None, ok=True, retries=0,
+               error=None):
+        """
+        Records a request, after its last attempt.
+
+        :param kind: (str) 'request' (API calls) or 'download' (files)
+        :param url: (str) Full web-address
+        :param source: (str) data provider (defaults to source_of(url))
+        :param trace: Trace object of the last attempt
+        :param ok: (boolean) False if the request failed
+        :param retries: (int) attempts before the last one
+        :param error: exception or message of a failed request
+        :return: (dict) the event
+        """
+
+        if trace is None:
+            trace = Trace()
+        source = source or source_of(url)
+        host = _host(url)
+        event = {"time": round(time.time(), 6), "kind": kind,
+                 "source": source, "host": host, "url": url,
+                 "status": trace.status, "ok": ok, "retries": retries,
+                 "bytes": trace.size, "cache": trace.cache,
+                 "error": str(error) if error is not None else None}
+        for timing in TIMINGS:
+            value = getattr(trace, timing)
+            event[timing] = round(value, 6) if value is not None else None
+        with self._lock:
+            status = str(trace.status) if trace.status is not None else \
+                "ok" if ok else "error"
+            self._count("requests_total", (kind, source, host, status))
+            if not ok:
+                self._count("failures_total", (kind, source, host))
+            if retries:
+                self._count("retries_total", (kind, source, host), retries)
+            if trace.size:
+                self._count("bytes_total", (kind, source, host), trace.size)
+            if trace.cache in CACHE_RESULTS:
+                self._count("cache_total", (source, host, trace.cache))
+            for timing in TIMINGS:
+                if event[timing] is not None:
+                    key = (timing + "_seconds", (source, host))
+                    if key not in self._histograms:
+                        self._histograms[key] = Histogram()
+                    self._histograms[key].observe(event[timing])
+            self._emit(event)
+        return event
+
+    def cache(self, url, result, source=None):
+        """
+        Records a cache lookup that did not need a request.
+
+        :param url: (str) Full web-address
+        :param result: (str) one of CACHE_RESULTS
+        :param source: (str) data provider (defaults to source_of(url))
+        :return: (dict) the event
+        """
+
+        source = source or source_of(url)
+        host = _host(url)
+        event = {"time": round(time.time(), 6), "kind": "cache",
+                 "source": source, "host": host, "url": url, "cache": result}
+        with self._lock:
+            self._count("cache_total", (source, host, result))
+            self._emit(event)
+        return event
+
+    def summary(self):
+        """
+        Totals per (source, host).
+
+        :return: (dict) of dicts with requests, downloads, failed, retries,
+            bytes, seconds of ttfb, transfer and decompress, and cache
+            lookups by result
+        """
+
+        totals = {}
+
+        def group(source, host):
+            if (source, host) not in totals:
+                totals[(source, host)] = dict(
+                    {"requests": 0, "downloads": 0, "failed": 0, "retries": 0,
+                     "bytes": 0, "ttfb": 0.0, "transfer": 0.0,
+                     "decompress": 0.0},
+                    **{result: 0 for result in CACHE_RESULTS})
+            return totals[(source, host)]
+
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                if name == "requests_total":
+                    kind = "downloads" if labels[0] == "download" else "requests"
+                    group(*labels[1:3])[kind] += value
+                elif name == "cache_total":
+                    group(*labels[:2])[labels[2]] += value
+                else:
+                    field = {"failures_total": "failed",
+                             "retries_total": "retries",
+                             "bytes_total": "bytes"}[name]
+                    group(*labels[1:3])[field] += value
+            for (name, labels), histogram in self._histograms.items():
+                group(*labels)[name[:-len("_seconds")]] += histogram.sum
+        return totals
+
+    def log_summary(self):
+        """
+        Logs where the time of the run went, per source and host.
+
+        :return: (side effects)
+        """
+
+        totals = self.summary()
+        for (source, host), t in sorted(totals.items()):
+            logger.info("%s (%s): %s requests, %s downloads, %s failed, "
+                        "%s retries, %.1f MB, %.1fs to first byte, "
+                        "%.1fs transfer, %.1fs decompressing, "
+                        "cache %s hit/%s miss/%s local", source, host,
+                        t["requests"], t["downloads"], t["failed"],
+                        t["retries"], t["bytes"] / 1e6, t["ttfb"],
+                        t["transfer"], t["decompress"], t["hit"], t["miss"],
+                        t["local"])
+        logger.info("Run took %.1fs...", time.time() - self.started)
+
+    def textfile(self):
+        """
+        :return: (str) the metrics in the Prometheus text format
+        """
+
+        names = {"requests_total": ("kind", "source", "host", "status"),
+                 "cache_total": ("source", "host", "result")}
+        lines = []
+        with self._lock:
+            for name, description in COUNTERS:
+                lines.append("# HELP biodownloader_{} {}".format(name,
+                                                                 description))
+                lines.append("# TYPE biodownloader_{} counter".format(name))
+                for (key, labels), value in sorted(self._counters.items()):
+                    if key == name:
+                        lines.append("biodownloader_{}{{{}}} {}".format(
+                            name, _labels(names.get(name, ("kind", "source",
+                                                           "host")), labels),
+                            value))
+            for name, description in HISTOGRAMS:
+                lines.append("# HELP biodownloader_{} {}".format(name,
+                                                                 description))
+                lines.append("# TYPE biodownloader_{} histogram".format(name))
+                for (key, labels), histogram in sorted(
+                        self._histograms.items(), key=lambda item: item[0]):
+                    if key != name:
+                        continue
+                    label = _labels(("source", "host"), labels)
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets,
+                                            histogram.counts):
+                        cumulative += count
+                        lines.append('biodownloader_{}_bucket{{{},le="{}"}} {}'
+                                     ''.format(name, label, bound, cumulative))
+                    lines.append('biodownloader_{}_bucket{{{},le="+Inf"}} {}'
+                                 ''.format(name, label, histogram.count))
+                    lines.append("biodownloader_{}_sum{{{}}} {}".format(
+                        name, label, repr(histogram.sum)))
+                    lines.append("biodownloader_{}_count{{{}}} {}".format(
+                        name, label, histogram.count))
+        lines.append("# HELP biodownloader_start_time_seconds Start of the run "
+                     "(seconds since the epoch).")
+        lines.append("# TYPE biodownloader_start_time_seconds gauge")
+        lines.append("biodownloader_start_time_seconds {}".format(
+            repr(self.started)))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """
+        Writes the metrics for the node_exporter textfile collector,
+        replacing the file atomically.
+
+        :param path: (str) filename, usually ending in .prom
+        :return: (side effects)
+        """
+
+        import tempfile
+        fd, partial = tempfile.mkstemp(suffix=".tmp",
+                                       dir=os.path.dirname(path) or ".")
+        with os.fdopen(fd, "w") as f:
+            f.write(self.textfile())
+        os.chmod(partial, 0o644)
+        os.replace(partial, path)
+
+    def close(self):
+        with self._lock:
+            if self._events is not None:
+                self._events.close()
+            self._events = None
+            self._events_path = None
+
+
+def _labels(names, values):
+    return ",".join('{}="{}"'.format(name, str(value).replace(
+        "\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values))
+
+
+def get_metrics():
+    """
+    Gets the (per process) Metrics.
+
+    :return: Metrics object
+    """
+
+    global _metrics
+
+    with _lock:
+        if _metrics is None:
+            _metrics = Metrics()
+        return _metrics
+
+
+def reset_metrics():
+    """
+    Closes the events file and starts the metrics over.
+
+    :return: (side effects)
+    """
+
+    global _metrics
+
+    with _lock:
+        if _metrics is not None:
+            _metrics.close()
+        _metrics = None
+
+
+def report():
+    """
+    End of run: logs the summary and writes config.metrics_textfile, if set.
+
+    :return: (side effects)
+    """
+
+    metrics = get_metrics()
+    metrics.log_summary()
+    if config.metrics_textfile:
+        metrics.write_textfile(config.metrics_textfile)
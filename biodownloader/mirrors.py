@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from biodownloader.config import config
+from biodownloader.session import get_session
+
+logger = logging.getLogger("biodownloader")
+
+_lock = threading.Lock()
+_registries = {}
+
+
+class Mirror(object):
+    def __init__(self, name, templates):
+        """
+        A site serving the files of a resource, with its health record.
+
+        :param name: (str) mirror name
+        :param templates: (dict) url template per file format, with the
+            {id}, {mid} (middle two characters of the ID), {assembly_id}
+            and {http_pdbe} fields
+        """
+
+        self.name = name
+        self.templates = templates
+        self.latency = None
+        self.failures = 0
+        self.down_until = 0.0
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.down_until
+
+    @property
+    def root(self):
+        url = urlparse(self.url(next(iter(self.templates)), "0000"))
+        return "{}://{}/".format(url.scheme, url.netloc)
+
+    def url(self, file_format, identifier, assembly_id="1"):
+        """
+        :param file_format: (str) pdb, mmcif or bio for structures
+        :param identifier: (str) accession ID
+        :param assembly_id: (str) assembly, for bio
+        :return: (str) Full web-address or None if not served by the mirror
+        """
+
+        template = self.templates.get(file_format)
+        if template is None:
+            return None
+        return template.format(id=identifier, mid=identifier[1:3],
+                               assembly_id=assembly_id,
+                               http_pdbe=config.http_pdbe)
+
+    def score(self):
+        # unknown latencies rank after the measured ones
+        latency = self.latency if self.latency is not None else float("inf")
+        return latency * (1 + self.failures)
+
+
+class MirrorRegistry(object):
+    def __init__(self, mirrors):
+        """
+        Mirrors of a resource, ranked by their measured latency and
+        recent failures.
+
+        :param mirrors: (dict) url templates per mirror name (in order of
+            preference, see Mirror)
+        """
+
+        self._lock = threading.Lock()
+        self.mirrors = OrderedDict((name, Mirror(name, templates))
+                                   for name, templates in mirrors.items())
+
+    def probe(self):
+        """
+        Measures the latency of every mirror with a HEAD request to its
+        root, in parallel. Unreachable mirrors are recorded as failures.
+
+        :return: (side effects)
+        """
+
+        def probe(mirror):
+            started = time.monotonic()
+            try:
+                get_session().head(mirror.root, timeout=(config.connect_timeout,
+                                                         config.read_timeout))
+            except Exception as e:
+                logger.debug("Unable to probe %s for %s", mirror.root, e)
+                self.record(mirror, ok=False)
+            else:
+                self.record(mirror, ok=True,
+                            latency=time.monotonic() - started)
+
+        threads = [threading.Thread(target=probe, args=(mirror,))
+                   for mirror in self.mirrors.values()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        logger.info("Mirror latencies: %s", ", ".join(
+            "{} {}".format(m.name, "-" if m.latency is None else
+                           "{:.0f} ms".format(m.latency * 1000))
+            for m in self.ranked()))
+
+    def ranked(self):
+        """
+        :return: list of Mirror, healthy ones first, fastest first
+        """
+
+        with self._lock:
+            mirrors = list(self.mirrors.values())
+            return sorted(mirrors, key=lambda m: (not m.healthy, m.score()))
+
+    def record(self, mirror, ok, latency=None):
+        """
+        Updates the health record of a mirror after a request. Mirrors are
+        skipped for config.mirror_cooldown seconds after
+        config.mirror_max_failures consecutive failures.
+
+        :param mirror: Mirror object
+        :param ok: (boolean) the request succeeded
+        :param latency: (float) seconds the request took
+        :return: (side effects)
+        """
+
+        with self._lock:
+            if ok:
+                mirror.failures = 0
+                mirror.down_until = 0.0
+                if latency is not None:
+                    mirror.latency = (latency if mirror.latency is None else
+                                      0.7 * mirror.latency + 0.3 * latency)
+            else:
+                mirror.failures += 1
+                if mirror.failures >= config.mirror_max_failures:
+                    mirror.down_until = time.monotonic() + config.mirror_cooldown
+                    logger.warning("Mirror %s is failing, skipping it for %s "
+                                   "seconds...", mirror.name,
+                                   config.mirror_cooldown)
+
+
+def get_mirror_registry(resource="structures"):
+    """
+    Gets the (per process) MirrorRegistry of a resource in config.mirrors,
+    probed when first used if config.mirror_probe is set.
+
+    :param resource: (str) key in config.mirrors
+    :return: MirrorRegistry object
+    """
+
+    with _lock:
+        registry = _registries.get(resource)
+        if registry is None:
+            registry = MirrorRegistry(config.mirrors[resource])
+            if config.mirror_probe:
+                registry.probe()
+            _registries[resource] = registry
+        return registry
+
+
+def reset_mirrors():
+    """
+    Forgets the mirror registries (and their health records).
+
+    :return: (side effects)
+    """
+
+    with _lock:
+        _registries.clear()
@@ -0,0 +1,648 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+import json as jsonlib
+from urllib.parse import urlsplit
+from socketserver import ThreadingMixIn
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from biodownloader.config import config
+from biodownloader.session import get_session, get_ftp_opener
+from biodownloader.ratelimit import throttle
+
+logger = logging.getLogger("biodownloader")
+
+CHUNK_SIZE = 64 * 1024
+# upstream response headers stored with each entry and sent to clients
+STORED_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+# upstream error response headers passed on to clients
+ERROR_HEADERS = ("Content-Type", "Retry-After")
+
+
+class ProxyStore(object):
+    def __init__(self, directory, max_size=50 * 1024 ** 3, ttl=24 * 3600):
+        """
+        Upstream responses stored as files in a directory, with their
+        headers and expiry times in a sqlite file. The least recently used
+        files are evicted when the total size grows beyond max_size.
+
+        :param directory: (str) cache directory
+        :param max_size: (int) size cap in bytes
+        :param ttl: (int) seconds before an entry is revalidated upstream
+        """
+
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(
+            os.path.join(directory, "entries.sqlite"), timeout=30,
+            check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, url TEXT, headers TEXT, size INTEGER, "
+                "expires REAL, accessed REAL)")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_accessed "
+                "ON entries (accessed)")
+        self._size = self._total_size()
+
+    def _total_size(self):
+        row = self._connection.execute("SELECT SUM(size) FROM entries").fetchone()
+        return row[0] or 0
+
+    def filename(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """
+        :param key: (str) cache key
+        :return: dict (url, headers, size, expires) or None
+        """
+
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT url, headers, size, expires FROM entries WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE entries SET accessed = ? WHERE key = ?",
+                (time.time(), key))
+        return {"url": row[0], "headers": jsonlib.loads(row[1]),
+                "size": row[2], "expires": row[3]}
+
+    def put(self, key, url, headers, filename):
+        """
+        Moves a fetched file into the store.
+
+        :param key: (str) cache key
+        :param url: (str) upstream url
+        :param headers: (dict) response headers (see STORED_HEADERS)
+        :param filename: (str) temporary file with the response body
+        :return: (side effects)
+        """
+
+        size = os.path.getsize(filename)
+        target = self.filename(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            os.replace(filename, target)
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (key, url, jsonlib.dumps(headers), size,
+                 time.time() + self.ttl, time.time()))
+            self._size += size - (row[0] if row else 0)
+            if self._size > self.max_size:
+                self._evict(keep=key)
+
+    def touch(self, key):
+        # revalidated upstream, good for another ttl
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE entries SET expires = ? WHERE key = ?",
+                (time.time() + self.ttl, key))
+
+    def _evict(self, keep=None):
+        target = int(self.max_size * 0.9)
+        rows = self._connection.execute(
+            "SELECT key, size FROM entries ORDER BY accessed").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            if key == keep:
+                continue
+            try:
+                # readers holding the file open can still finish
+                os.remove(self.filename(key))
+            except OSError:
+                pass
+            evicted.append((key,))
+            self._size -= size
+        self._connection.executemany("DELETE FROM entries WHERE key = ?",
+                                     evicted)
+        logger.debug("Evicted %s entries from %s", len(evicted), self.directory)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class _Fill(object):
+    def __init__(self, partial):
+        """
+        Upstream response being stored, streamed to every client asking
+        for it meanwhile. Clients read the partial file as it is written,
+        then the stored file once it has been moved into the store.
+
+        :param partial: (str) temporary file the body is written to
+        """
+
+        self.partial = partial
+        self.target = None
+        self.headers = None
+        self.size = None
+        self.error = None
+        self.not_modified = False
+        self.written = 0
+        self.done = False
+        self.responded = threading.Event()
+        self._condition = threading.Condition()
+
+    def respond(self, headers=None, size=None, error=None,
+                not_modified=False):
+        """
+        :param headers: (dict) stored response headers
+        :param size: (int) body size, if upstream sent it
+        :param error: tuple (status, headers, body) if upstream did not
+            return the file
+        :param not_modified: (boolean) the stored entry is still valid
+        :return: (side effects)
+        """
+
+        if self.responded.is_set():
+            return
+        self.headers, self.size = headers, size
+        self.error, self.not_modified = error, not_modified
+        self.responded.set()
+
+    def wrote(self, written):
+        with self._condition:
+            self.written = written
+            self._condition.notify_all()
+
+    def commit(self, store, key, url, written):
+        # moved while readers are kept out of open()
+        with self._condition:
+            store.put(key, url, self.headers, self.partial)
+            self.target = store.filename(key)
+            self.written = written
+            self.done = True
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self.done = True
+            self._condition.notify_all()
+        if os.path.exists(self.partial):
+            os.remove(self.partial)
+        self.respond(error=(502, {}, b""))
+
+    def open(self):
+        with self._condition:
+            if not self.done:
+                return open(self.partial, "rb")
+            if self.target is None:
+                raise IOError("Unable to retrieve {}".format(self.partial))
+            return open(self.target, "rb")
+
+    def wait(self, offset):
+        """
+        Waits for bytes after offset to be written.
+
+        :param offset: (int) bytes already read
+        :return: (int) bytes written so far, or None if the fill failed
+        """
+
+        with self._condition:
+            while self._available() <= offset and not self.done:
+                self._condition.wait()
+            if self.done and self.target is None:
+                return None
+            return self._available()
+
+    def _available(self):
+        # the last byte only once the entry is stored, so a client that
+        # has read the whole body finds it in the store
+        if self.done or self.size is None:
+            return self.written
+        return min(self.written, self.size - 1)
+
+
+class CachingProxy(object):
+    def __init__(self, store, upstreams=None):
+        """
+        Read-through cache of upstream urls. Concurrent misses for the same
+        url are coalesced into a single upstream request, whose response
+        is streamed to the clients while it is stored.
+
+        :param store: ProxyStore object
+        :param upstreams: (dict) upstream urls keyed by config key (defaults
+            to the http_* and ftp_* config urls when the proxy is created)
+        """
+
+        self.store = store
+        self.upstreams = upstreams if upstreams is not None else _upstreams()
+        self.upstream_requests = 0
+        self._lock = threading.Lock()
+        self._fills = {}
+
+    def upstream(self, path):
+        """
+        Maps a proxy path to the upstream url, the first path component
+        being the config key of the upstream (e.g. /http_pdbe/api/... for
+        config.http_pdbe + 'api/...').
+
+        :param path: (str) request path, with its query string
+        :return: (str) url or None if not a known upstream
+        """
+
+        parts = urlsplit(path)
+        key, _, rest = parts.path.lstrip("/").partition("/")
+        base = self.upstreams.get(key)
+        if base is None:
+            return None
+        url = base + rest
+        if parts.query:
+            url += "?" + parts.query
+        return url
+
+    def lookup(self, url):
+        """
+        Gets the stored response for an url, fetching it upstream if it is
+        missing or expired. A response still being fetched is returned as
+        soon as upstream answers, with the _Fill to read it from under
+        'fill'.
+
+        :param url: (str) upstream url
+        :return: tuple (key, entry, error, hit) where error is a tuple
+            (status, headers, body) if upstream did not return the file
+        """
+
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        entry = self.store.get(key)
+        if entry is not None and entry["expires"] >= time.time():
+            return key, entry, None, True
+
+        with self._lock:
+            fill = self._fills.get(key)
+            if fill is None:
+                fd, partial = tempfile.mkstemp(dir=self.store.directory,
+                                               suffix=".part")
+                os.close(fd)
+                fill = self._fills[key] = _Fill(partial)
+                self.upstream_requests += 1
+                # not tied to the client, which may go away midway
+                thread = threading.Thread(target=self._fill,
+                                          args=(key, url, fill, entry))
+                thread.daemon = True
+                thread.start()
+        fill.responded.wait()
+        if fill.error is not None:
+            if entry is not None and fill.error[0] >= 500:
+                logger.debug("Serving a stale copy of %s", url)
+                return key, entry, None, True
+            return key, None, fill.error, False
+        if fill.not_modified:
+            return key, self.store.get(key), None, False
+        return key, {"url": url, "headers": fill.headers, "size": fill.size,
+                     "fill": fill}, None, False
+
+    def _fill(self, key, url, fill, entry=None):
+        try:
+            self._fetch(key, url, fill, entry)
+        except Exception as e:
+            logger.warning("Unable to retrieve %s: %s", url, e)
+            fill.respond(error=(502, {"Content-Type": "text/plain"},
+                                str(e).encode("utf-8")))
+        finally:
+            with self._lock:
+                del self._fills[key]
+            fill.close()
+
+    def _fetch(self, key, url, fill, entry=None):
+        throttle(url)
+        logger.info("Fetching %s ...", url)
+        with open(fill.partial, "wb") as outfile:
+            if not url.startswith("http"):
+                with get_ftp_opener().open(
+                        url, timeout=config.read_timeout) as response:
+                    fill.respond(headers={})
+                    written = _copy(iter(lambda: response.read(CHUNK_SIZE),
+                                         b""), outfile, fill)
+            else:
+                header = {"Accept-Encoding": "identity"}
+                if entry is not None:
+                    validators = entry["headers"]
+                    if "ETag" in validators:
+                        header["If-None-Match"] = validators["ETag"]
+                    if "Last-Modified" in validators:
+                        header["If-Modified-Since"] = \
+                            validators["Last-Modified"]
+                with get_session().get(
+                        url, headers=header, stream=True,
+                        timeout=(config.connect_timeout,
+                                 config.read_timeout)) as response:
+                    if response.status_code == 304 and entry is not None:
+                        self.store.touch(key)
+                        fill.respond(not_modified=True)
+                        return
+                    if response.status_code != 200:
+                        fill.respond(error=(
+                            response.status_code,
+                            {h: response.headers[h] for h in ERROR_HEADERS
+                             if h in response.headers},
+                            response.content))
+                        return
+                    size = response.headers.get("Content-Length")
+                    if "Content-Encoding" in response.headers:
+                        # decoded by requests, so the length would not match
+                        size = None
+                    fill.respond(headers={h: response.headers[h]
+                                          for h in STORED_HEADERS
+                                          if h in response.headers},
+                                 size=int(size) if size is not None else None)
+                    written = _copy(_chunks(response), outfile, fill)
+        if fill.size is not None and written != fill.size:
+            raise IOError("Expected {} bytes from {}, got {}".format(
+                fill.size, url, written))
+        fill.commit(self.store, key, url, written)
+
+    def forward(self, url, body, headers):
+        """
+        Passes a request with a body (e.g. POST) upstream, without caching.
+
+        :return: tuple (status, headers, body)
+        """
+
+        throttle(url)
+        response = get_session().post(url, data=body, headers=headers,
+                                      timeout=(config.connect_timeout,
+                                               config.read_timeout))
+        return (response.status_code,
+                {h: response.headers[h] for h in ERROR_HEADERS
+                 if h in response.headers},
+                response.content)
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug("%s - " + format, self.address_string(), *args)
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def do_POST(self):
+        proxy = self.server.proxy
+        url = proxy.upstream(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if url is None:
+            return self._respond(404, {}, b"Unknown upstream")
+        header = {}
+        if "Content-Type" in self.headers:
+            header["Content-Type"] = self.headers["Content-Type"]
+        try:
+            self._respond(*proxy.forward(url, body, header))
+        except Exception as e:
+            self._respond(502, {}, str(e).encode("utf-8"))
+
+    def _respond(self, status, headers, content, body=True):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+    def _range(self, size):
+        # (start, end) of a single 'bytes=start-[end]' range, None for the
+        # whole file, or False if it can not be satisfied
+        value = self.headers.get("Range")
+        if not value or not value.startswith("bytes=") or "," in value:
+            return None
+        start, _, end = value[len("bytes="):].partition("-")
+        try:
+            if not start:
+                start, end = max(0, size - int(end)), size - 1
+            else:
+                start = int(start)
+                end = min(int(end), size - 1) if end else size - 1
+        except ValueError:
+            return None
+        if start > end or start >= size:
+            return False
+        return start, end
+
+    def _not_modified(self, headers):
+        etag = self.headers.get("If-None-Match")
+        if etag is not None:
+            return etag == headers.get("ETag")
+        since = self.headers.get("If-Modified-Since")
+        return since is not None and since == headers.get("Last-Modified")
+
+    def _serve(self, body=True):
+        proxy = self.server.proxy
+        url = proxy.upstream(self.path)
+        if url is None:
+            return self._respond(404, {}, b"Unknown upstream", body=body)
+        key, entry, error, hit = proxy.lookup(url)
+        if error is not None:
+            return self._respond(*error, body=body)
+        fill = entry.get("fill") if entry is not None else None
+        try:
+            if entry is None:
+                raise IOError(key)
+            if fill is not None:
+                infile = fill.open()
+            else:
+                infile = open(proxy.store.filename(key), "rb")
+        except OSError:
+            # evicted (or failed upstream) in the meantime
+            return self._respond(503, {"Retry-After": "0"}, b"", body=body)
+
+        with infile:
+            headers = dict(entry["headers"])
+            headers["X-Cache"] = "HIT" if hit else "MISS"
+            if self._not_modified(headers):
+                return self._respond(304, headers, b"", body=False)
+            size = entry["size"]
+            if size is None:
+                # still being fetched, of unknown length: the body ends
+                # with the connection
+                self.close_connection = True
+                self.send_response(200)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Connection", "close")
+                self.end_headers()
+                if body:
+                    self._send(infile, 0, None, fill=fill)
+                return
+            status, start, end = 200, 0, size - 1
+            requested = self._range(size)
+            if requested is False:
+                headers["Content-Range"] = "bytes */{}".format(size)
+                return self._respond(416, headers, b"", body=body)
+            elif requested is not None:
+                status, (start, end) = 206, requested
+                headers["Content-Range"] = "bytes {}-{}/{}".format(start, end,
+                                                                   size)
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end + 1 - start))
+            self.end_headers()
+            if body:
+                self._send(infile, start, end + 1, fill=fill)
+
+    def _send(self, infile, start, end, fill=None):
+        # bytes start to end (None for all) of a file, waiting for them if
+        # the file is still being fetched
+        infile.seek(start)
+        position = start
+        while end is None or position < end:
+            available = end
+            if fill is not None:
+                written = fill.wait(position)
+                if written is None:
+                    # failed upstream, the client gets a short body
+                    self.close_connection = True
+                    return
+                if written <= position:
+                    return
+                available = written if end is None else min(written, end)
+            chunk = infile.read(min(CHUNK_SIZE, available - position))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            position += len(chunk)
+
+
+class ProxyServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, proxy):
+        """
+        Threaded HTTP server of a CachingProxy.
+
+        :param address: tuple (host, port)
+        :param proxy: CachingProxy object
+        """
+
+        HTTPServer.__init__(self, address, ProxyHandler)
+        self.proxy = proxy
+
+
+def _chunks(response):
+    # whatever has arrived, rather than waiting for whole chunks
+    # (urllib3 < 2 has no read1)
+    read = getattr(response.raw, "read1", None)
+    if read is None:
+        return response.iter_content(chunk_size=CHUNK_SIZE)
+    return iter(lambda: read(CHUNK_SIZE, decode_content=True), b"")
+
+
+def _copy(chunks, outfile, fill):
+    written = 0
+    for chunk in chunks:
+        outfile.write(chunk)
+        outfile.flush()
+        written += len(chunk)
+        fill.wrote(written)
+    return written
+
+
+def _upstreams():
+    return {key: value for key, value in vars(config).items()
+            if key.startswith(("http_", "ftp_")) and isinstance(value, str)}
+
+
+def proxy_dir():
+    if config.proxy_dir is not None:
+        return os.path.abspath(config.proxy_dir)
+    return os.path.abspath(os.path.join(config.db_root, "proxy-cache"))
+
+
+def make_server(host=None, port=None, directory=None, max_size=None):
+    """
+    Builds a caching proxy server, not yet serving.
+
+    :param host: (str) address to listen on (defaults to config.proxy_host)
+    :param port: (int) port (defaults to config.proxy_port, 0 picks one)
+    :param directory: (str) cache directory (defaults to config.proxy_dir)
+    :param max_size: (int) size cap in bytes (defaults to
+        config.proxy_max_size)
+    :return: ProxyServer object
+    """
+
+    store = ProxyStore(directory or proxy_dir(),
+                       max_size=max_size or config.proxy_max_size,
+                       ttl=config.proxy_ttl)
+    address = (host or config.proxy_host,
+               config.proxy_port if port is None else port)
+    return ProxyServer(address, CachingProxy(store))
+
+
+def serve(host=None, port=None, directory=None, max_size=None):
+    """
+    Runs a caching proxy server until interrupted (see make_server).
+
+    :return: (side effects)
+    """
+
+    server = make_server(host=host, port=port, directory=directory,
+                         max_size=max_size)
+    logger.info("Serving %s on http://%s:%s/ ...", server.proxy.store.directory,
+                *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.proxy.store.close()
+
+
+def route_through(url):
+    """
+    Points every http_* and ftp_* config url at a caching proxy, e.g.
+    config.http_pdbe becomes <url>/http_pdbe/.
+
+    :param url: (str) address of the proxy (e.g. http://node1:8008)
+    :return: (side effects)
+    """
+
+    url = url.rstrip("/")
+    for key, value in _upstreams().items():
+        if not value.startswith(url + "/"):
+            setattr(config, key, "{}/{}{}".format(
+                url, key, "/" if value.endswith("/") else ""))
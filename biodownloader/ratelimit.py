@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import logging
+import threading
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from biodownloader.config import config
+
+logger = logging.getLogger("biodownloader")
+
+_lock = threading.Lock()
+_limiters = {}
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=1):
+        """
+        Token bucket shared by the threads of a process. Tokens are added
+        at `rate` per second, up to `burst`, and each request takes one.
+
+        :param rate: (float) requests per second
+        :param burst: (int) requests allowed back to back
+        """
+
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    def reserve(self):
+        """
+        Takes a token, leaving the balance negative if none is available.
+
+        :return: (float) seconds to wait before sending the request
+        """
+
+        with self._lock:
+            self._tokens, self._updated, wait = self._take(
+                self._tokens, self._updated, time.monotonic())
+        return wait
+
+    def _take(self, tokens, updated, now):
+        tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+        wait = -tokens / self.rate if tokens < 0 else 0.0
+        return tokens, now, wait
+
+
+class FileTokenBucket(TokenBucket):
+    def __init__(self, path, rate, burst=1):
+        """
+        Token bucket shared by every process on a host: the balance is kept
+        in a small file, updated under an exclusive lock (fcntl.flock).
+
+        :param path: (str) state filename
+        :param rate: (float) requests per second
+        :param burst: (int) requests allowed back to back
+        """
+
+        super(FileTokenBucket, self).__init__(rate, burst=burst)
+        self.path = path
+
+    def reserve(self):
+        # wall clock time, as the monotonic clock is not shared by processes
+        with self._lock, open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    tokens, updated = [float(v) for v in f.read().split()]
+                except ValueError:
+                    tokens, updated = float(self.burst), time.time()
+                tokens, updated, wait = self._take(tokens, updated, time.time())
+                f.seek(0)
+                f.truncate()
+                f.write("{!r} {!r}".format(tokens, updated))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return wait
+
+
+def _host(url):
+    return urlparse(url).netloc.lower()
+
+
+def get_rate_limiter(url):
+    """
+    Gets the (per process) TokenBucket of the host in url.
+
+    Limits are set per host in config.rate_limits, keyed on the config key
+    of the host (e.g. {"http_pdbe": (10, 20)} for 10 requests per second in
+    bursts of up to 20). With config.rate_limit_dir set, the buckets are
+    shared with the other processes using that directory.
+
+    :param url: (str) Full web-address
+    :return: TokenBucket object or None if the host is not limited
+    """
+
+    host = _host(url)
+    with _lock:
+        if host not in _limiters:
+            limiter = None
+            for key, limit in config.rate_limits.items():
+                if limit and _host(getattr(config, key)) == host:
+                    rate, burst = limit
+                    if config.rate_limit_dir is not None and fcntl is not None:
+                        os.makedirs(config.rate_limit_dir, exist_ok=True)
+                        path = os.path.join(config.rate_limit_dir,
+                                            "{}.bucket".format(host))
+                        limiter = FileTokenBucket(path, rate, burst=burst)
+                    else:
+                        limiter = TokenBucket(rate, burst=burst)
+                    break
+            _limiters[host] = limiter
+        return _limiters[host]
+
+
+def reserve(url):
+    """
+    Takes a token from the host's bucket.
+
+    :param url: (str) Full web-address
+    :return: (float) seconds to wait before requesting url
+    """
+
+    limiter = get_rate_limiter(url)
+    if limiter is None:
+        return 0.0
+    wait = limiter.reserve()
+    if wait > 0:
+        logger.debug("Rate limiting %s for %.2f seconds...", _host(url), wait)
+    return wait
+
+
+def throttle(url):
+    """
+    Blocks until a request to url is allowed by the host's rate limit.
+
+    :param url: (str) Full web-address
+    :return: (side effects)
+    """
+
+    wait = reserve(url)
+    if wait > 0:
+        time.sleep(wait)
+
+
+def reset_rate_limiters():
+    """
+    Drops the per-host buckets, so the next request picks up any changes
+    to config.rate_limits or config.rate_limit_dir.
+
+    :return: (side effects)
+    """
+
+    with _lock:
+        _limiters.clear()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import time
+import socket
+import ftplib
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from biodownloader.config import config
+
+logger = logging.getLogger("biodownloader")
+
+_lock = threading.Lock()
+_policy = None
+# policies scoped to a thread (see scope)
+_local = threading.local()
+
+
+class RetryPolicy(object):
+    def __init__(self, max_retries=None, backoff=None, backoff_cap=None,
+                 budget=None, statuses=None, window=None):
+        """
+        Decides whether and when a failed request is tried again.
+
+        Waits grow exponentially (backoff * 2 ** attempt, capped at
+        backoff_cap) with full jitter, unless the server sends Retry-After.
+        Every retry is taken from a budget shared by all requests, so a
+        struggling server is not hammered for the whole run. Long-lived
+        processes regain the budget over a time window instead.
+
+        :param max_retries: (int) retries per request (config.retry_max)
+        :param backoff: (float) base wait in seconds (config.retry_backoff)
+        :param backoff_cap: (float) maximum wait in seconds
+            (config.retry_backoff_cap)
+        :param budget: (int) retries left for the run (config.retry_budget)
+        :param statuses: HTTP status codes retried when none are given
+            (config.retry_statuses)
+        :param window: (float) seconds to regain a spent budget, None for
+            a budget that lasts the whole run
+        """
+
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.budget = budget
+        self.statuses = statuses
+        self.window = window
+        if self.max_retries is None:
+            self.max_retries = config.retry_max
+        if self.backoff is None:
+            self.backoff = config.retry_backoff
+        if self.backoff_cap is None:
+            self.backoff_cap = config.retry_backoff_cap
+        if self.budget is None:
+            self.budget = config.retry_budget
+        if self.statuses is None:
+            self.statuses = tuple(config.retry_statuses)
+        self._capacity = self.budget
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+
+    def retryable(self, error=None, status_code=None, retry_in=None):
+        """
+        :param error: exception raised by the request, if any
+        :param status_code: (int) HTTP status code, if any
+        :param retry_in: HTTP status codes worth retrying (defaults to
+            self.statuses)
+        :return: (boolean)
+        """
+
+        if retry_in is None:
+            retry_in = self.statuses
+        if error is not None:
+            status_code = _status_code(error)
+            if status_code is None:
+                return _transient(error)
+        return status_code in retry_in
+
+    def delay(self, attempt, headers=None, backoff=None):
+        """
+        :param attempt: (int) number of retries already made
+        :param headers: response headers, checked for Retry-After
+        :param backoff: (float) base wait overriding self.backoff
+        :return: (float) seconds to wait
+        """
+
+        retry_after = _retry_after(headers)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_cap)
+        if backoff is None:
+            backoff = self.backoff
+        return random.uniform(0, min(self.backoff_cap, backoff * 2 ** attempt))
+
+    def next_delay(self, attempt, error=None, status_code=None, headers=None,
+                   retry_in=None, max_retries=None, backoff=None):
+        """
+        Takes one retry from the budget if the failure is worth retrying.
+
+        :param attempt: (int) number of retries already made
+        :param error: exception raised by the request, if any
+        :param status_code: (int) HTTP status code, if any
+        :param headers: response headers, checked for Retry-After
+        :param retry_in: HTTP status codes worth retrying
+        :param max_retries: (int) overrides self.max_retries
+        :param backoff: (float) overrides self.backoff
+        :return: (float) seconds to wait, or None to give up
+        """
+
+        if max_retries is None:
+            max_retries = self.max_retries
+        if attempt >= max_retries:
+            return None
+        if not self.retryable(error=error, status_code=status_code,
+                              retry_in=retry_in):
+            return None
+        with self._lock:
+            if self.window:
+                now = time.monotonic()
+                self.budget = min(self._capacity, self.budget + (
+                    now - self._refilled) * self._capacity / self.window)
+                self._refilled = now
+            if self.budget < 1:
+                logger.warning("Retry budget exhausted, not retrying...")
+                return None
+            self.budget -= 1
+        if headers is None and error is not None:
+            headers = _headers(error)
+        return self.delay(attempt, headers=headers, backoff=backoff)
+
+
+def _aiohttp():
+    # aiohttp errors only come from biodownloader.aio, which imports it, so
+    # the (slow) import is not needed to classify them
+    return sys.modules.get("aiohttp")
+
+
+def _timeouts():
+    asyncio = sys.modules.get("asyncio")
+    if asyncio is None:
+        return (TimeoutError,)
+    return (TimeoutError, asyncio.TimeoutError)
+
+
+def _causes(error):
+    # the error and everything it wraps (requests, urllib3, urllib and
+    # aiohttp keep the underlying socket error in different places)
+    seen = set()
+    stack = [error]
+    while stack:
+        e = stack.pop()
+        if not isinstance(e, BaseException) or id(e) in seen:
+            continue
+        seen.add(id(e))
+        yield e
+        stack.extend([e.__cause__, e.__context__, getattr(e, "reason", None),
+                      getattr(e, "os_error", None)])
+        stack.extend(getattr(e, "args", ()))
+
+
+def _transient(error):
+    causes = list(_causes(error))
+    aiohttp = _aiohttp()
+    for e in causes:
+        if isinstance(e, socket.gaierror):
+            # unknown hosts won't resolve on the next attempt either
+            return e.errno == socket.EAI_AGAIN
+    for e in causes:
+        if isinstance(e, requests.exceptions.SSLError):
+            return False
+        if aiohttp is not None and isinstance(e, aiohttp.ClientSSLError):
+            return False
+    for e in causes:
+        if isinstance(e, (requests.exceptions.ConnectionError,
+                          requests.exceptions.Timeout,
+                          requests.exceptions.ChunkedEncodingError,
+                          ConnectionError, ftplib.error_temp) + _timeouts()):
+            return True
+        if aiohttp is not None and isinstance(
+                e, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
+            return True
+    return False
+
+
+def _status_code(error):
+    # requests.HTTPError, aiohttp.ClientResponseError, urllib HTTPError
+    response = getattr(error, "response", None)
+    if response is not None:
+        return getattr(response, "status_code", None)
+    aiohttp = _aiohttp()
+    if aiohttp is not None and isinstance(error, aiohttp.ClientResponseError):
+        return error.status
+    return getattr(error, "code", None) if hasattr(error, "headers") else None
+
+
+def _headers(error):
+    response = getattr(error, "response", None)
+    if response is not None:
+        return getattr(response, "headers", None)
+    return getattr(error, "headers", None)
+
+
+def _retry_after(headers):
+    if not headers:
+        return None
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_retry_policy():
+    """
+    Gets the RetryPolicy (and retry budget) shared by every request
+    of this process, or the one of the current thread (see scope).
+
+    :return: RetryPolicy object
+    """
+
+    global _policy
+
+    scoped = getattr(_local, "policy", None)
+    if scoped is not None:
+        return scoped
+    if _policy is None:
+        with _lock:
+            if _policy is None:
+                _policy = RetryPolicy()
+    return _policy
+
+
+def reset_retry_policy():
+    """
+    Drops the shared RetryPolicy, so the next call to get_retry_policy
+    picks up any changes to the retry_* config keys (and a new budget).
+
+    :return: (side effects)
+    """
+
+    global _policy
+
+    with _lock:
+        _policy = None
+
+
+@contextmanager
+def scope(policy):
+    """
+    Uses a RetryPolicy of its own (e.g. the daemon's) for the requests
+    made by the current thread, instead of the one of the process.
+
+    :param policy: RetryPolicy object
+    :return: (side effects)
+    """
+
+    previous = getattr(_local, "policy", None)
+    _local.policy = policy
+    try:
+        yield policy
+    finally:
+        _local.policy = previous
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import threading
+import urllib.request
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from biodownloader.config import config
+
+logger = logging.getLogger("biodownloader")
+
+_lock = threading.Lock()
+_session = None
+_local = threading.local()
+
+
+def get_session():
+    """
+    Gets the requests session shared by Fetcher and Downloader.
+
+    The session keeps connections alive and pools them per host, according
+    to the http_pool_* config keys read when the session is first created.
+
+    :return: requests.Session
+    """
+
+    global _session
+
+    if _session is None:
+        with _lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=config.http_pool_connections,
+                                      pool_maxsize=config.http_pool_maxsize,
+                                      pool_block=config.http_pool_block)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def get_ftp_opener():
+    """
+    Gets a urllib opener that keeps FTP connections open between transfers.
+
+    urllib's FTP connection cache is not thread-safe, so each thread gets
+    its own opener (and its own connections).
+
+    :return: urllib.request.OpenerDirector
+    """
+
+    opener = getattr(_local, "ftp_opener", None)
+    if opener is None:
+        handler = urllib.request.CacheFTPHandler()
+        handler.setMaxConns(config.ftp_max_connections)
+        opener = urllib.request.build_opener(handler)
+        _local.ftp_opener = opener
+    return opener
+
+
+def reset_session():
+    """
+    Closes the shared session so the next call to get_session picks up
+    any changes to the http_pool_* config keys.
+
+    :return: (side effects)
+    """
+
+    global _session
+
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+    _local.ftp_opener = None
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+
+
+class _Flight(object):
+    def __init__(self):
+        """
+        Call in progress, shared by every caller with the same key.
+        """
+
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    def __init__(self):
+        """
+        Runs at most one call per key at a time. Callers arriving while a
+        call is in flight wait for it and get the same result (or the
+        same exception) instead of running it again.
+        """
+
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._flights)
+
+    def do(self, key, function):
+        """
+        :param key: hashable key of the call
+        :param function: callable without arguments
+        :return: what function returned
+        """
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+        if leader:
+            try:
+                flight.result = function()
+            except Exception as e:
+                flight.error = e
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import zlib
+import struct
+import logging
+
+from biodownloader.config import config
+
+logger = logging.getLogger("biodownloader")
+
+# storage codecs of the downloaded files and the suffix each one adds
+CODECS = ("plain", "gzip", "zstd", "bgzf")
+SUFFIXES = {"plain": "", "gzip": ".gz", "zstd": ".zst", "bgzf": ".gz"}
+
+# uncompressed bytes per BGZF block, as in htslib
+BGZF_BLOCK_SIZE = 0xff00
+# empty block marking the end of a BGZF file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000"
+                         "000000")
+
+
+def storage_codec(source=None):
+    """
+    Gets the codec files from a source are stored with.
+
+    :param source: (str) e.g. pdbe, sifts, uniprot, cath or pfam
+    :return: (str) config.storage_codecs of the source, otherwise
+        config.storage_codec
+    """
+
+    codec = config.storage_codecs.get(source) or config.storage_codec
+    if codec not in CODECS:
+        raise ValueError("Storage codec {} is not currently implemented..."
+                         "".format(codec))
+    return codec
+
+
+def stored_path(path, codec):
+    """
+    :param path: (str) filename of the uncompressed file
+    :param codec: (str) one of CODECS
+    :return: (str) filename of the file stored with the codec
+    """
+
+    return path + SUFFIXES[codec]
+
+
+def strip_suffix(filename):
+    """
+    :param filename: (str) filename, possibly of a compressed file
+    :return: (str) filename of the uncompressed file
+    """
+
+    for suffix in (".gz", ".zst"):
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+def variants(path, codecs=CODECS):
+    """
+    Filenames a file can be stored under, e.g. 2pah.cif, 2pah.cif.gz
+    (gzip or bgzf) and 2pah.cif.zst.
+
+    :param path: (str) filename of the file, with or without a suffix
+    :param codecs: codecs to include (defaults to all of them)
+    :return: list of filenames, the uncompressed one first
+    """
+
+    path = strip_suffix(path)
+    paths = []
+    for codec in CODECS:
+        if codec in codecs and path + SUFFIXES[codec] not in paths:
+            paths.append(path + SUFFIXES[codec])
+    return paths
+
+
+
+def stored_variant(path):
+    """
+    Finds the file as stored with any codec, whatever the codec
+    configured now (e.g. 2pah.cif.zst kept after going back to plain).
+
+    :param path: (str) filename of the file, with or without a suffix
+    :return: (str) filename of the first variant that exists, or None
+    """
+
+    for variant in variants(path):
+        if os.path.exists(variant):
+            return variant
+    return None
+
+
+class GzipWriter(object):
+    def __init__(self, outfile, level=None):
+        """
+        File-like object that gzips whatever is written to it into outfile.
+
+        :param outfile: binary file object for the compressed data
+        :param level: (int) compression level (defaults to config.gzip_level)
+        """
+
+        self.outfile = outfile
+        self._compressor = zlib.compressobj(
+            config.gzip_level if level is None else level, zlib.DEFLATED,
+            16 + zlib.MAX_WBITS)
+
+    def write(self, data):
+        self.outfile.write(self._compressor.compress(data))
+
+    def close(self):
+        self.outfile.write(self._compressor.flush())
+
+
+class BGZFWriter(object):
+    def __init__(self, outfile, level=None):
+        """
+        File-like object writing BGZF (blocked gzip, as read by samtools,
+        tabix and Biopython's bgzf module) into outfile. The file is still
+        a valid gzip file, made of independent members of at most 64 KiB,
+        so readers can seek to any block.
+
+        :param outfile: binary file object for the compressed data
+        :param level: (int) compression level (defaults to config.gzip_level)
+        """
+
+        self.outfile = outfile
+        self.level = config.gzip_level if level is None else level
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer.extend(data)
+        while len(self._buffer) >= BGZF_BLOCK_SIZE:
+            self._write_block(bytes(self._buffer[:BGZF_BLOCK_SIZE]))
+            del self._buffer[:BGZF_BLOCK_SIZE]
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(data) + compressor.flush()
+        if len(deflated) > 0x10000 - 26:
+            # incompressible data, stored instead
+            compressor = zlib.compressobj(0, zlib.DEFLATED, -zlib.MAX_WBITS)
+            deflated = compressor.compress(data) + compressor.flush()
+        # gzip header with the BC extra field holding the block size - 1
+        header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+                             ord("B"), ord("C"), 2, len(deflated) + 25)
+        self.outfile.write(header + deflated +
+                           struct.pack("<2I", zlib.crc32(data), len(data)))
+
+    def close(self):
+        if self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer = bytearray()
+        self.outfile.write(BGZF_EOF)
+
+
+class ZstdWriter(object):
+    def __init__(self, outfile, level=None, threads=None):
+        """
+        File-like object that compresses whatever is written to it into
+        outfile as a zstd frame (requires the zstandard package).
+
+        :param outfile: binary file object for the compressed data
+        :param level: (int) compression level (defaults to config.zstd_level)
+        :param threads: (int) compression threads, -1 for one per CPU
+            (defaults to config.zstd_threads)
+        """
+
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstd storage requires zstandard "
+                              "(pip install zstandard)...")
+
+        compressor = zstandard.ZstdCompressor(
+            level=config.zstd_level if level is None else level,
+            threads=config.zstd_threads if threads is None else threads)
+        self._writer = compressor.stream_writer(outfile, closefd=False)
+
+    def write(self, data):
+        self._writer.write(data)
+
+    def close(self):
+        self._writer.close()
+
+
+def storage_writer(codec, outfile):
+    """
+    Gets a file-like object encoding whatever is written to it with a
+    storage codec into outfile. Its close method writes the end of the
+    stream, but leaves outfile open.
+
+    :param codec: (str) one of CODECS
+    :param outfile: binary file object
+    :return: writer object, or None for plain
+    """
+
+    if codec == "gzip":
+        return GzipWriter(outfile)
+    elif codec == "bgzf":
+        return BGZFWriter(outfile)
+    elif codec == "zstd":
+        return ZstdWriter(outfile)
+    elif codec == "plain":
+        return None
+    raise ValueError("Storage codec {} is not currently implemented..."
+                     "".format(codec))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    BioDownloader: a Command Line Tool for downloading protein structures,
+    protein sequences and multiple sequence alignments.
+    Copyright (C) 2017  Fábio Madeira
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import logging
+from collections import namedtuple
+
+from biodownloader.config import config
+from biodownloader import fetchers
+from biodownloader.ids import read_ids
+from biodownloader.index import get_index
+from biodownloader.layout import move_validators
+from biodownloader.storage import variants
+
+logger = logging.getLogger("biodownloader")
+
+STATUS_LISTS = ("added", "modified", "obsolete")
+# formats kept for each entry of a structure mirror
+SYNC_FORMATS = ("pdb", "mmcif", "bio", "sifts")
+
+SyncResult = namedtuple("SyncResult",
+                        ["added", "modified", "obsolete", "moved", "results",
+                         "downloads"])
+
+
+def read_status_lists(location=None):
+    """
+    Reads the wwPDB added, modified and obsolete lists (one PDB ID per
+    line), from a directory holding a copy of them or from a url.
+
+    :param location: (str) directory or url (defaults to
+        config.http_wwpdb_status)
+    :return: dict of lists of PDB IDs, keyed by list name
+    """
+
+    if location is None:
+        location = config.http_wwpdb_status
+
+    lists = {}
+    for name in STATUS_LISTS:
+        filename = "{}.pdb".format(name)
+        if os.path.isdir(location):
+            with open(os.path.join(location, filename)) as f:
+                lines = f.read().splitlines()
+        else:
+            url = location.rstrip("/") + "/" + filename
+            response = fetchers.fetch_from_url_or_retry(url, json=False)
+            if response is None:
+                raise IOError("Unable to retrieve {}...".format(url))
+            lines = response.text.splitlines()
+        lists[name] = [i.lower() for i in read_ids(lines)]
+    return lists
+
+
+def _target(identifier, file_format):
+    if file_format == "sifts":
+        return "sifts", fetchers._sifts_target(identifier)[1]
+    return "pdbe", fetchers._structure_target(
+        identifier, pdb=file_format == "pdb", bio=file_format == "bio")[1]
+
+
+def _local_files(identifier, file_format):
+    # the file stored with any codec, e.g. decompressed with the .gz kept
+    # next to it
+    source, outputfile = _target(identifier, file_format)
+    return source, variants(outputfile)
+
+
+def _available(identifier, file_format):
+    # the same check the downloads make, so a plan never disagrees with them
+    source, outputfile = _target(identifier, file_format)
+    return fetchers._available(outputfile,
+                               (source, identifier, file_format))
+
+
+def plan_downloads(added, modified, file_formats):
+    """
+    Works out the downloads that bring a local mirror up to date: added
+    entries not available yet, and modified entries that are available
+    (entries the mirror does not hold are left alone).
+
+    :param added: list of PDB IDs
+    :param modified: list of PDB IDs
+    :param file_formats: iterable of formats (see SYNC_FORMATS)
+    :return: list of tuples (PDB ID, file format, override), override
+        being True for the modified entries
+    """
+
+    downloads = []
+    for file_format in file_formats:
+        downloads.extend((identifier, file_format, False)
+                         for identifier in added
+                         if not _available(identifier, file_format))
+        downloads.extend((identifier, file_format, True)
+                         for identifier in modified
+                         if _available(identifier, file_format))
+    return downloads
+
+
+def move_obsolete(identifiers):
+    """
+    Moves every local file of obsolete entries to
+    <db_root>/<db_obsolete>, and drops them from the index.
+
+    :param identifiers: iterable of PDB IDs
+    :return: list of the moved files (new filenames)
+    """
+
+    directory = os.path.abspath(os.path.join(config.db_root,
+                                             config.db_obsolete))
+    moved = []
+    for identifier in identifiers:
+        for file_format in SYNC_FORMATS:
+            source, paths = _local_files(identifier, file_format)
+            for path in paths:
+                if not os.path.exists(path):
+                    continue
+                os.makedirs(directory, exist_ok=True)
+                target = os.path.join(directory, os.path.basename(path))
+                os.replace(path, target)
+                move_validators(path, target)
+                logger.info("Moved obsolete %s to %s", path, directory)
+                moved.append(target)
+            if config.index:
+                get_index().remove(source, identifier, file_format)
+    return moved
+
+
+def sync(file_formats=("mmcif",), location=None, jobs=1, dry_run=False):
+    """
+    Brings a local structure mirror up to date with the wwPDB weekly lists:
+    downloads the added entries that are not available yet, downloads the
+    modified ones the mirror holds again and moves the obsolete ones aside
+    (see plan_downloads).
+
+    :param file_formats: iterable of formats (see SYNC_FORMATS)
+    :param location: (str) directory or url of the lists (see
+        read_status_lists)
+    :param jobs: (int) number of files downloaded in parallel
+    :param dry_run: (boolean) works out the downloads (in
+        SyncResult.downloads) without changing anything
+    :return: SyncResult
+    """
+
+    from biodownloader.engine import download_files
+
+    for file_format in file_formats:
+        if file_format not in SYNC_FORMATS:
+            raise ValueError("File format {} can not be synced..."
+                             "".format(file_format))
+
+    lists = read_status_lists(location)
+    obsolete = lists["obsolete"]
+    skip = set(obsolete)
+    added = [i for i in lists["added"] if i not in skip]
+    skip.update(added)
+    modified = [i for i in lists["modified"] if i not in skip]
+    logger.info("wwPDB lists: %s added, %s modified and %s obsolete entries",
+                len(added), len(modified), len(obsolete))
+    downloads = plan_downloads(added, modified, file_formats)
+    if dry_run:
+        return SyncResult(added, modified, obsolete, [], [], downloads)
+
+    results = []
+    for file_format in file_formats:
+        for override in (False, True):
+            identifiers = [i for i, f, o in downloads
+                           if f == file_format and o == override]
+            if identifiers:
+                results += download_files(identifiers, [file_format],
+                                          jobs=jobs, override=override)
+    moved = move_obsolete(obsolete)
+    return SyncResult(added, modified, obsolete, moved, results, downloads)
@@ -45,10 +45,15 @@ setup(
 
     # Packaging options.
     include_package_data=True,
+    python_requires='>=3.8',
 
     # Package dependencies
     # should always match the entries in requirements.txt
     install_requires=DEPENDENCIES,
+    extras_require={
+        "aio": ["aiohttp>=3.0"],
+        "zstd": ["zstandard>=0.15"],
+    },
 
     entry_points={
         "console_scripts": [
@@ -76,9 +81,13 @@ setup(
         'Intended Audience :: Science/Research',
         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
         'Natural Language :: English',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
         'Topic :: Internet',
         'Topic :: Scientific/Engineering :: Bio-informatics',
         'Topic :: Software Development :: Libraries :: Python Modules',
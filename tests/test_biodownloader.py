@@ -22,8 +22,19 @@
 
 import os
 import re
+import sys
+import gzip
+import asyncio
 import json
+import shutil
+import time
+import socket
 import logging
+import tempfile
+import threading
+import subprocess
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
 import unittest
 import requests
 import responses
@@ -49,6 +60,50 @@ from biodownloader.fetchers import (fetch_from_url_or_retry,
 
 from biodownloader.cli import downloads, file_downloader
 
+from biodownloader.engine import (download_files, generate_results,
+                                  generate_tasks, tally)
+
+from biodownloader import session
+from biodownloader import fetchers
+from biodownloader.fetchers import Downloader, GunzipWriter, PARTIAL_SUFFIX
+from biodownloader.fetchers import get_preferred_assembly_ids
+from biodownloader.manifest import MANIFEST_NAME, get_manifest, close_manifests
+from biodownloader.layout import shard, migrate
+from biodownloader.sync import plan_downloads, read_status_lists, sync
+from biodownloader.proxy import make_server, route_through
+from biodownloader.singleflight import SingleFlight
+from biodownloader import daemon
+from biodownloader import storage
+from biodownloader.metrics import (Metrics, Trace, get_metrics, reset_metrics,
+                                   source_of)
+from biodownloader.index import (INDEX_NAME, Index, artefact, get_index,
+                                 close_indexes, data_directories)
+from biodownloader.cache import (CachedResponse, DiskCache, MemoryCache,
+                                 get_cache, close_caches)
+from biodownloader import retry
+from biodownloader.retry import RetryPolicy
+from biodownloader import ratelimit
+from biodownloader.ratelimit import TokenBucket, FileTokenBucket
+from biodownloader import concurrency
+from biodownloader.concurrency import AIMDLimiter
+from biodownloader import hedge
+from biodownloader.hedge import LatencyTracker, hedged_get
+from biodownloader import mirrors
+from biodownloader.ids import read_ids, normalise, unique
+
+from biodownloader import aio
+
+try:
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+except ImportError:
+    web = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 from biodownloader.config import config as c
 
 from biodownloader.version import __version__
@@ -90,6 +145,121 @@ def response_mocker(kwargs, base_url, endpoint_url, status=200,
     return response
 
 
+def listdir(directory):
+    """
+    Sorted directory listing, without the manifest and index files.
+    """
+
+    return sorted(f for f in os.listdir(directory)
+                  if f not in (MANIFEST_NAME, INDEX_NAME))
+
+
+class StandinServer(object):
+    """
+    Threaded local HTTP server serving in-memory files, with Range support.
+    """
+
+    def __init__(self, files=None):
+        self.files = dict(files or {})
+        self.requests = []
+        self.ranges = True
+        self.truncate_after = None
+        self.status = {}
+        self.failures = {}
+        self.delays = {}
+        # half of the body is sent, the rest once the event is set
+        self.gates = {}
+        self.etags = True
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.do_GET(body=False)
+
+            def do_GET(self, body=True):
+                server.requests.append((self.command, self.path,
+                                        dict(self.headers)))
+                if server.delays.get(self.path):
+                    # served once each, before answering
+                    time.sleep(server.delays[self.path].pop(0))
+                status = server.status.get(self.path)
+                if server.failures.get(self.path):
+                    # served once each, before the file
+                    status, retry_after = server.failures[self.path].pop(0)
+                    self.send_response(status)
+                    if retry_after is not None:
+                        self.send_header("Retry-After", retry_after)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if status is not None or self.path not in server.files:
+                    self.send_response(status or 404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                data = server.files[self.path]
+                etag = '"{:x}"'.format(hash(data) & 0xffffffff)
+                if server.etags and self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                start, end = 0, len(data) - 1
+                header = self.headers.get("Range")
+                if header and server.ranges:
+                    first, last = header.split("=")[1].split("-")
+                    start = int(first)
+                    end = min(int(last), end) if last else end
+                    if start > end:
+                        self.send_response(416)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes {}-{}/{}"
+                                     "".format(start, end, len(data)))
+                else:
+                    self.send_response(200)
+                if server.ranges:
+                    self.send_header("Accept-Ranges", "bytes")
+                if server.etags:
+                    self.send_header("ETag", etag)
+                    self.send_header("Last-Modified",
+                                     "Mon, 02 Jan 2017 00:00:00 GMT")
+                self.send_header("Content-Length", str(end - start + 1))
+                self.end_headers()
+                if body:
+                    payload = data[start:end + 1]
+                    if server.truncate_after is not None:
+                        payload = payload[:server.truncate_after]
+                        self.close_connection = True
+                    gate = server.gates.get(self.path)
+                    if gate is not None:
+                        self.wfile.write(payload[:len(payload) // 2])
+                        self.wfile.flush()
+                        gate.wait(10)
+                        payload = payload[len(payload) // 2:]
+                    self.wfile.write(payload)
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.httpd = Server(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
 @patch("biodownloader.config.config.db_root", cwd)
 class TestBioDownloader(unittest.TestCase):
     """
@@ -118,6 +288,16 @@ class TestBioDownloader(unittest.TestCase):
         self.download_alignment_from_pfam = download_alignment_from_pfam
         self.downloads = downloads
         self.file_downloader = file_downloader
+        # the response cache and the index go to a tempdir rather than
+        # the tests dir
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_patch = patch("biodownloader.config.config.db_pickled",
+                                 self.cache_dir)
+        self.cache_patch.start()
+        self.index_patch = patch(
+            "biodownloader.config.config.index_file",
+            os.path.join(self.cache_dir, ".biodownloader-index.sqlite"))
+        self.index_patch.start()
 
         logging.disable(logging.CRITICAL)
 
@@ -140,6 +320,11 @@ class TestBioDownloader(unittest.TestCase):
         self.download_alignment_from_pfam = None
         self.downloads = None
         self.file_downloader = None
+        close_caches()
+        close_indexes()
+        self.cache_patch.stop()
+        self.index_patch.stop()
+        shutil.rmtree(self.cache_dir)
 
         logging.disable(logging.NOTSET)
 
@@ -256,12 +441,14 @@ class TestBioDownloader(unittest.TestCase):
         self.assertTrue(r.ok)
 
     def test_summary_properties_cached(self):
-        pickled = os.path.join(c.db_root, c.db_pickled, self.pdbid + "_sp.pkl")
-        self.assertFalse(os.path.isfile(pickled))
+        cached = os.path.join(c.db_root, c.db_pickled, c.cache_file)
+        self.assertFalse(os.path.isfile(cached))
         r = self.fetch_summary_properties_pdbe(self.pdbid, cached=True)
         self.assertTrue(r.ok)
-        self.assertTrue(os.path.isfile(pickled))
-        os.remove(pickled)
+        self.assertTrue(os.path.isfile(cached))
+        self.assertIsNotNone(get_cache().get(self.pdbid + "_sp"))
+        close_caches()
+        os.remove(cached)
 
     def test_preferred_assembly_pdbe_1(self):
         r = self.get_preferred_assembly_id(self.pdbid)
@@ -427,6 +614,2589 @@ class TestBioDownloader(unittest.TestCase):
             self.assertEqual(result.exit_code, 0)
 
 
+@patch("biodownloader.config.config.db_root", cwd)
+class TestDownloadEngine(unittest.TestCase):
+    """Offline tests for the concurrent download engine."""
+
+    def setUp(self):
+        self.ids = ["2pah", "3kic", "1csb"]
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_generate_tasks_order(self):
+        tasks = list(generate_tasks(iter(["2pah", "3kic"]), ["sifts", "pdb"]))
+        self.assertEqual(tasks, [("2pah", "pdb"), ("2pah", "sifts"),
+                                 ("3kic", "pdb"), ("3kic", "sifts")])
+
+    @patch("biodownloader.fetchers.download_sifts_from_ebi")
+    @patch("biodownloader.fetchers.download_structure_from_pdbe")
+    def test_download_files_jobs(self, mock_pdbe, mock_sifts):
+        mock_pdbe.return_value = MagicMock(error=None)
+        mock_sifts.return_value = MagicMock(error=None)
+        results = download_files(self.ids, ["mmcif", "sifts"], jobs=4)
+        self.assertEqual(len(results), 6)
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(sorted((r.identifier, r.file_format) for r in results),
+                         sorted((i, f) for i in self.ids
+                                for f in ["mmcif", "sifts"]))
+        self.assertEqual(mock_pdbe.call_count, 3)
+        self.assertEqual(mock_sifts.call_count, 3)
+
+    @patch("biodownloader.fetchers.download_data_from_uniprot")
+    def test_download_files_reports_failures(self, mock_uniprot):
+        def side_effect(identifier, file_format="fasta", override=False):
+            if identifier == "P12345":
+                raise ValueError("boom")
+            if file_format == "gff":
+                return MagicMock(error=IOError("unreachable"))
+            return MagicMock(error=None)
+        mock_uniprot.side_effect = side_effect
+        results = download_files(["P00439", "P12345"], ["fasta", "gff"], jobs=2)
+        status = {(r.identifier, r.file_format): r.ok for r in results}
+        self.assertEqual(status, {("P00439", "fasta"): True,
+                                  ("P00439", "gff"): False,
+                                  ("P12345", "fasta"): False,
+                                  ("P12345", "gff"): False})
+
+    @patch("biodownloader.fetchers.download_structure_from_pdbe")
+    def test_results_are_streamed(self, mock_pdbe):
+        mock_pdbe.return_value = MagicMock(error=None)
+        read = []
+
+        def ids():
+            for i in range(1000):
+                read.append(i)
+                yield "{}abc".format(i)
+
+        results = generate_results(ids(), ["pdb"], jobs=2)
+        first = next(results)
+        self.assertTrue(first.ok)
+        # only the IDs of the tasks in flight have been read
+        self.assertLessEqual(len(read), 10)
+        self.assertEqual(tally(results), (999, 0))
+        self.assertEqual(len(read), 1000)
+
+    def test_download_files_bad_jobs(self):
+        with self.assertRaises(ValueError):
+            download_files(self.ids, ["pdb"], jobs=0)
+
+    @patch("biodownloader.fetchers.download_structure_from_pdbe")
+    def test_file_downloader_jobs(self, mock_pdbe):
+        mock_pdbe.return_value = MagicMock(error=None)
+        self.assertEqual(file_downloader(self.ids, pdb=True, jobs=2), (3, 0))
+        mock_pdbe.assert_any_call("2pah", pdb=True, override=False)
+
+    @patch("biodownloader.fetchers.download_alignment_from_pfam")
+    def test_cli_jobs(self, mock_pfam):
+        mock_pfam.return_value = MagicMock(error=None)
+        runner = CliRunner()
+        result = runner.invoke(downloads, ['pfam', '--pfam', '--jobs', '3',
+                                           'PF08124', 'PF00001'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(mock_pfam.call_count, 2)
+        result = runner.invoke(downloads, ['pfam', '--pfam', '--jobs', '0',
+                                           'PF08124'])
+        self.assertNotEqual(result.exit_code, 0)
+
+
+def aio_standin_app():
+    """
+    Local aiohttp stand-in for the PDBe, UniProt and Pfam endpoints.
+    """
+
+    hits = {"retry": 0}
+
+    async def summary(request):
+        identifier = request.match_info["identifier"]
+        return web.json_response({identifier: [{"assemblies": [
+            {"assembly_id": "1", "preferred": False},
+            {"assembly_id": "2", "preferred": True}]}]})
+
+    async def entry_file(request):
+        return web.Response(body=b"data_2pah\n")
+
+    async def assembly(request):
+        return web.Response(body=gzip.compress(
+            request.match_info["filename"].encode()))
+
+    async def uniprot(request):
+        if request.match_info["filename"].startswith("RETRY"):
+            hits["retry"] += 1
+            if hits["retry"] < 3:
+                return web.Response(status=429)
+        return web.Response(text=">sp|{}\nMSTAVLENPGLGRKLSDFGQETSYIEDNCNQ\n"
+                                 "".format(request.match_info["filename"]))
+
+    async def pfam(request):
+        return web.Response(text="# STOCKHOLM 1.0\n//\n")
+
+    app = web.Application()
+    app["hits"] = hits
+    app.router.add_get("/pdbe/api/pdb/entry/summary/{identifier}", summary)
+    app.router.add_get("/pdbe/entry-files/download/{filename}", entry_file)
+    app.router.add_get("/pdbe/static/entry/download/{filename}", assembly)
+    app.router.add_get("/uniprot/{filename}", uniprot)
+    app.router.add_get("/pfam/family/{identifier}/alignment/{size}", pfam)
+    return app
+
+
+@unittest.skipIf(web is None, "aiohttp is not installed")
+class TestAio(unittest.IsolatedAsyncioTestCase):
+    """Tests for biodownloader.aio against a local aiohttp stand-in server."""
+
+    async def asyncSetUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.app = aio_standin_app()
+        self.server = TestServer(self.app)
+        await self.server.start_server()
+        root = str(self.server.make_url("/"))
+        self.patches = [patch("biodownloader.config.config.db_root", self.tmp),
+                        patch("biodownloader.config.config.http_pdbe",
+                              root + "pdbe/"),
+                        patch("biodownloader.config.config.http_uniprot",
+                              root + "uniprot/"),
+                        patch("biodownloader.config.config.http_pfam",
+                              root + "pfam/")]
+        for p in self.patches:
+            p.start()
+        fetchers._preferred_assemblies.clear()
+
+    async def asyncTearDown(self):
+        fetchers._preferred_assemblies.clear()
+        await aio.close_session()
+        await self.server.close()
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    async def test_fetch_summary_properties_pdbe(self):
+        r = await aio.fetch_summary_properties_pdbe("2pah")
+        self.assertTrue(r.ok)
+        self.assertIn("2pah", r.json())
+        pref = await aio.get_preferred_assembly_id("2pah")
+        self.assertEqual(pref, "2")
+
+    async def test_preferred_assemblies_shared_with_fetchers(self):
+        self.assertEqual(await aio.get_preferred_assembly_id("2pah"), "2")
+        # memoized, without a request from the synchronous path
+        self.assertEqual(fetchers.get_preferred_assembly_id("2pah"), "2")
+        fetchers._preferred_assemblies["3kic"] = "4"
+        self.assertEqual(await aio.get_preferred_assembly_id("3kic"), "4")
+
+    async def test_downloader_waits_for_run(self):
+        outputfile = os.path.join(self.tmp, "PF08124.sth")
+        d = aio.Downloader(aio.config.http_pfam +
+                           "family/PF08124/alignment/seed", outputfile)
+        self.assertFalse(os.path.exists(outputfile))
+        self.assertIs(await d.run(), d)
+        self.assertIsNone(d.error)
+        self.assertTrue(os.path.exists(outputfile))
+
+    async def test_download_structure_from_pdbe(self):
+        d = await aio.download_structure_from_pdbe("2pah")
+        self.assertIsNone(d.error)
+        with open(os.path.join(self.tmp, "2pah.cif")) as f:
+            self.assertEqual(f.read(), "data_2pah\n")
+        d = await aio.download_structure_from_pdbe("2pah", bio=True)
+        self.assertIsNone(d.error)
+        with open(os.path.join(self.tmp, "2pah_bio.cif")) as f:
+            self.assertEqual(f.read(), "2pah-assembly-2.cif.gz")
+        self.assertFalse(os.path.exists(os.path.join(self.tmp,
+                                                     "2pah_bio.cif.gz")))
+
+    async def test_many_concurrent_downloads_share_session(self):
+        ids = ["P{:05d}".format(i) for i in range(200)]
+        results = await asyncio.gather(*[aio.download_data_from_uniprot(i)
+                                         for i in ids])
+        self.assertTrue(all(d.error is None for d in results))
+        self.assertEqual(len(listdir(self.tmp)), 200)
+        session = aio.get_session()
+        self.assertIs(session, aio.get_session())
+
+    async def test_fetch_from_url_or_retry(self):
+        url = aio.config.http_uniprot + "RETRY.fasta"
+        r = await aio.fetch_from_url_or_retry(url, json=False,
+                                              retry_in=(429,), wait=0)
+        self.assertTrue(r.ok)
+        self.assertEqual(self.app["hits"]["retry"], 3)
+        r = await aio.fetch_from_url_or_retry(aio.config.http_pdbe + "missing")
+        self.assertIsNone(r)
+
+    async def test_download_errors_and_existing_files(self):
+        d = await aio.download_alignment_from_pfam("PF08124")
+        self.assertIsNone(d.error)
+        d = await aio.download_alignment_from_pfam("PF08124")
+        self.assertIsNone(d.error)
+        with patch("biodownloader.config.config.http_pfam",
+                   aio.config.http_pdbe + "nothing/"):
+            d = await aio.download_alignment_from_pfam("PF00001")
+        self.assertIsNotNone(d.error)
+        with self.assertRaises(ValueError):
+            await aio.download_data_from_uniprot("P00439", file_format="xml")
+
+
+    async def test_blocking_work_runs_off_the_loop(self):
+        loop_thread = threading.get_ident()
+        threads = {}
+
+        def record(name, func):
+            def wrapper(*args, **kwargs):
+                threads.setdefault(name, set()).add(threading.get_ident())
+                return func(*args, **kwargs)
+            return wrapper
+
+        patches = [patch.object(fetchers.Downloader, name,
+                                record(name, getattr(fetchers.Downloader, name)))
+                   for name in ("_available", "_record_artefact",
+                                "_remove_variants", "_record_validators")]
+        patches.append(patch.object(fetchers._OutputStream, "write",
+                                    record("write",
+                                           fetchers._OutputStream.write)))
+        for p in patches:
+            p.start()
+        try:
+            d = await aio.download_structure_from_pdbe("2pah")
+        finally:
+            for p in patches:
+                p.stop()
+        self.assertIsNone(d.error)
+        self.assertEqual(set(threads), {"_available", "_record_artefact",
+                                        "_remove_variants",
+                                        "_record_validators", "write"})
+        self.assertNotIn(loop_thread, set.union(*threads.values()))
+
+    async def test_ftp_fallback_keeps_the_artefact(self):
+        with patch("biodownloader.aio.fetchers.Downloader") as downloader:
+            downloader.return_value.error = None
+            d = await aio.download_sifts_from_ebi("2pah")
+        self.assertIsNone(d.error)
+        self.assertEqual(downloader.call_args[1]["artefact"],
+                         ("sifts", "2pah", "sifts"))
+
+class TestSession(unittest.TestCase):
+    """Offline tests for the shared HTTP session layer."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        session.reset_session()
+
+    def tearDown(self):
+        session.reset_session()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def test_session_is_shared_and_pooled(self):
+        with patch("biodownloader.config.config.http_pool_maxsize", 32):
+            s = session.get_session()
+        self.assertIs(s, session.get_session())
+        adapter = s.get_adapter("https://www.ebi.ac.uk/pdbe/")
+        self.assertEqual(adapter._pool_maxsize, 32)
+        session.reset_session()
+        self.assertIsNot(s, session.get_session())
+
+    def test_ftp_opener_per_thread(self):
+        import threading
+        opener = session.get_ftp_opener()
+        self.assertIs(opener, session.get_ftp_opener())
+        other = []
+        t = threading.Thread(target=lambda: other.append(session.get_ftp_opener()))
+        t.start()
+        t.join()
+        self.assertIsNot(opener, other[0])
+
+    @responses.activate
+    def test_fetcher_and_downloader_use_session(self):
+        url = c.http_uniprot + "P00439.fasta"
+        responses.add(responses.GET, url, body=">sp|P00439\nMSTAV\n",
+                      status=200, content_type='text/plain')
+        responses.add(responses.GET, c.http_uniprot + "P12345.fasta",
+                      status=404)
+        with patch.object(session.get_session(), "get",
+                          wraps=session.get_session().get) as mock_get:
+            r = fetch_from_url_or_retry(url, json=False)
+            self.assertEqual(r.text, ">sp|P00439\nMSTAV\n")
+            outputfile = os.path.join(self.tmp, "P00439.fasta")
+            d = Downloader(url, outputfile)
+            self.assertIsNone(d.error)
+            self.assertEqual(mock_get.call_count, 2)
+        with open(outputfile) as f:
+            self.assertEqual(f.read(), ">sp|P00439\nMSTAV\n")
+        outputfile = os.path.join(self.tmp, "P12345.fasta")
+        d = Downloader(c.http_uniprot + "P12345.fasta", outputfile)
+        self.assertIsNotNone(d.error)
+        self.assertFalse(os.path.exists(outputfile))
+
+
+class TestStreamDecompress(unittest.TestCase):
+    """Offline tests for decompressing .gz payloads while downloading."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.url = c.http_pdbe + "static/entry/download/2pah-assembly-1.cif.gz"
+        self.payload = b"ATOM      1  N   VAL A 118\n" * 20000
+        self.gzipped = gzip.compress(self.payload)
+        self.outputfile = os.path.join(self.tmp, "2pah_bio.cif.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def test_gunzip_writer_bounded_and_multimember(self):
+        from io import BytesIO
+
+        class Sink(BytesIO):
+            largest = 0
+
+            def write(self, data):
+                Sink.largest = max(Sink.largest, len(data))
+                return BytesIO.write(self, data)
+
+        sink = Sink()
+        writer = GunzipWriter(sink)
+        data = gzip.compress(b"\x00" * (8 * 1024 * 1024)) + gzip.compress(b"tail")
+        for i in range(0, len(data), 1000):
+            writer.write(data[i:i + 1000])
+        writer.close()
+        self.assertEqual(sink.getvalue(), b"\x00" * (8 * 1024 * 1024) + b"tail")
+        self.assertLessEqual(Sink.largest, 64 * 1024)
+
+    def test_gunzip_writer_truncated(self):
+        from io import BytesIO
+        writer = GunzipWriter(BytesIO())
+        writer.write(self.gzipped[:len(self.gzipped) // 2])
+        with self.assertRaises(EOFError):
+            writer.close()
+
+    @responses.activate
+    def test_download_decompresses_on_the_fly(self):
+        responses.add(responses.GET, self.url, body=self.gzipped, status=200,
+                      content_type='application/octet-stream')
+        with patch("biodownloader.fetchers.zlib.decompressobj",
+                   wraps=__import__("zlib").decompressobj) as mock_zlib:
+            d = Downloader(self.url, self.outputfile)
+        self.assertIsNone(d.error)
+        self.assertTrue(mock_zlib.called)
+        self.assertFalse(os.path.exists(self.outputfile))
+        with open(os.path.join(self.tmp, "2pah_bio.cif"), 'rb') as f:
+            self.assertEqual(f.read(), self.payload)
+
+    @responses.activate
+    def test_download_keep_compressed(self):
+        responses.add(responses.GET, self.url, body=self.gzipped, status=200,
+                      content_type='application/octet-stream')
+        d = Downloader(self.url, self.outputfile, keep_compressed=True)
+        self.assertIsNone(d.error)
+        with open(self.outputfile, 'rb') as f:
+            self.assertEqual(f.read(), self.gzipped)
+        with open(os.path.join(self.tmp, "2pah_bio.cif"), 'rb') as f:
+            self.assertEqual(f.read(), self.payload)
+
+    @responses.activate
+    def test_download_truncated_leaves_nothing(self):
+        responses.add(responses.GET, self.url, body=self.gzipped[:500],
+                      status=200, content_type='application/octet-stream')
+        d = Downloader(self.url, self.outputfile, keep_compressed=True)
+        self.assertIsInstance(d.error, EOFError)
+        self.assertEqual(listdir(self.tmp), [])
+
+
+class TestResumableDownloads(unittest.TestCase):
+    """Tests for atomic .part commits and HTTP Range resumes."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.payload = os.urandom(300000)
+        self.server = StandinServer({"/family/PF08124/alignment/full":
+                                     self.payload})
+        self.url = self.server.url + "/family/PF08124/alignment/full"
+        self.outputfile = os.path.join(self.tmp, "PF08124.sth")
+        # a single attempt, so interrupted downloads are left behind
+        self.policy = patch("biodownloader.retry._policy",
+                            RetryPolicy(max_retries=0))
+        self.policy.start()
+        session.reset_session()
+
+    def tearDown(self):
+        self.policy.stop()
+        self.server.close()
+        session.reset_session()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def test_interrupted_download_keeps_partial_only(self):
+        self.server.truncate_after = 100000
+        d = Downloader(self.url, self.outputfile)
+        self.assertIsNotNone(d.error)
+        self.assertFalse(os.path.exists(self.outputfile))
+        partial = self.read(self.outputfile + PARTIAL_SUFFIX)
+        self.assertEqual(partial, self.payload[:len(partial)])
+
+    def test_resume_with_range(self):
+        self.server.truncate_after = 100000
+        Downloader(self.url, self.outputfile)
+        offset = os.path.getsize(self.outputfile + PARTIAL_SUFFIX)
+        self.server.truncate_after = None
+        d = Downloader(self.url, self.outputfile)
+        self.assertIsNone(d.error)
+        self.assertEqual(self.read(self.outputfile), self.payload)
+        self.assertFalse(os.path.exists(self.outputfile + PARTIAL_SUFFIX))
+        headers = self.server.requests[-1][2]
+        self.assertEqual(headers["Range"], "bytes={}-".format(offset))
+        self.assertEqual(headers["Accept-Encoding"], "identity")
+
+    def test_resume_without_range_support(self):
+        with open(self.outputfile + PARTIAL_SUFFIX, 'wb') as f:
+            f.write(self.payload[:5000])
+        self.server.ranges = False
+        d = Downloader(self.url, self.outputfile)
+        self.assertIsNone(d.error)
+        self.assertEqual(self.read(self.outputfile), self.payload)
+
+    def test_resume_range_not_satisfiable(self):
+        with open(self.outputfile + PARTIAL_SUFFIX, 'wb') as f:
+            f.write(self.payload + b"stale")
+        d = Downloader(self.url, self.outputfile)
+        self.assertIsNone(d.error)
+        self.assertEqual(self.read(self.outputfile), self.payload)
+        self.assertNotIn("Range", self.server.requests[-1][2])
+
+    def test_resume_keep_compressed(self):
+        payload = b"data_2pah\n" * 50000
+        gzipped = gzip.compress(payload)
+        self.server.files["/2pah-assembly-1.cif.gz"] = gzipped
+        url = self.server.url + "/2pah-assembly-1.cif.gz"
+        outputfile = os.path.join(self.tmp, "2pah_bio.cif.gz")
+        with open(outputfile + PARTIAL_SUFFIX, 'wb') as f:
+            f.write(gzipped[:len(gzipped) // 2])
+        d = Downloader(url, outputfile, keep_compressed=True)
+        self.assertIsNone(d.error)
+        self.assertEqual(self.read(outputfile), gzipped)
+        self.assertEqual(self.read(os.path.join(self.tmp, "2pah_bio.cif")),
+                         payload)
+        self.assertIn("Range", self.server.requests[-1][2])
+        self.assertEqual(listdir(self.tmp), ["2pah_bio.cif", "2pah_bio.cif.gz"])
+
+
+@patch("biodownloader.config.config.range_min_size", 1000)
+@patch("biodownloader.config.config.range_connections", 4)
+class TestRangedDownloads(unittest.TestCase):
+    """Tests for fetching large files as parallel byte ranges."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.payload = os.urandom(10000)
+        self.server = StandinServer({"/PF08124.sth": self.payload})
+        self.url = self.server.url + "/PF08124.sth"
+        self.outputfile = os.path.join(self.tmp, "PF08124.sth")
+        # a single attempt, so interrupted downloads are left behind
+        self.policy = patch("biodownloader.retry._policy",
+                            RetryPolicy(max_retries=0))
+        self.policy.start()
+        session.reset_session()
+
+    def tearDown(self):
+        self.policy.stop()
+        self.server.close()
+        session.reset_session()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def test_parallel_ranges(self):
+        d = Downloader(self.url, self.outputfile)
+        self.assertIsNone(d.error)
+        self.assertEqual(self.read(self.outputfile), self.payload)
+        ranges = sorted(r[2].get("Range", "") for r in self.server.requests)
+        self.assertEqual(ranges, ["", "bytes=2500-4999", "bytes=5000-7499",
+                                  "bytes=7500-9999"])
+        self.assertEqual(listdir(self.tmp), ["PF08124.sth"])
+
+    def test_parallel_ranges_keep_compressed(self):
+        payload = self.payload * 10
+        gzipped = gzip.compress(payload)
+        self.server.files["/2pah.cif.gz"] = gzipped
+        outputfile = os.path.join(self.tmp, "2pah.cif.gz")
+        d = Downloader(self.server.url + "/2pah.cif.gz", outputfile,
+                       keep_compressed=True)
+        self.assertIsNone(d.error)
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(self.read(outputfile), gzipped)
+        self.assertEqual(self.read(os.path.join(self.tmp, "2pah.cif")), payload)
+
+    def test_fallback_single_stream(self):
+        self.server.ranges = False
+        d = Downloader(self.url, self.outputfile)
+        self.assertIsNone(d.error)
+        self.assertEqual(self.read(self.outputfile), self.payload)
+        self.assertEqual(len(self.server.requests), 1)
+        with patch("biodownloader.config.config.range_min_size", 20000):
+            self.server.ranges = True
+            d = Downloader(self.url, self.outputfile, override=True)
+        self.assertIsNone(d.error)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_failed_ranges_keep_contiguous_prefix(self):
+        self.payload = os.urandom(1000000)
+        self.server.files["/PF08124.sth"] = self.payload
+        self.server.truncate_after = 200000
+        d = Downloader(self.url, self.outputfile)
+        self.assertIsNotNone(d.error)
+        self.assertFalse(os.path.exists(self.outputfile))
+        partial = self.read(self.outputfile + PARTIAL_SUFFIX)
+        self.assertTrue(0 < len(partial) < 250000)
+        self.assertEqual(partial, self.payload[:len(partial)])
+        self.server.truncate_after = None
+        d = Downloader(self.url, self.outputfile)
+        self.assertIsNone(d.error)
+        self.assertEqual(self.read(self.outputfile), self.payload)
+        self.assertEqual(self.server.requests[-1][2]["Range"],
+                         "bytes={}-".format(len(partial)))
+
+class TestRefresh(unittest.TestCase):
+    """Tests for the validator manifest and conditional re-downloads."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.server = StandinServer({"/P00439.fasta": b">sp|P00439\nMSTAV\n"})
+        self.url = self.server.url + "/P00439.fasta"
+        self.outputfile = os.path.join(self.tmp, "P00439.fasta")
+        session.reset_session()
+
+    def tearDown(self):
+        self.server.close()
+        session.reset_session()
+        close_manifests()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def test_manifest_records_validators(self):
+        Downloader(self.url, self.outputfile)
+        entry = get_manifest(self.tmp).get("P00439.fasta")
+        self.assertEqual(entry["url"], self.url)
+        self.assertTrue(entry["etag"].startswith('"'))
+        self.assertEqual(entry["last_modified"], "Mon, 02 Jan 2017 00:00:00 GMT")
+        self.assertEqual(entry["size"], 17)
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp, MANIFEST_NAME)))
+
+    def test_refresh_not_modified(self):
+        Downloader(self.url, self.outputfile)
+        mtime = os.path.getmtime(self.outputfile)
+        d = Downloader(self.url, self.outputfile, refresh=True)
+        self.assertIsNone(d.error)
+        self.assertTrue(d.not_modified)
+        self.assertEqual(os.path.getmtime(self.outputfile), mtime)
+        headers = self.server.requests[-1][2]
+        self.assertIn("If-None-Match", headers)
+        self.assertEqual(headers["If-Modified-Since"],
+                         "Mon, 02 Jan 2017 00:00:00 GMT")
+
+    def test_refresh_modified(self):
+        Downloader(self.url, self.outputfile)
+        self.server.files["/P00439.fasta"] = b">sp|P00439\nMSTAVLENPG\n"
+        d = Downloader(self.url, self.outputfile, refresh=True)
+        self.assertFalse(d.not_modified)
+        self.assertEqual(self.read(self.outputfile), b">sp|P00439\nMSTAVLENPG\n")
+        self.assertEqual(get_manifest(self.tmp).get("P00439.fasta")["size"], 22)
+
+    def test_refresh_without_validators_or_size_mismatch(self):
+        Downloader(self.url, self.outputfile)
+        with open(self.outputfile, 'ab') as f:
+            f.write(b"local edit")
+        Downloader(self.url, self.outputfile, refresh=True)
+        self.assertNotIn("If-None-Match", self.server.requests[-1][2])
+        self.assertEqual(self.read(self.outputfile), b">sp|P00439\nMSTAV\n")
+        get_manifest(self.tmp).remove("P00439.fasta")
+        Downloader(self.url, self.outputfile, refresh=True)
+        self.assertNotIn("If-None-Match", self.server.requests[-1][2])
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_no_refresh_skips_existing(self):
+        Downloader(self.url, self.outputfile)
+        Downloader(self.url, self.outputfile)
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class TestCache(unittest.TestCase):
+    """Offline tests for the response cache used by Fetcher."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.patch = patch("biodownloader.config.config.db_root", self.tmp)
+        self.patch.start()
+        self.url = c.http_pdbe + "api/pdb/entry/summary/2pah"
+        self.body = json.dumps({"2pah": [{"assemblies": [
+            {"assembly_id": "1", "preferred": True}]}]})
+        session.reset_session()
+
+    def tearDown(self):
+        close_caches()
+        session.reset_session()
+        self.patch.stop()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def test_cached_response_roundtrip(self):
+        r = CachedResponse("http://x/", 200, {"Content-Type": "text/plain"},
+                           b"line\nanother line\n")
+        r2 = CachedResponse.loads(r.dumps())
+        self.assertEqual((r2.url, r2.status_code, r2.headers, r2.content),
+                         (r.url, r.status_code, r.headers, r.content))
+        self.assertTrue(r2.ok)
+        self.assertEqual(r2.text, "line\nanother line\n")
+
+    @responses.activate
+    def test_fetch_summary_properties_cached(self):
+        responses.add(responses.GET, self.url, body=self.body, status=200,
+                      content_type='application/json')
+        r = fetch_summary_properties_pdbe("2pah", cached=True)
+        self.assertEqual(r.json(), json.loads(self.body))
+        r = fetch_summary_properties_pdbe("2pah", cached=True)
+        self.assertEqual(r.json(), json.loads(self.body))
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(os.listdir(self.tmp), [c.cache_file])
+        # survives a new process (empty memory tier)
+        close_caches()
+        self.assertEqual(get_cache().get("2pah_sp").json(), json.loads(self.body))
+        self.assertEqual(get_preferred_assembly_id("2pah", cached=True), "1")
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_failures_are_not_cached(self):
+        responses.add(responses.GET, self.url, status=404)
+        r = fetch_summary_properties_pdbe("2pah", cached=True)
+        self.assertIsNone(r)
+        self.assertIsNone(get_cache().get("2pah_sp"))
+
+    def test_ttl_expiry(self):
+        with patch("biodownloader.config.config.cache_ttl",
+                   {"default": 100, "short": -1}):
+            cache = get_cache()
+            cache.set("a", CachedResponse("u", 200, {}, b"a"), endpoint="short")
+            cache.set("b", CachedResponse("u", 200, {}, b"b"))
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(cache.get("b").content, b"b")
+            self.assertIsNone(cache.disk.get("a"))
+
+    def test_disk_lru_eviction(self):
+        disk = DiskCache(os.path.join(self.tmp, "lru.sqlite"), max_size=20000,
+                         level=0)
+        expires = time.time() + 100
+        for i in range(4):
+            disk.set(str(i), CachedResponse("u", 200, {}, b"x" * 6000), expires)
+            disk.get("0")
+        self.assertIsNotNone(disk.get("0"))
+        self.assertIsNone(disk.get("1"))
+        self.assertIsNotNone(disk.get("3"))
+        self.assertLessEqual(disk._total_size(), 20000)
+        disk.close()
+
+    def test_disk_replace_keeps_size(self):
+        disk = DiskCache(os.path.join(self.tmp, "lru.sqlite"), max_size=20000,
+                         level=0)
+        expires = time.time() + 100
+        disk.set("a", CachedResponse("u", 200, {}, b"x" * 6000), expires)
+        disk.set("b", CachedResponse("u", 200, {}, b"x" * 6000), expires)
+        for _ in range(3):
+            disk.set("a", CachedResponse("u", 200, {}, b"y" * 6000), expires)
+        # replacing "a" does not evict "b"
+        self.assertEqual(disk._size, disk._total_size())
+        self.assertIsNotNone(disk.get("b"))
+        disk.close()
+
+    def test_memory_lru(self):
+        memory = MemoryCache(max_entries=2)
+        expires = time.time() + 100
+        memory.set("a", 1, expires)
+        memory.set("b", 2, expires)
+        memory.get("a")
+        memory.set("c", 3, expires)
+        self.assertEqual(memory.get("a"), 1)
+        self.assertIsNone(memory.get("b"))
+        self.assertEqual(memory.get("c"), 3)
+
+
+class TestPreferredAssemblyBatches(unittest.TestCase):
+    """Offline tests for batched PDBe summary lookups."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.patch = patch("biodownloader.config.config.db_root", self.tmp)
+        self.patch.start()
+        self.url = c.http_pdbe + "api/pdb/entry/summary/"
+        self.summaries = {
+            "2pah": [{"assemblies": [{"assembly_id": "1", "preferred": False},
+                                     {"assembly_id": "2", "preferred": True}]}],
+            "3kic": [{"assemblies": [{"assembly_id": "1", "preferred": True}]}],
+            "1csb": [{"assemblies": [{"assembly_id": "3", "preferred": True}]}]}
+        fetchers._preferred_assemblies.clear()
+        session.reset_session()
+
+    def tearDown(self):
+        fetchers._preferred_assemblies.clear()
+        close_caches()
+        close_manifests()
+        session.reset_session()
+        self.patch.stop()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def summary_callback(self, request):
+        ids = request.body.split(",")
+        data = {i: self.summaries[i] for i in ids if i in self.summaries}
+        return 200, {}, json.dumps(data)
+
+    @responses.activate
+    def test_batches_and_memoization(self):
+        responses.add_callback(responses.POST, self.url,
+                               callback=self.summary_callback)
+        table = get_preferred_assembly_ids(["2pah", "3kic", "1csb", "9xyz"],
+                                           batch_size=2)
+        self.assertEqual(table, {"2pah": "2", "3kic": "1", "1csb": "3",
+                                 "9xyz": "1"})
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(responses.calls[0].request.body, "2pah,3kic")
+        # memoized for the rest of the run
+        self.assertEqual(get_preferred_assembly_id("2pah"), "2")
+        self.assertEqual(get_preferred_assembly_ids(["2PAH", "1csb"]),
+                         {"2PAH": "2", "1csb": "3"})
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_batch_populates_cache(self):
+        responses.add_callback(responses.POST, self.url,
+                               callback=self.summary_callback)
+        get_preferred_assembly_ids(["2pah"], cached=True)
+        r = fetch_summary_properties_pdbe("2pah", cached=True)
+        self.assertEqual(r.json(), {"2pah": self.summaries["2pah"]})
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_failed_batch_is_not_memoized(self):
+        responses.add(responses.POST, self.url, status=500)
+        table = get_preferred_assembly_ids(["2pah"])
+        self.assertEqual(table, {"2pah": "1"})
+        self.assertEqual(fetchers._preferred_assemblies, {})
+
+    @responses.activate
+    def test_bio_downloads_use_resolved_table(self):
+        responses.add_callback(responses.POST, self.url,
+                               callback=self.summary_callback)
+        for identifier, assembly in (("2pah", "2"), ("3kic", "1"), ("1csb", "3")):
+            responses.add(responses.GET, c.http_pdbe + "static/entry/download/"
+                          "{}-assembly-{}.cif.gz".format(identifier, assembly),
+                          body=gzip.compress(identifier.encode()), status=200)
+        results = download_files(["2pah", "3kic", "1csb"], ["bio"], jobs=2)
+        self.assertTrue(all(r.ok for r in results))
+        methods = [call.request.method for call in responses.calls]
+        self.assertEqual(methods.count("POST"), 1)
+        self.assertEqual(methods.count("GET"), 3)
+        with open(os.path.join(self.tmp, "2pah_bio.cif")) as f:
+            self.assertEqual(f.read(), "2pah")
+
+
+
+class TestUniProtBatches(unittest.TestCase):
+    """Offline tests for batched UniProt downloads."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.patch = patch("biodownloader.config.config.db_root", self.tmp)
+        self.patch.start()
+        self.entries = {
+            "fasta": {"P00439": b">sp|P00439|PH4H_HUMAN Phenylalanine\nMSTAV\n",
+                      "P12345": b">sp|P12345|AATM_RABIT Aspartate\nMALLH\nSS\n"},
+            "txt": {"P00439": b"ID   PH4H_HUMAN\nAC   P00439; Q16717;\n//\n",
+                    "P12345": b"ID   AATM_RABIT\nAC   P12345;\n//\n"},
+            "gff": {"P00439": b"##sequence-region P00439 1 452\n"
+                              b"P00439\tUniProtKB\tChain\t1\t452\n",
+                    "P12345": b"##sequence-region P12345 1 430\n"
+                              b"P12345\tUniProtKB\tChain\t1\t430\n"}}
+        session.reset_session()
+
+    def tearDown(self):
+        close_manifests()
+        session.reset_session()
+        self.patch.stop()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def stream_callback(self, request):
+        file_format = request.params["format"]
+        ids = [q.split(":")[1] for q in request.params["query"].split(" OR ")]
+        body = b"".join(self.entries[file_format][i] for i in ids
+                        if i in self.entries[file_format])
+        if file_format == "gff":
+            body = b"##gff-version 3\n" + body
+        return 200, {}, body
+
+    def read(self, filename):
+        with open(os.path.join(self.tmp, filename), "rb") as f:
+            return f.read()
+
+    @responses.activate
+    def test_split_per_accession(self):
+        responses.add_callback(responses.GET, c.http_uniprot_stream,
+                               callback=self.stream_callback)
+        for file_format in ("fasta", "txt", "gff"):
+            missing = fetchers.download_data_from_uniprot_batch(
+                ["P00439", "P12345", "Q99999"], file_format=file_format)
+            self.assertEqual(missing, ["Q99999"])
+            for identifier, entry in self.entries[file_format].items():
+                if file_format == "gff":
+                    entry = b"##gff-version 3\n" + entry
+                self.assertEqual(self.read("{}.{}".format(identifier,
+                                                          file_format)), entry)
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_batch_size_and_existing_files(self):
+        responses.add_callback(responses.GET, c.http_uniprot_stream,
+                               callback=self.stream_callback)
+        with open(os.path.join(self.tmp, "P00439.fasta"), "wb") as f:
+            f.write(b"old")
+        missing = fetchers.download_data_from_uniprot_batch(
+            ["P00439", "P12345", "Q99999"], batch_size=1)
+        self.assertEqual(missing, ["Q99999"])
+        self.assertEqual(self.read("P00439.fasta"), b"old")
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_engine_batches(self):
+        responses.add_callback(responses.GET, c.http_uniprot_stream,
+                               callback=self.stream_callback)
+        with patch("biodownloader.config.config.uniprot_batch_size", 2):
+            results = download_files(["P00439", "P12345", "Q99999"],
+                                     ["fasta", "gff"], jobs=2, batch=True)
+        self.assertEqual(len(results), 6)
+        failed = sorted((r.identifier, r.file_format)
+                        for r in results if not r.ok)
+        self.assertEqual(failed, [("Q99999", "fasta"), ("Q99999", "gff")])
+        self.assertEqual(len(responses.calls), 4)
+        self.assertEqual(sorted(listdir(self.tmp)),
+                         ["P00439.fasta", "P00439.gff",
+                          "P12345.fasta", "P12345.gff"])
+
+
+
+class TestRetryPolicy(unittest.TestCase):
+    """Offline tests for the shared retry policy."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.payload = os.urandom(300000)
+        self.server = StandinServer({"/PF08124.sth": self.payload})
+        self.url = self.server.url + "/PF08124.sth"
+        self.outputfile = os.path.join(self.tmp, "PF08124.sth")
+        self.policy = RetryPolicy(backoff=0, budget=100)
+        self.patch = patch("biodownloader.retry._policy", self.policy)
+        self.patch.start()
+        session.reset_session()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.server.close()
+        close_manifests()
+        session.reset_session()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def test_backoff_with_full_jitter(self):
+        policy = RetryPolicy(backoff=1, backoff_cap=10)
+        with patch("random.uniform", side_effect=lambda a, b: b):
+            self.assertEqual([policy.delay(i) for i in range(6)],
+                             [1, 2, 4, 8, 10, 10])
+        for _ in range(100):
+            self.assertTrue(0 <= policy.delay(2) <= 4)
+
+    def test_retry_after(self):
+        policy = RetryPolicy(backoff=1, backoff_cap=10)
+        self.assertEqual(policy.delay(0, headers={"Retry-After": "3"}), 3)
+        self.assertEqual(policy.delay(0, headers={"Retry-After": "3600"}), 10)
+        date = time.strftime("%a, %d %b %Y %H:%M:%S GMT",
+                             time.gmtime(time.time() + 5))
+        self.assertTrue(3 < policy.delay(0, headers={"Retry-After": date}) <= 5)
+
+    def test_retryable(self):
+        policy = RetryPolicy()
+        response = requests.Response()
+        response.status_code = 503
+        self.assertTrue(policy.retryable(
+            error=requests.exceptions.HTTPError(response=response)))
+        response.status_code = 404
+        self.assertFalse(policy.retryable(
+            error=requests.exceptions.HTTPError(response=response)))
+        self.assertTrue(policy.retryable(error=ConnectionResetError()))
+        self.assertTrue(policy.retryable(error=requests.exceptions.ReadTimeout()))
+        self.assertTrue(policy.retryable(status_code=429))
+        self.assertFalse(policy.retryable(status_code=429, retry_in=(500,)))
+        self.assertFalse(policy.retryable(error=ValueError()))
+        unknown_host = socket.gaierror(socket.EAI_NONAME, "Name unknown")
+        error = requests.exceptions.ConnectionError(unknown_host)
+        self.assertFalse(policy.retryable(error=error))
+        dns_timeout = socket.gaierror(socket.EAI_AGAIN, "Try again")
+        error = requests.exceptions.ConnectionError(dns_timeout)
+        self.assertTrue(policy.retryable(error=error))
+
+    def test_budget_and_max_retries(self):
+        policy = RetryPolicy(backoff=0, max_retries=5, budget=3)
+        self.assertIsNone(policy.next_delay(5, status_code=503))
+        self.assertEqual([policy.next_delay(0, status_code=503)
+                          for _ in range(4)], [0, 0, 0, None])
+        self.assertEqual(policy.budget, 0)
+
+    def test_budget_window(self):
+        policy = RetryPolicy(backoff=0, budget=2, window=10)
+        self.assertEqual([policy.next_delay(0, status_code=503)
+                          for _ in range(3)], [0, 0, None])
+        # regained over the window, up to the full budget
+        policy._refilled -= 5
+        self.assertEqual(policy.next_delay(0, status_code=503), 0)
+        self.assertIsNone(policy.next_delay(0, status_code=503))
+        policy._refilled -= 100
+        policy.next_delay(0, status_code=503)
+        self.assertEqual(policy.budget, 1)
+
+    @responses.activate
+    def test_fetch_retries_status_and_network_errors(self):
+        url = c.http_pdbe + "api/pdb/entry/summary/2pah"
+        responses.add(responses.GET, url, status=503,
+                      headers={"Retry-After": "0"})
+        responses.add(responses.GET, url,
+                      body=requests.exceptions.ConnectionError("reset"))
+        responses.add(responses.GET, url, body="{}", status=200)
+        r = fetch_from_url_or_retry(url, json=True, retry_in=(503,))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(self.policy.budget, 98)
+
+    @responses.activate
+    def test_fetch_gives_up(self):
+        url = c.http_pdbe + "api/pdb/entry/summary/2pah"
+        responses.add(responses.GET, url, status=503)
+        self.assertIsNone(fetch_from_url_or_retry(url, retry_in=(503,),
+                                                  n_retries=2))
+        self.assertEqual(len(responses.calls), 3)
+        responses.add(responses.GET, url + "0",
+                      body=requests.exceptions.ConnectionError("reset"))
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            fetch_from_url_or_retry(url + "0", n_retries=1)
+
+    def test_download_retries_status(self):
+        self.server.failures["/PF08124.sth"] = [(503, "0"), (429, None)]
+        d = Downloader(self.url, self.outputfile)
+        self.assertIsNone(d.error)
+        with open(self.outputfile, "rb") as f:
+            self.assertEqual(f.read(), self.payload)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_download_retries_resume(self):
+        self.server.truncate_after = 100000
+        d = Downloader(self.url, self.outputfile)
+        self.assertIsNone(d.error)
+        with open(self.outputfile, "rb") as f:
+            self.assertEqual(f.read(), self.payload)
+        ranges = [r[2].get("Range") for r in self.server.requests]
+        self.assertGreater(len(ranges), 1)
+        self.assertIsNone(ranges[0])
+        self.assertTrue(all(r.startswith("bytes=") for r in ranges[1:]))
+
+    def test_download_does_not_retry_not_found(self):
+        d = Downloader(self.server.url + "/missing", self.outputfile)
+        self.assertIsNotNone(d.error)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.policy.budget, 100)
+
+    @unittest.skipIf(web is None, "aiohttp is not installed")
+    def test_aio_download_retries(self):
+        self.server.failures["/PF08124.sth"] = [(503, "0")]
+        self.server.truncate_after = 100000
+
+        async def run():
+            try:
+                return await aio.Downloader(self.url, self.outputfile).run()
+            finally:
+                await aio.close_session()
+
+        d = asyncio.run(run())
+        self.assertIsNone(d.error)
+        with open(self.outputfile, "rb") as f:
+            self.assertEqual(f.read(), self.payload)
+
+
+
+class TestRateLimit(unittest.TestCase):
+    """Offline tests for the per-host token buckets."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        ratelimit.reset_rate_limiters()
+
+    def tearDown(self):
+        ratelimit.reset_rate_limiters()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def test_token_bucket(self):
+        now = [100.0]
+        with patch("time.monotonic", side_effect=lambda: now[0]):
+            bucket = TokenBucket(rate=2, burst=3)
+            self.assertEqual([bucket.reserve() for _ in range(3)], [0, 0, 0])
+            self.assertEqual(bucket.reserve(), 0.5)
+            self.assertEqual(bucket.reserve(), 1.0)
+            now[0] += 10
+            # refills up to the burst size only
+            self.assertEqual([bucket.reserve() for _ in range(3)], [0, 0, 0])
+            self.assertEqual(bucket.reserve(), 0.5)
+
+    @unittest.skipIf(ratelimit.fcntl is None, "fcntl is not available")
+    def test_file_token_bucket_is_shared(self):
+        path = os.path.join(self.tmp, "host.bucket")
+        now = [100.0]
+        with patch("time.time", side_effect=lambda: now[0]):
+            first = FileTokenBucket(path, rate=1, burst=2)
+            second = FileTokenBucket(path, rate=1, burst=2)
+            self.assertEqual(first.reserve(), 0)
+            self.assertEqual(second.reserve(), 0)
+            self.assertEqual(first.reserve(), 1.0)
+            self.assertEqual(second.reserve(), 2.0)
+
+    def test_limits_per_host(self):
+        limits = {"http_pdbe": (5, 10)}
+        with patch("biodownloader.config.config.rate_limits", limits):
+            limiter = ratelimit.get_rate_limiter(c.http_pdbe + "api/pdb")
+            self.assertIsInstance(limiter, TokenBucket)
+            self.assertEqual((limiter.rate, limiter.burst), (5, 10))
+            self.assertIs(ratelimit.get_rate_limiter(c.http_pdbe), limiter)
+            self.assertIsNone(ratelimit.get_rate_limiter(c.http_pfam))
+            self.assertEqual(ratelimit.reserve(c.http_pfam), 0)
+
+    @unittest.skipIf(ratelimit.fcntl is None, "fcntl is not available")
+    def test_limits_shared_between_processes(self):
+        limits = {"ftp_sifts": (1, 1)}
+        with patch("biodownloader.config.config.rate_limits", limits), \
+                patch("biodownloader.config.config.rate_limit_dir", self.tmp):
+            limiter = ratelimit.get_rate_limiter(c.ftp_sifts)
+        self.assertIsInstance(limiter, FileTokenBucket)
+        self.assertEqual(os.path.dirname(limiter.path), self.tmp)
+
+    @responses.activate
+    def test_fetch_is_throttled(self):
+        url = c.http_pdbe + "api/pdb/entry/summary/2pah"
+        responses.add(responses.GET, url, body="{}", status=200)
+        limits = {"http_pdbe": (10, 2)}
+        with patch("biodownloader.config.config.rate_limits", limits), \
+                patch("biodownloader.ratelimit.time.sleep") as sleep:
+            for _ in range(4):
+                fetch_from_url_or_retry(url)
+        self.assertEqual(len(responses.calls), 4)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertTrue(all(0 < call[0][0] <= 0.2
+                            for call in sleep.call_args_list))
+
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+    """Offline tests for the AIMD per-host concurrency limits."""
+
+    def setUp(self):
+        self.policy = patch("biodownloader.retry._policy",
+                            RetryPolicy(max_retries=0))
+        self.policy.start()
+        session.reset_session()
+
+    def tearDown(self):
+        concurrency.disable()
+        session.reset_session()
+        self.policy.stop()
+
+    def test_additive_increase(self):
+        limiter = AIMDLimiter("host", maximum=4, initial=2)
+        # about one slot per `limit` responses
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release(latency=0.1)
+        self.assertEqual(int(limiter.limit), 3)
+        for _ in range(20):
+            limiter.acquire()
+            limiter.release(latency=0.1)
+        self.assertEqual(limiter.limit, 4)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_slow_responses_stop_growth(self):
+        limiter = AIMDLimiter("host", maximum=4, initial=2)
+        limiter.acquire()
+        limiter.release(latency=0.1)
+        limit = limiter.limit
+        limiter.acquire()
+        limiter.release(latency=1.0)
+        self.assertEqual(limiter.limit, limit)
+
+    def test_multiplicative_decrease(self):
+        limiter = AIMDLimiter("host", maximum=16, initial=16, cooldown=60)
+        limiter.acquire()
+        limiter.acquire()
+        limiter.release(congested=True)
+        self.assertEqual(limiter.limit, 8)
+        # failures already in flight count once
+        limiter.release(congested=True)
+        self.assertEqual(limiter.limit, 8)
+        limiter = AIMDLimiter("host", maximum=16, initial=3, cooldown=0)
+        for _ in range(4):
+            limiter.acquire()
+            limiter.release(congested=True)
+        self.assertEqual(limiter.limit, 1)
+
+    def test_acquire_blocks_at_limit(self):
+        limiter = AIMDLimiter("host", maximum=4, initial=1)
+        limiter.acquire()
+        acquired = threading.Event()
+
+        def worker():
+            limiter.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        self.assertFalse(acquired.wait(0.2))
+        limiter.release(latency=0.1)
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+
+    def test_limit_changes_are_logged(self):
+        with self.assertLogs("biodownloader", level="INFO") as logs:
+            limiter = AIMDLimiter("www.ebi.ac.uk", maximum=4, initial=4)
+            limiter.acquire()
+            limiter.release(congested=True)
+        self.assertEqual(logs.output[-1], "INFO:biodownloader:"
+                         "Concurrency limit for www.ebi.ac.uk: 2")
+
+    @responses.activate
+    def test_congestion_shrinks_host_limit(self):
+        url = c.http_pdbe + "api/pdb/entry/summary/2pah"
+        responses.add(responses.GET, url, status=503)
+        self.assertIsNone(concurrency.get_concurrency_limiter(url))
+        with patch("biodownloader.config.config.concurrency_initial", 4):
+            concurrency.enable(8)
+            limiter = concurrency.get_concurrency_limiter(url)
+            self.assertEqual(limiter.limit, 4)
+            self.assertIsNone(fetch_from_url_or_retry(url, retry_in=(503,)))
+        self.assertEqual(limiter.limit, 2)
+        self.assertIsNot(concurrency.get_concurrency_limiter(c.http_uniprot),
+                         limiter)
+
+    def test_engine_enables_limits(self):
+        server = StandinServer({"/PF08124.sth": b"# STOCKHOLM 1.0\n//\n"})
+        tmp = tempfile.mkdtemp()
+        seen = []
+
+        def download_task(identifier, file_format, override=False):
+            url = server.url + "/PF08124.sth"
+            seen.append(concurrency.get_concurrency_limiter(url))
+            return Downloader(url, os.path.join(tmp, identifier), override=True)
+
+        try:
+            with patch("biodownloader.engine.download_task", download_task):
+                results = download_files(["a", "b", "c"], ["pfam"], jobs=3)
+        finally:
+            server.close()
+            close_manifests()
+            shutil.rmtree(tmp)
+        self.assertTrue(all(r.ok for r in results))
+        self.assertIsNotNone(seen[0])
+        self.assertIs(seen[0], seen[-1])
+        self.assertIsNone(concurrency.get_concurrency_limiter(server.url))
+
+
+
+class TestTimeoutsAndHedging(unittest.TestCase):
+    """Offline tests for request timeouts and hedged GETs."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.payload = b">sp|P00439|PH4H_HUMAN\nMSTAV\n"
+        self.server = StandinServer({"/P00439.fasta": self.payload})
+        self.url = self.server.url + "/P00439.fasta"
+        self.outputfile = os.path.join(self.tmp, "P00439.fasta")
+        self.policy = patch("biodownloader.retry._policy",
+                            RetryPolicy(max_retries=0))
+        self.policy.start()
+        session.reset_session()
+        hedge.reset_hedging()
+
+    def tearDown(self):
+        hedge.reset_hedging()
+        self.policy.stop()
+        self.server.close()
+        close_manifests()
+        session.reset_session()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def test_read_timeout(self):
+        self.server.delays["/P00439.fasta"] = [2]
+        with patch("biodownloader.config.config.read_timeout", 0.2):
+            started = time.monotonic()
+            d = Downloader(self.url, self.outputfile)
+        self.assertIsInstance(d.error, requests.exceptions.ReadTimeout)
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertFalse(os.path.exists(self.outputfile))
+
+    def test_fetch_read_timeout(self):
+        self.server.delays["/P00439.fasta"] = [2]
+        with patch("biodownloader.config.config.read_timeout", 0.2):
+            with self.assertRaises(requests.exceptions.ReadTimeout):
+                fetch_from_url_or_retry(self.url, json=False)
+
+    def test_latency_percentile(self):
+        tracker = LatencyTracker(size=100)
+        self.assertIsNone(tracker.percentile(95))
+        for i in range(200):
+            tracker.add(i / 100.0)
+        self.assertEqual(len(tracker), 100)
+        self.assertEqual(tracker.percentile(0), 1.0)
+        self.assertEqual(tracker.percentile(50), 1.5)
+        self.assertEqual(tracker.percentile(100), 1.99)
+
+    def test_hedge_delay(self):
+        with patch("biodownloader.config.config.hedge_delay", 0.7):
+            self.assertEqual(hedge.hedge_delay(self.url), 0.7)
+            tracker = hedge.get_latency_tracker(self.url)
+            for _ in range(c.hedge_min_samples):
+                tracker.add(0.01)
+            self.assertEqual(hedge.hedge_delay(self.url), c.hedge_min_delay)
+            tracker.add(0.3)
+            self.assertEqual(hedge.hedge_delay(self.url + "?x"),
+                             hedge.hedge_delay(self.url))
+            self.assertEqual(hedge.hedge_delay("http://other.org/"), 0.7)
+
+    def test_hedged_get_keeps_first_response(self):
+        self.server.delays["/P00439.fasta"] = [2]
+        with patch("biodownloader.config.config.hedge_delay", 0.1):
+            started = time.monotonic()
+            r = hedged_get(self.url, timeout=5)
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(r.content, self.payload)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_hedged_get_without_hedge(self):
+        r = hedged_get(self.url, timeout=5)
+        self.assertEqual(r.content, self.payload)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(len(hedge.get_latency_tracker(self.url)), 1)
+
+    def test_api_requests_are_hedged(self):
+        self.server.delays["/P00439.fasta"] = [2]
+        with patch("biodownloader.config.config.hedge_requests", True), \
+                patch("biodownloader.config.config.hedge_delay", 0.1):
+            started = time.monotonic()
+            r = fetch_from_url_or_retry(self.url, json=False)
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(r.content, self.payload)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_downloads_are_not_hedged(self):
+        self.server.delays["/P00439.fasta"] = [0.5]
+        with patch("biodownloader.config.config.hedge_requests", True), \
+                patch("biodownloader.config.config.hedge_delay", 0.1):
+            d = Downloader(self.url, self.outputfile)
+            r = fetch_from_url_or_retry(self.url, json=False, stream=True)
+            r.close()
+        self.assertIsNone(d.error)
+        with open(self.outputfile, "rb") as f:
+            self.assertEqual(f.read(), self.payload)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(len(hedge.get_latency_tracker(self.url)), 0)
+
+    def test_queued_requests_are_not_hedged(self):
+        # more callers than hedging threads: the pool grows rather than
+        # queueing primaries until their hedge delay has passed
+        self.server.delays["/P00439.fasta"] = [0.3] * 6
+        results = []
+        with patch("biodownloader.config.config.hedge_workers", 1), \
+                patch("biodownloader.config.config.hedge_delay", 0.5):
+            threads = [threading.Thread(target=lambda: results.append(
+                hedged_get(self.url, timeout=5))) for _ in range(6)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual([r.content for r in results], [self.payload] * 6)
+        self.assertEqual(len(self.server.requests), 6)
+
+    def test_latency_up_to_headers(self):
+        r = hedged_get(self.url, timeout=5, stream=True)
+        r.close()
+        latency = hedge.get_latency_tracker(self.url).percentile(50)
+        self.assertEqual(latency, r.elapsed.total_seconds())
+
+
+
+class TestMirrors(unittest.TestCase):
+    """Offline tests for mirror selection and failover, with one stand-in
+    server per mirror."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.mmcif = b"data_2PAH\n#\n"
+        self.pdb = b"HEADER    PHENYLALANINE HYDROXYLASE\nEND\n"
+        self.servers = {}
+        templates = {}
+        for name in ("pdbe", "rcsb", "pdbj"):
+            server = StandinServer({"/cif/2pah.cif": self.mmcif,
+                                    "/pdb/pa/pdb2pah.ent.gz":
+                                        gzip.compress(self.pdb)})
+            self.servers[name] = server
+            templates[name] = {"mmcif": server.url + "/cif/{id}.cif",
+                               "pdb": server.url + "/pdb/{mid}/pdb{id}.ent.gz"}
+        self.patches = [
+            patch("biodownloader.config.config.db_root", self.tmp),
+            patch("biodownloader.config.config.mirrors",
+                  {"structures": templates}),
+            patch("biodownloader.config.config.structure_mirrors", True),
+            patch("biodownloader.retry._policy", RetryPolicy(backoff=0))]
+        for p in self.patches:
+            p.start()
+        mirrors.reset_mirrors()
+        session.reset_session()
+
+    def tearDown(self):
+        mirrors.reset_mirrors()
+        for p in self.patches:
+            p.stop()
+        for server in self.servers.values():
+            server.close()
+        close_manifests()
+        session.reset_session()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def requests_to(self, name):
+        return [r for r in self.servers[name].requests if r[0] == "GET"]
+
+    def read(self, filename):
+        with open(os.path.join(self.tmp, filename), "rb") as f:
+            return f.read()
+
+    def test_probe_ranks_fastest_mirror(self):
+        self.servers["pdbe"].delays["/"] = [0.5]
+        registry = mirrors.get_mirror_registry("structures")
+        self.assertEqual(registry.ranked()[-1].name, "pdbe")
+        self.assertTrue(all(m.latency is not None for m in registry.ranked()))
+        fastest = registry.ranked()[0].name
+        d = download_structure_from_pdbe("2pah", pdb=False)
+        self.assertIsNone(d.error)
+        self.assertEqual(self.read("2pah.cif"), self.mmcif)
+        self.assertEqual(len(self.requests_to(fastest)), 1)
+        self.assertEqual(len(self.requests_to("pdbe")), 0)
+
+    def test_failover(self):
+        with patch("biodownloader.config.config.mirror_probe", False):
+            registry = mirrors.get_mirror_registry("structures")
+        self.servers["pdbe"].status["/cif/2pah.cif"] = 503
+        d = download_structure_from_pdbe("2pah", pdb=False)
+        self.assertIsNone(d.error)
+        self.assertEqual(self.read("2pah.cif"), self.mmcif)
+        # one retry (mirror_retries) before failing over
+        self.assertEqual(len(self.requests_to("pdbe")), 2)
+        self.assertEqual(len(self.requests_to("rcsb")), 1)
+        self.assertEqual(registry.mirrors["pdbe"].failures, 1)
+        self.assertEqual(registry.ranked()[0].name, "rcsb")
+
+    def test_missing_entry_is_not_a_mirror_failure(self):
+        with patch("biodownloader.config.config.mirror_probe", False):
+            registry = mirrors.get_mirror_registry("structures")
+        self.servers["pdbe"].status["/cif/2pah.cif"] = 404
+        d = download_structure_from_pdbe("2pah", pdb=False)
+        self.assertIsNone(d.error)
+        self.assertEqual(self.read("2pah.cif"), self.mmcif)
+        self.assertEqual(len(self.requests_to("pdbe")), 1)
+        self.assertEqual(registry.mirrors["pdbe"].failures, 0)
+        self.assertIsNone(registry.mirrors["pdbe"].latency)
+
+    def test_latency_is_time_to_first_byte(self):
+        with patch("biodownloader.config.config.mirror_probe", False):
+            registry = mirrors.get_mirror_registry("structures")
+        d = download_structure_from_pdbe("2pah", pdb=False)
+        self.assertIsNone(d.error)
+        mirror = registry.mirrors[registry.ranked()[0].name]
+        self.assertEqual(mirror.latency, d.trace.ttfb)
+
+    def test_failing_mirror_is_skipped(self):
+        with patch("biodownloader.config.config.mirror_probe", False):
+            registry = mirrors.get_mirror_registry("structures")
+        pdbe = registry.mirrors["pdbe"]
+        for _ in range(c.mirror_max_failures):
+            registry.record(pdbe, ok=False)
+        self.assertFalse(pdbe.healthy)
+        self.assertEqual(registry.ranked()[-1], pdbe)
+        registry.record(pdbe, ok=True, latency=0.01)
+        self.assertTrue(pdbe.healthy)
+
+    def test_unreachable_mirror(self):
+        self.servers["pdbe"].close()
+        registry = mirrors.get_mirror_registry("structures")
+        self.assertEqual(registry.ranked()[-1].name, "pdbe")
+        self.assertEqual(registry.mirrors["pdbe"].failures, 1)
+        d = download_structure_from_pdbe("2pah", pdb=False)
+        self.assertIsNone(d.error)
+
+    def test_default_mirrors_serve_the_same_mmcif(self):
+        # failing over must not change what the local file holds, e.g.
+        # the PDBe updated mmCIF for the archive one
+        from biodownloader.config import config_defaults
+        templates = config_defaults["mirrors"]["structures"].values()
+        self.assertEqual({storage.strip_suffix(t["mmcif"].rsplit("/", 1)[1])
+                          for t in templates}, {"{id}.cif"})
+
+    def test_compressed_mirror_keeps_local_filename(self):
+        with patch("biodownloader.config.config.mirror_probe", False):
+            mirrors.get_mirror_registry("structures")
+        d = download_structure_from_pdbe("2pah", pdb=True)
+        self.assertIsNone(d.error)
+        self.assertEqual(self.read("2pah.pdb"), self.pdb)
+        self.assertEqual(sorted(listdir(self.tmp)), ["2pah.pdb"])
+        # already available, from any mirror
+        d = download_structure_from_pdbe("2pah", pdb=True)
+        self.assertIsNone(d.error)
+        self.assertEqual(len(self.requests_to("pdbe")), 1)
+
+
+
+class TestIdsInput(unittest.TestCase):
+    """Tests for streamed ID input (--ids-from)."""
+
+    def test_read_ids(self):
+        lines = ["2pah 3kic\n", "\n", "1csb,4pah, 5pah\n",
+                 "# comment\n", "6pah  # trailing comment\n"]
+        self.assertEqual(list(read_ids(lines)),
+                         ["2pah", "3kic", "1csb", "4pah", "5pah", "6pah"])
+
+    def test_normalise(self):
+        self.assertEqual(list(normalise(["2PAH"], ["mmcif", "sifts"])),
+                         ["2pah"])
+        self.assertEqual(list(normalise(["p00439"], ["fasta"])), ["P00439"])
+        self.assertEqual(list(normalise(["pf08124"], ["pfam"])), ["PF08124"])
+        # only accessions change case, Pfam family names are kept as given
+        self.assertEqual(list(normalise(["Pkinase", "pf08124"], ["pfam"])),
+                         ["Pkinase", "PF08124"])
+        self.assertEqual(list(normalise(["a0a023gpi8", "sp|p00439"],
+                                        ["fasta"])),
+                         ["A0A023GPI8", "sp|p00439"])
+        self.assertEqual(list(normalise(["1.50.10.100_1318"], ["cath"])),
+                         ["1.50.10.100_1318"])
+
+    def test_unique_with_bounded_window(self):
+        ids = ["a", "b", "a", "c", "a", "b"]
+        self.assertEqual(list(unique(ids)), ["a", "b", "c"])
+        # b falls out of a window of two IDs
+        self.assertEqual(list(unique(ids, window=2)), ["a", "b", "c", "b"])
+
+    def test_cli_reads_stdin(self):
+        captured = {}
+
+        def generate_results(ids, file_formats, **kwargs):
+            captured["ids"] = ids
+            captured["list"] = list(ids)
+            return iter([])
+
+        runner = CliRunner()
+        with patch("biodownloader.engine.generate_results", generate_results):
+            result = runner.invoke(downloads, ["pdb", "--mmcif", "--ids-from",
+                                               "-", "1ABC"],
+                                   input="2PAH 3kic\n2pah\n# done\n1abc\n")
+        self.assertEqual(result.exit_code, 0)
+        self.assertNotIsInstance(captured["ids"], (list, tuple))
+        self.assertEqual(captured["list"], ["1abc", "2pah", "3kic"])
+
+    def test_engine_starts_before_input_is_read(self):
+        read = []
+
+        def lines():
+            for i in range(1000):
+                read.append(i)
+                yield "{}abc\n".format(i)
+
+        def generate_results(ids, file_formats, **kwargs):
+            self.assertEqual(next(iter(ids)), "0abc")
+            self.assertEqual(read, [0])
+            return iter([])
+
+        with patch("biodownloader.engine.generate_results", generate_results):
+            file_downloader((), mmcif=True, ids_from=lines())
+
+    def test_cli_without_ids(self):
+        result = CliRunner().invoke(downloads, ["pdb", "--mmcif"])
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn("--ids-from", result.output)
+
+
+class TestIndex(unittest.TestCase):
+    """Tests for the index of downloaded files."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.server = StandinServer({"/family/PF08124/alignment/seed": b"# STOCKHOLM 1.0\n"})
+        self.patches = [patch("biodownloader.config.config.db_root", self.tmp),
+                        patch("biodownloader.config.config.http_pfam",
+                              self.server.url + "/"),
+                        patch("biodownloader.retry._policy",
+                              RetryPolicy(max_retries=0))]
+        for p in self.patches:
+            p.start()
+        self.outputfile = os.path.join(self.tmp, "PF08124.sth")
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        close_indexes()
+        close_manifests()
+        self.server.close()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def test_artefact(self):
+        self.assertEqual(artefact("2pah_bio.cif"), ("pdbe", "2pah", "bio"))
+        self.assertEqual(artefact("2pah.cif"), ("pdbe", "2pah", "mmcif"))
+        self.assertEqual(artefact("2pah.xml"), ("sifts", "2pah", "sifts"))
+        self.assertEqual(artefact("P00439.fasta"),
+                         ("uniprot", "P00439", "fasta"))
+        self.assertEqual(artefact("1.50.10.100_1318.fasta"),
+                         ("cath", "1.50.10.100_1318", "cath"))
+        self.assertEqual(artefact("PF08124.sth"), ("pfam", "PF08124", "pfam"))
+        # files stored compressed are the same artefact (see storage)
+        self.assertEqual(artefact("2pah.cif.gz"), ("pdbe", "2pah", "mmcif"))
+        self.assertIsNone(artefact("2pah.cif.part"))
+        self.assertIsNone(artefact(MANIFEST_NAME))
+
+    def test_update_and_get(self):
+        index = Index(os.path.join(self.tmp, "index.sqlite"))
+        self.assertIsNone(index.get("pdbe", "2pah", "mmcif"))
+        index.update("pdbe", "2pah", "mmcif", path="/x/2pah.cif", size=10,
+                     mtime=1.0)
+        entry = index.get("pdbe", "2pah", "mmcif")
+        self.assertEqual((entry["path"], entry["size"], entry["status"]),
+                         ("/x/2pah.cif", 10, "ok"))
+        index.remove("pdbe", "2pah", "mmcif")
+        self.assertIsNone(index.get("pdbe", "2pah", "mmcif"))
+        index.close()
+
+    def test_rebuild_from_scan(self):
+        for name in ("2pah.cif", "P00439.gff", "notes.md"):
+            with open(os.path.join(self.tmp, name), "w") as f:
+                f.write("data")
+        index = get_index()
+        self.assertFalse(index.complete)
+        self.assertEqual(index.rebuild(data_directories()), 2)
+        self.assertTrue(index.complete)
+        entry = index.get("uniprot", "P00439", "gff")
+        self.assertEqual(entry["size"], 4)
+        self.assertEqual(entry["path"], os.path.join(self.tmp, "P00439.gff"))
+
+    def test_downloads_are_indexed(self):
+        d = download_alignment_from_pfam("PF08124")
+        self.assertIsNone(d.error)
+        entry = get_index().get("pfam", "PF08124", "pfam")
+        self.assertEqual(entry["status"], "ok")
+        self.assertEqual(entry["size"], os.path.getsize(self.outputfile))
+
+    def test_complete_index_stats_only_the_indexed_file(self):
+        key = ("pfam", "PF08124", "pfam")
+        with open(self.outputfile, "w") as f:
+            f.write("# STOCKHOLM 1.0\n")
+        get_index().rebuild(data_directories())
+        with patch("os.path.exists", side_effect=os.path.exists) as exists:
+            self.assertTrue(fetchers._available(self.outputfile, key))
+        exists.assert_called_once_with(self.outputfile)
+        d = download_alignment_from_pfam("PF08124")
+        self.assertIsNone(d.error)
+        self.assertEqual(self.server.requests, [])
+        # missing from a complete index, so missing from disk
+        os.remove(self.outputfile)
+        get_index().rebuild(data_directories())
+        with patch("os.path.exists", side_effect=AssertionError("stat")):
+            self.assertFalse(fetchers._available(self.outputfile, key))
+
+    def test_removed_file_is_downloaded_again(self):
+        d = download_alignment_from_pfam("PF08124")
+        self.assertIsNone(d.error)
+        # behind the index's back
+        os.remove(self.outputfile)
+        d = download_alignment_from_pfam("PF08124")
+        self.assertIsNone(d.error)
+        self.assertTrue(os.path.isfile(self.outputfile))
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(get_index().get("pfam", "PF08124", "pfam")["status"],
+                         "ok")
+
+    def test_failed_download_is_retried(self):
+        self.server.status["/family/PF08124/alignment/seed"] = 404
+        d = download_alignment_from_pfam("PF08124")
+        self.assertIsNotNone(d.error)
+        entry = get_index().get("pfam", "PF08124", "pfam")
+        self.assertEqual(entry["status"], "failed")
+        del self.server.status["/family/PF08124/alignment/seed"]
+        d = download_alignment_from_pfam("PF08124")
+        self.assertIsNone(d.error)
+        self.assertEqual(get_index().get("pfam", "PF08124", "pfam")["status"],
+                         "ok")
+
+    def test_cli_rebuild_index(self):
+        with open(self.outputfile, "w") as f:
+            f.write("data")
+        result = CliRunner().invoke(downloads, ["rebuild-index", "--output",
+                                                self.tmp])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Indexed 1 files", result.output)
+
+
+class TestShardedLayout(unittest.TestCase):
+    """Tests for the sharded on-disk layout."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.server = StandinServer({"/P00439.fasta": b">P00439\nMSTAVLENPGLGRK\n"})
+        self.patches = [patch("biodownloader.config.config.db_root", self.tmp),
+                        patch("biodownloader.config.config.http_uniprot",
+                              self.server.url + "/"),
+                        patch("biodownloader.config.config.sharded_layout",
+                              True),
+                        patch("biodownloader.retry._policy",
+                              RetryPolicy(max_retries=0))]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        close_indexes()
+        close_manifests()
+        self.server.close()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def write(self, *names):
+        for name in names:
+            path = os.path.join(self.tmp, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write("data")
+
+    def test_shard(self):
+        self.assertEqual(shard("pdbe", "2PAH"), "pa")
+        self.assertEqual(shard("sifts", "2pah"), "pa")
+        self.assertEqual(shard("uniprot", "P00439"), "P00")
+        self.assertIsNone(shard("pfam", "PF08124"))
+
+    def test_targets(self):
+        self.assertEqual(fetchers._structure_target("2pah")[1],
+                         os.path.join(self.tmp, ".", "pa", "2pah.cif"))
+        self.assertEqual(fetchers._sifts_target("2pah")[1],
+                         os.path.join(self.tmp, ".", "pa", "2pah.xml.gz"))
+        self.assertEqual(fetchers._pfam_target("PF08124")[1],
+                         os.path.join(self.tmp, ".", "PF08124.sth"))
+        with patch("biodownloader.config.config.sharded_layout", False):
+            self.assertEqual(fetchers._structure_target("2pah")[1],
+                             os.path.join(self.tmp, ".", "2pah.cif"))
+
+    def test_download_and_override(self):
+        outputfile = os.path.join(self.tmp, "P00", "P00439.fasta")
+        d = download_data_from_uniprot("P00439")
+        self.assertIsNone(d.error)
+        self.assertTrue(os.path.isfile(outputfile))
+        download_data_from_uniprot("P00439")
+        self.assertEqual(len(self.server.requests), 1)
+        download_data_from_uniprot("P00439", override=True)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_removed_shard_directory_is_made_again(self):
+        self.server.files["/P00440.fasta"] = b">P00440\nMSTAV\n"
+        self.assertIsNone(download_data_from_uniprot("P00439").error)
+        # e.g. emptied and deleted while the daemon keeps running
+        shutil.rmtree(os.path.join(self.tmp, "P00"))
+        d = download_data_from_uniprot("P00440")
+        self.assertIsNone(d.error)
+        self.assertEqual(listdir(os.path.join(self.tmp, "P00")),
+                         ["P00440.fasta"])
+        self.assertIsNotNone(get_manifest(os.path.join(self.tmp, "P00"))
+                             .get("P00440.fasta"))
+
+    def test_migrate(self):
+        self.write("2pah.cif", "2pah_bio.cif.gz", "3kic.xml", "P00439.fasta",
+                   "PF08124.sth", "1.50.10.100_1318.fasta", "notes.md")
+        get_manifest(self.tmp).update("2pah.cif", etag='"v1"')
+        self.assertEqual(migrate(sharded=True), 4)
+        self.assertEqual(listdir(self.tmp),
+                         ["1.50.10.100_1318.fasta", "P00", "PF08124.sth",
+                          "ki", "notes.md", "pa"])
+        self.assertEqual(listdir(os.path.join(self.tmp, "pa")),
+                         ["2pah.cif", "2pah_bio.cif.gz"])
+        self.assertEqual(get_manifest(os.path.join(self.tmp, "pa"))
+                         .get("2pah.cif")["etag"], '"v1"')
+        self.assertIsNone(get_manifest(self.tmp).get("2pah.cif"))
+        entry = get_index().get("uniprot", "P00439", "fasta")
+        self.assertEqual(entry["path"],
+                         os.path.join(self.tmp, "P00", "P00439.fasta"))
+        # already in place, so nothing is downloaded
+        download_data_from_uniprot("P00439")
+        self.assertEqual(self.server.requests, [])
+
+        self.assertEqual(migrate(sharded=False), 4)
+        self.assertEqual(listdir(self.tmp),
+                         ["1.50.10.100_1318.fasta", "2pah.cif",
+                          "2pah_bio.cif.gz", "3kic.xml", "P00439.fasta",
+                          "PF08124.sth", "notes.md"])
+        self.assertEqual(get_manifest(self.tmp).get("2pah.cif")["etag"],
+                         '"v1"')
+
+    def test_obsolete_and_other_directories_are_not_shards(self):
+        self.write("pa/2pah.cif", "P00/P00439.fasta", "obsolete/4abc.cif",
+                   "backup/3kic.cif", "ki/old/3kic.cif")
+        self.assertEqual(get_index().rebuild([self.tmp]), 2)
+        self.assertIsNone(get_index().get("pdbe", "4abc", "mmcif"))
+        self.assertIsNone(get_index().get("pdbe", "3kic", "mmcif"))
+        migrate(sharded=False)
+        self.assertEqual(listdir(self.tmp),
+                         ["2pah.cif", "P00439.fasta", "backup", "ki",
+                          "obsolete"])
+        self.assertEqual(listdir(os.path.join(self.tmp, "obsolete")),
+                         ["4abc.cif"])
+
+    def test_cli_migrate_layout(self):
+        self.write("2pah.cif")
+        result = CliRunner().invoke(downloads, ["migrate-layout", "--output",
+                                                self.tmp])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Moved 1 files", result.output)
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp, "pa",
+                                                    "2pah.cif")))
+
+
+class TestSync(unittest.TestCase):
+    """Tests for the incremental mirror sync from the wwPDB lists."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.lists = {"added": b"1abc\n2ABC\n", "modified": b"3abc\n",
+                      "obsolete": b"4abc\n"}
+        files = {"/status/{}.pdb".format(k): v for k, v in self.lists.items()}
+        for i in ("1abc", "2abc", "3abc"):
+            files["/entry-files/download/{}_updated.cif".format(i)] = \
+                "data_{}\n".format(i).encode()
+        self.server = StandinServer(files)
+        self.patches = [patch("biodownloader.config.config.db_root", self.tmp),
+                        patch("biodownloader.config.config.http_pdbe",
+                              self.server.url + "/"),
+                        patch("biodownloader.retry._policy",
+                              RetryPolicy(max_retries=0))]
+        for p in self.patches:
+            p.start()
+        for name, content in (("2abc.cif", "data_2abc\n"),
+                              ("3abc.cif", "old\n"), ("4abc.cif", "old\n"),
+                              ("4abc.xml", "old\n")):
+            with open(os.path.join(self.tmp, name), "w") as f:
+                f.write(content)
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        close_indexes()
+        close_manifests()
+        self.server.close()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def read(self, name):
+        with open(os.path.join(self.tmp, name)) as f:
+            return f.read()
+
+    def test_read_status_lists(self):
+        lists_dir = os.path.join(self.tmp, "lists")
+        os.mkdir(lists_dir)
+        for name, content in self.lists.items():
+            with open(os.path.join(lists_dir, name + ".pdb"), "wb") as f:
+                f.write(content)
+        expected = {"added": ["1abc", "2abc"], "modified": ["3abc"],
+                    "obsolete": ["4abc"]}
+        self.assertEqual(read_status_lists(lists_dir), expected)
+        self.assertEqual(read_status_lists(self.server.url + "/status"),
+                         expected)
+
+    def test_sync(self):
+        result = sync(["mmcif"], location=self.server.url + "/status/")
+        self.assertEqual(result.added, ["1abc", "2abc"])
+        self.assertEqual(result.modified, ["3abc"])
+        self.assertTrue(all(r.ok for r in result.results))
+        self.assertEqual(self.read("1abc.cif"), "data_1abc\n")
+        self.assertEqual(self.read("3abc.cif"), "data_3abc\n")
+        paths = [r[1] for r in self.server.requests]
+        # already available
+        self.assertNotIn("/entry-files/download/2abc_updated.cif", paths)
+        self.assertEqual(listdir(os.path.join(self.tmp, "obsolete")),
+                         ["4abc.cif", "4abc.xml"])
+        self.assertEqual(len(result.moved), 2)
+        self.assertIsNone(get_index().get("pdbe", "4abc", "mmcif"))
+        self.assertEqual(listdir(self.tmp), ["1abc.cif", "2abc.cif",
+                                             "3abc.cif", "obsolete"])
+
+    def test_modified_entries_not_held_are_skipped(self):
+        lists_dir = os.path.join(self.tmp, "lists")
+        os.mkdir(lists_dir)
+        for name, content in dict(self.lists, modified=b"3abc\n5abc\n").items():
+            with open(os.path.join(lists_dir, name + ".pdb"), "wb") as f:
+                f.write(content)
+        result = sync(["mmcif"], location=lists_dir)
+        self.assertEqual(result.modified, ["3abc", "5abc"])
+        self.assertEqual([d for d in result.downloads if d[2]],
+                         [("3abc", "mmcif", True)])
+        self.assertEqual(self.read("3abc.cif"), "data_3abc\n")
+        paths = [r[1] for r in self.server.requests]
+        self.assertNotIn("/entry-files/download/5abc_updated.cif", paths)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, "5abc.cif")))
+
+    def test_dry_run(self):
+        result = sync(["mmcif"], location=self.server.url + "/status/",
+                      dry_run=True)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual((result.moved, result.results), ([], []))
+        self.assertEqual(self.read("3abc.cif"), "old\n")
+        # 2abc is already available
+        self.assertEqual(result.downloads, [("1abc", "mmcif", False),
+                                            ("3abc", "mmcif", True)])
+
+    def test_cli_sync(self):
+        result = CliRunner().invoke(downloads, [
+            "sync", "--mmcif", "--output", self.tmp, "--lists",
+            self.server.url + "/status/"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("2 added, 1 modified and 1 obsolete entries",
+                      result.output)
+
+    def test_cli_dry_run(self):
+        result = CliRunner().invoke(downloads, [
+            "sync", "--mmcif", "--dry-run", "--output", self.tmp, "--lists",
+            self.server.url + "/status/"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Would download 1abc mmcif (added)", result.output)
+        self.assertIn("Would download 3abc mmcif (modified)", result.output)
+        self.assertNotIn("2abc", result.output)
+
+
+class TestCachingProxy(unittest.TestCase):
+    """Tests for the serve-cache read-through proxy."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.files = {"/a": b"a" * 100, "/b": b"b" * 100, "/c": b"c" * 100,
+                      "/family/PF08124/alignment/seed": b"# STOCKHOLM 1.0\n"}
+        self.origin = StandinServer(self.files)
+        self.config = dict(vars(c))
+        self.patches = [patch("biodownloader.config.config.db_root", self.tmp),
+                        patch("biodownloader.config.config.http_pfam",
+                              self.origin.url + "/"),
+                        patch("biodownloader.retry._policy",
+                              RetryPolicy(max_retries=0))]
+        for p in self.patches:
+            p.start()
+        self.server = make_server(host="127.0.0.1", port=0,
+                                  directory=os.path.join(self.tmp, "cache"),
+                                  max_size=250)
+        self.proxy = self.server.proxy
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.proxy.store.close()
+        for p in self.patches:
+            p.stop()
+        vars(c).update(self.config)
+        close_indexes()
+        close_manifests()
+        session.reset_session()
+        self.origin.close()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def get(self, path, **kwargs):
+        return requests.get(self.url + "/http_pfam" + path, **kwargs)
+
+    def test_read_through(self):
+        first = self.get("/a")
+        second = self.get("/a")
+        self.assertEqual(first.content, self.files["/a"])
+        self.assertEqual(second.content, self.files["/a"])
+        self.assertEqual((first.headers["X-Cache"], second.headers["X-Cache"]),
+                         ("MISS", "HIT"))
+        self.assertEqual(len(self.origin.requests), 1)
+
+    def test_unknown_upstream(self):
+        self.assertEqual(requests.get(self.url + "/db_root/a").status_code, 404)
+
+    def test_coalesces_concurrent_misses(self):
+        self.origin.delays["/a"] = [0.3]
+        responses = []
+        threads = [threading.Thread(target=lambda: responses.append(self.get("/a")))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(responses), 8)
+        self.assertTrue(all(r.content == self.files["/a"] for r in responses))
+        self.assertEqual(len(self.origin.requests), 1)
+        self.assertEqual(self.proxy.upstream_requests, 1)
+
+    def test_streams_while_filling(self):
+        gate = self.origin.gates["/a"] = threading.Event()
+        try:
+            first = self.get("/a", stream=True, timeout=5)
+            # half of the body before upstream has sent the rest
+            self.assertEqual(first.raw.read(50), b"a" * 50)
+            second = self.get("/a", stream=True, timeout=5)
+            self.assertEqual(second.headers["X-Cache"], "MISS")
+            self.assertEqual(second.raw.read(50), b"a" * 50)
+        finally:
+            gate.set()
+        self.assertEqual(first.raw.read(), b"a" * 50)
+        self.assertEqual(second.raw.read(), b"a" * 50)
+        self.assertEqual(self.proxy.upstream_requests, 1)
+        self.assertEqual(self.get("/a").headers["X-Cache"], "HIT")
+        self.assertEqual(self.get("/a", headers={"Range": "bytes=90-"}).content,
+                         b"a" * 10)
+
+    def test_truncated_upstream_is_not_stored(self):
+        self.origin.truncate_after = 50
+        response = self.get("/a", stream=True)
+        self.assertEqual(response.status_code, 200)
+        with self.assertRaises(Exception):
+            response.content
+        self.origin.truncate_after = None
+        self.assertEqual(self.get("/a").headers["X-Cache"], "MISS")
+        self.assertEqual(self.proxy.upstream_requests, 2)
+
+    def test_lru_size_cap(self):
+        self.get("/a")
+        self.get("/b")
+        self.get("/a")
+        self.get("/c")
+        # b was the least recently used
+        self.assertEqual(self.get("/b").headers["X-Cache"], "MISS")
+        self.assertEqual(self.get("/c").headers["X-Cache"], "HIT")
+        self.assertLessEqual(self.proxy.store._size, 250)
+
+    def test_ranges_and_validators(self):
+        etag = self.get("/a").headers["ETag"]
+        response = self.get("/a", headers={"Range": "bytes=10-19"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, b"a" * 10)
+        self.assertEqual(response.headers["Content-Range"], "bytes 10-19/100")
+        response = self.get("/a", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_errors_are_not_cached(self):
+        self.assertEqual(self.get("/missing").status_code, 404)
+        self.assertEqual(self.get("/missing").status_code, 404)
+        self.assertEqual(len(self.origin.requests), 2)
+
+    def test_revalidates_expired_entries(self):
+        # stored already expired
+        self.proxy.store.ttl = -1
+        self.get("/a")
+        response = self.get("/a")
+        self.assertEqual(response.content, self.files["/a"])
+        self.assertIn("If-None-Match", self.origin.requests[-1][2])
+
+    def test_downloads_through_proxy(self):
+        route_through(self.url)
+        self.assertEqual(c.http_pfam, self.url + "/http_pfam/")
+        self.assertEqual(c.http_uniprot_stream,
+                         self.url + "/http_uniprot_stream")
+        d = download_alignment_from_pfam("PF08124")
+        self.assertIsNone(d.error)
+        d = download_alignment_from_pfam("PF08124", override=True)
+        self.assertIsNone(d.error)
+        with open(os.path.join(self.tmp, "PF08124.sth"), "rb") as f:
+            self.assertEqual(f.read(),
+                             self.files["/family/PF08124/alignment/seed"])
+        self.assertEqual(len(self.origin.requests), 1)
+
+
+class TestDaemon(unittest.TestCase):
+    """Tests for the download daemon and single-flight coalescing."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.origin = StandinServer({"/family/PF08124/alignment/seed":
+                                     b"# STOCKHOLM 1.0\n"})
+        self.patches = [patch("biodownloader.config.config.db_root", self.tmp),
+                        patch("biodownloader.config.config.http_pfam",
+                              self.origin.url + "/"),
+                        patch("biodownloader.retry._policy",
+                              RetryPolicy(max_retries=0))]
+        for p in self.patches:
+            p.start()
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+            server.service.close()
+        for p in self.patches:
+            p.stop()
+        close_indexes()
+        close_manifests()
+        self.origin.close()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def start(self, **kwargs):
+        server = daemon.make_server(jobs=4, **kwargs)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+        return server
+
+    def concurrently(self, function, n=6):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(function()))
+                   for _ in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_single_flight(self):
+        flights = SingleFlight()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return len(calls)
+
+        results = self.concurrently(lambda: flights.do("key", slow))
+        self.assertEqual(results, [1] * 6)
+        self.assertEqual((len(calls), flights.calls, len(flights)), (1, 1, 0))
+        self.assertEqual(flights.do("other", slow), 2)
+
+    def test_single_flight_shares_errors(self):
+        flights = SingleFlight()
+
+        def fail():
+            time.sleep(0.1)
+            raise IOError("upstream down")
+
+        errors = self.concurrently(lambda: self.assertRaises(
+            IOError, flights.do, "key", fail))
+        self.assertEqual(len(errors), 6)
+        self.assertEqual(flights.calls, 1)
+
+    def test_concurrent_requests_share_one_download(self):
+        self.origin.delays["/family/PF08124/alignment/seed"] = [0.3]
+        service = daemon.DownloadService(jobs=2)
+        results = self.concurrently(
+            lambda: service.download("pf08124", "pfam", override=True))
+        service.close()
+        self.assertEqual(len(self.origin.requests), 1)
+        self.assertTrue(all(r == results[0] for r in results))
+        self.assertTrue(results[0]["ok"])
+        self.assertEqual(results[0]["path"],
+                         os.path.join(self.tmp, "PF08124.sth"))
+
+    def test_own_retry_budget_and_limits(self):
+        url = c.http_pfam + "family/PF08124/alignment/seed"
+        seen = []
+
+        def download_task(identifier, file_format, override=False):
+            seen.append((retry.get_retry_policy(),
+                         concurrency.get_concurrency_limiter(url)))
+            # as a CLI run in the same process would
+            concurrency.enable(2)
+            concurrency.disable()
+            seen.append((retry.get_retry_policy(),
+                         concurrency.get_concurrency_limiter(url)))
+            return Downloader(url, os.path.join(self.tmp, "PF08124.sth"))
+
+        with patch("biodownloader.config.config.adaptive_concurrency", True):
+            service = daemon.DownloadService(jobs=2)
+        try:
+            with patch("biodownloader.daemon.download_task", download_task):
+                self.assertTrue(service.download("PF08124", "pfam")["ok"])
+        finally:
+            service.close()
+        (policy, limiter), after = seen
+        self.assertIs(policy, service.retry_policy)
+        self.assertEqual(policy.window, c.daemon_retry_window)
+        self.assertIsNotNone(limiter)
+        self.assertEqual(after, (policy, limiter))
+        self.assertIsNot(retry.get_retry_policy(), policy)
+        self.assertIsNone(concurrency.get_concurrency_limiter(url))
+
+    def test_override_joins_download_in_progress(self):
+        self.origin.delays["/family/PF08124/alignment/seed"] = [0.3]
+        service = daemon.DownloadService(jobs=2)
+        results = []
+        threads = [threading.Thread(target=lambda o=o: results.append(
+            service.download("PF08124", "pfam", override=o)))
+            for o in (False, True)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        service.close()
+        self.assertEqual(len(self.origin.requests), 1)
+        self.assertTrue(all(r["ok"] for r in results))
+        self.assertEqual(service.flights.calls, 1)
+
+    def test_http_api(self):
+        server = self.start(host="127.0.0.1", port=0)
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+        response = requests.get(url + "/download",
+                                params={"id": "PF08124", "format": "pfam"})
+        self.assertEqual(response.status_code, 200)
+        result, = response.json()["results"]
+        self.assertTrue(result["ok"])
+        self.assertTrue(os.path.isfile(result["path"]))
+        results = daemon.submit(["PF08124"], ["pfam"], address=url)
+        self.assertTrue(results[0]["ok"])
+        # the second request found the file already available
+        self.assertEqual(len(self.origin.requests), 1)
+        response = requests.post(url + "/download",
+                                 json={"id": "2pah", "format": "pdbml"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(requests.get(url + "/health").json()["in_flight"], 0)
+
+    def test_unix_socket(self):
+        path = os.path.join(self.tmp, "daemon.sock")
+        self.start(path=path)
+        results = daemon.submit(["PF08124"], ["pfam"], address=path)
+        self.assertTrue(results[0]["ok"])
+        with self.assertRaises(ValueError):
+            daemon.submit([], ["pfam"], address=path)
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for the request metrics and their exports."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.events = os.path.join(self.tmp, "events.jsonl")
+        self.origin = StandinServer({
+            "/family/PF08124/alignment/seed": b"# STOCKHOLM 1.0\n",
+            "/2pah-assembly-1.cif.gz": gzip.compress(b"data_2PAH\n" * 1000)})
+        self.patches = [patch("biodownloader.config.config.db_root", self.tmp),
+                        patch("biodownloader.config.config.http_pfam",
+                              self.origin.url + "/"),
+                        patch("biodownloader.config.config.metrics_events",
+                              self.events),
+                        patch("biodownloader.config.config.metrics_textfile",
+                              None),
+                        patch("biodownloader.retry._policy",
+                              RetryPolicy(max_retries=1, backoff=0.01))]
+        for p in self.patches:
+            p.start()
+        reset_metrics()
+
+    def tearDown(self):
+        reset_metrics()
+        for p in self.patches:
+            p.stop()
+        close_indexes()
+        close_manifests()
+        self.origin.close()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def read_events(self):
+        with open(self.events) as f:
+            return [json.loads(line) for line in f]
+
+    def test_source_of(self):
+        self.assertEqual(source_of(self.origin.url + "/family/PF08124"), "pfam")
+        self.assertEqual(source_of("http://example.org/x"), "other")
+
+    def test_record_and_textfile(self):
+        metrics = Metrics()
+        trace = Trace()
+        trace.responded(200, {"X-Cache": "HIT"})
+        trace.finished(size=1000, decompress=0.02)
+        metrics.record("download", "http://example.org/a.cif.gz",
+                       source="pdbe", trace=trace, retries=2)
+        metrics.record("request", "http://example.org/b", ok=False,
+                       error=IOError("timed out"))
+        totals = metrics.summary()[("pdbe", "example.org")]
+        self.assertEqual((totals["downloads"], totals["retries"],
+                          totals["bytes"], totals["hit"]), (1, 2, 1000, 1))
+        self.assertEqual(metrics.summary()[("other", "example.org")]["failed"],
+                         1)
+        text = metrics.textfile()
+        self.assertIn('biodownloader_requests_total{kind="download",'
+                      'source="pdbe",host="example.org",status="200"} 1', text)
+        self.assertIn('biodownloader_decompress_seconds_count{source="pdbe",'
+                      'host="example.org"} 1', text)
+        self.assertIn('biodownloader_requests_total{kind="request",'
+                      'source="other",host="example.org",status="error"} 1',
+                      text)
+        path = os.path.join(self.tmp, "biodownloader.prom")
+        metrics.write_textfile(path)
+        with open(path) as f:
+            self.assertEqual(f.read(), metrics.textfile())
+
+    def test_downloads_are_recorded(self):
+        self.origin.failures["/family/PF08124/alignment/seed"] = [(503, None)]
+        file_downloader(["PF08124"], pfam=True, metrics_textfile=os.path.join(
+            self.tmp, "biodownloader.prom"))
+        file_downloader(["PF08124"], pfam=True)
+        download, local = self.read_events()
+        self.assertEqual((download["kind"], download["source"],
+                          download["status"], download["retries"]),
+                         ("download", "pfam", 200, 1))
+        self.assertGreater(download["bytes"], 0)
+        self.assertIsNotNone(download["ttfb"])
+        # stored as received
+        self.assertIsNone(download["decompress"])
+        self.assertEqual((local["kind"], local["cache"]), ("cache", "local"))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp,
+                                                    "biodownloader.prom")))
+        totals, = get_metrics().summary().values()
+        self.assertEqual((totals["downloads"], totals["local"]), (1, 1))
+
+    def test_decompression_is_timed(self):
+        d = Downloader(self.origin.url + "/2pah-assembly-1.cif.gz",
+                       os.path.join(self.tmp, "2pah_bio.cif.gz"),
+                       artefact=("pdbe", "2pah", "bio"))
+        self.assertIsNone(d.error)
+        download, = self.read_events()
+        self.assertEqual((download["source"], download["bytes"] > 0),
+                         ("pdbe", True))
+        self.assertIsNotNone(download["decompress"])
+
+
+class TestStartup(unittest.TestCase):
+    """Modules the CLI imports, checked in fresh interpreters (the startup
+    time itself is measured by benchmarks/harness.py)."""
+
+    # too slow to import before a command runs
+    HEAVY = {"requests", "urllib3", "sqlite3", "asyncio", "aiohttp", "gzip",
+             "pickle", "biodownloader.fetchers"}
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.origin = StandinServer({"/family/PF08124/alignment/seed":
+                                     b"# STOCKHOLM 1.0\n"})
+
+    def tearDown(self):
+        self.origin.close()
+        shutil.rmtree(self.tmp)
+
+    def imported(self, code):
+        # the modules imported by running code in a new interpreter
+        script = ("import sys, json\n"
+                  "{}\n"
+                  "sys.stderr.write('\\n' + json.dumps(sorted(sys.modules)))"
+                  "\n").format(code)
+        process = subprocess.run([sys.executable, "-c", script],
+                                 cwd=os.path.dirname(cwd),
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE, check=True)
+        return set(json.loads(process.stderr.decode("utf-8").splitlines()[-1]))
+
+    def test_import(self):
+        modules = self.imported("import biodownloader.cli")
+        self.assertIn("biodownloader.cli", modules)
+        self.assertFalse(modules & self.HEAVY)
+
+    def test_help(self):
+        modules = self.imported(
+            "from biodownloader.cli import downloads\n"
+            "try:\n"
+            "    downloads(['--help'])\n"
+            "except SystemExit:\n"
+            "    pass")
+        self.assertFalse(modules & self.HEAVY)
+
+    def test_single_download(self):
+        modules = self.imported(
+            "from biodownloader.cli import file_downloader\n"
+            "from biodownloader.config import config\n"
+            "config.http_pfam = {!r}\n"
+            "file_downloader(['PF08124'], pfam=True, output_dir={!r})".format(
+                self.origin.url + "/", self.tmp))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp, "PF08124.sth")))
+        self.assertFalse(modules & {"asyncio", "aiohttp", "gzip", "pickle",
+                                    "biodownloader.aio"})
+
+
+class TestStorageCodecs(unittest.TestCase):
+    """Offline tests for storing downloads as gzip, BGZF or zstd."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tmp = tempfile.mkdtemp()
+        self.url = c.http_pdbe + "static/entry/download/2pah-assembly-1.cif.gz"
+        self.payload = b"ATOM      1  N   VAL A 118\n" * 20000
+        self.gzipped = gzip.compress(self.payload)
+        self.outputfile = os.path.join(self.tmp, "2pah_bio.cif.gz")
+        self.fasta_url = c.http_uniprot + "P00439.fasta"
+        self.patches = [patch("biodownloader.config.config.db_root", self.tmp),
+                        patch("biodownloader.config.config.storage_codecs",
+                              {}),
+                        patch("biodownloader.retry._policy",
+                              RetryPolicy(max_retries=0))]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        close_indexes()
+        close_manifests()
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def bgzf_blocks(self, data):
+        blocks = []
+        while data:
+            self.assertEqual(data[:4], b"\x1f\x8b\x08\x04")
+            self.assertEqual(data[12:16], b"BC\x02\x00")
+            size = int.from_bytes(data[16:18], "little") + 1
+            blocks.append(data[:size])
+            data = data[size:]
+        return blocks
+
+    def test_variants(self):
+        self.assertEqual(storage.variants("a/2pah.cif.zst"),
+                         ["a/2pah.cif", "a/2pah.cif.gz", "a/2pah.cif.zst"])
+        self.assertEqual(artefact("P00439.fasta.zst"),
+                         ("uniprot", "P00439", "fasta"))
+        self.assertEqual(artefact("2pah_bio.cif.gz"), ("pdbe", "2pah", "bio"))
+        with patch("biodownloader.config.config.storage_codecs",
+                   {"uniprot": "zstd"}):
+            self.assertEqual(storage.storage_codec("uniprot"), "zstd")
+            self.assertEqual(storage.storage_codec("pdbe"), "plain")
+        with patch("biodownloader.config.config.storage_codec", "xz"):
+            self.assertRaises(ValueError, storage.storage_codec, "pdbe")
+
+    def test_bgzf_writer(self):
+        from io import BytesIO
+        sink = BytesIO()
+        writer = storage.BGZFWriter(sink)
+        data = self.payload + os.urandom(100000)
+        for i in range(0, len(data), 10000):
+            writer.write(data[i:i + 10000])
+        writer.close()
+        blocks = self.bgzf_blocks(sink.getvalue())
+        self.assertEqual(blocks[-1], storage.BGZF_EOF)
+        self.assertTrue(all(len(b) <= 65536 for b in blocks))
+        # every block is a gzip member on its own
+        self.assertEqual(b"".join(gzip.decompress(b) for b in blocks), data)
+
+    @responses.activate
+    def test_gzip_keeps_payload_as_received(self):
+        responses.add(responses.GET, self.url, body=self.gzipped, status=200,
+                      content_type='application/octet-stream')
+        d = Downloader(self.url, self.outputfile, storage="gzip")
+        self.assertIsNone(d.error)
+        self.assertEqual(d.outputfile, self.outputfile)
+        self.assertEqual(listdir(self.tmp), ["2pah_bio.cif.gz"])
+        with open(self.outputfile, 'rb') as f:
+            self.assertEqual(f.read(), self.gzipped)
+
+    @responses.activate
+    def test_bgzf_transcodes_payload(self):
+        responses.add(responses.GET, self.url, body=self.gzipped, status=200,
+                      content_type='application/octet-stream')
+        d = Downloader(self.url, self.outputfile, storage="bgzf",
+                       keep_compressed=True)
+        self.assertIsNone(d.error)
+        self.assertEqual(listdir(self.tmp), ["2pah_bio.cif.gz"])
+        with open(self.outputfile, 'rb') as f:
+            data = f.read()
+        self.assertGreater(len(self.bgzf_blocks(data)), 2)
+        self.assertEqual(gzip.decompress(data), self.payload)
+
+    @responses.activate
+    def test_source_codec_compresses_plain_payload(self):
+        responses.add(responses.GET, self.fasta_url, body=self.payload,
+                      status=200, content_type='text/plain')
+        with patch("biodownloader.config.config.storage_codecs",
+                   {"uniprot": "gzip"}):
+            d = download_data_from_uniprot("P00439")
+        self.assertIsNone(d.error)
+        self.assertEqual(d.outputfile, os.path.join(self.tmp, "P00439.fasta.gz"))
+        with gzip.open(d.outputfile) as f:
+            self.assertEqual(f.read(), self.payload)
+        self.assertEqual(get_index().get("uniprot", "P00439", "fasta")["path"],
+                         os.path.abspath(d.outputfile))
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    @responses.activate
+    def test_zstd(self):
+        responses.add(responses.GET, self.url, body=self.gzipped, status=200,
+                      content_type='application/octet-stream')
+        d = Downloader(self.url, self.outputfile, storage="zstd")
+        self.assertIsNone(d.error)
+        self.assertEqual(listdir(self.tmp), ["2pah_bio.cif.zst"])
+        with open(d.outputfile, 'rb') as f:
+            reader = zstandard.ZstdDecompressor().stream_reader(f)
+            self.assertEqual(reader.read(), self.payload)
+
+    @responses.activate
+    def test_variants_are_available_and_overridden(self):
+        responses.add(responses.GET, self.fasta_url, body=self.payload,
+                      status=200, content_type='text/plain')
+        artefact = ("uniprot", "P00439", "fasta")
+        outputfile = os.path.join(self.tmp, "P00439.fasta")
+        Downloader(self.fasta_url, outputfile, artefact=artefact)
+        d = Downloader(self.fasta_url, outputfile, storage="bgzf",
+                       artefact=artefact)
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(listdir(self.tmp), ["P00439.fasta"])
+        d = Downloader(self.fasta_url, outputfile, storage="bgzf",
+                       override=True, artefact=artefact)
+        self.assertIsNone(d.error)
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(listdir(self.tmp), ["P00439.fasta.gz"])
+        self.assertEqual(get_index().get(*artefact)["path"],
+                         os.path.abspath(d.outputfile))
+        self.assertEqual(get_index().rebuild([self.tmp]), 1)
+        self.assertTrue(fetchers._available(outputfile, artefact))
+
+    @responses.activate
+    def test_variant_kept_after_codec_change(self):
+        # 2pah.cif.zst stored under an earlier zstd config is still the
+        # entry once the codec is back to plain, for downloads and sync alike
+        plainfile = storage.strip_suffix(fetchers._structure_target("2pah")[1])
+        structures = os.path.dirname(plainfile)
+        os.makedirs(structures, exist_ok=True)
+        stored = plainfile + ".zst"
+        with open(stored, 'wb') as f:
+            f.write(b"zstd")
+        self.assertEqual(storage.stored_variant(stored[:-4]), stored)
+        with patch("biodownloader.config.config.index", False):
+            self.assertTrue(fetchers._available(plainfile,
+                                                ("pdbe", "2pah", "mmcif")))
+            self.assertEqual(plan_downloads(["2pah"], [], ["mmcif"]), [])
+            d = download_structure_from_pdbe("2pah")
+        self.assertIsNone(d.error)
+        self.assertEqual(len(responses.calls), 0)
+        self.assertEqual(listdir(structures), ["2pah.cif.zst"])
+        self.assertEqual(plan_downloads(["2pah"], [], ["mmcif"]), [])
+        self.assertEqual(get_index().get("pdbe", "2pah", "mmcif")["path"],
+                         os.path.abspath(stored))
+
+    @responses.activate
+    def test_cli_storage_per_source(self):
+        responses.add(responses.GET, self.fasta_url, body=self.payload,
+                      status=200, content_type='text/plain')
+        with patch("biodownloader.config.config.storage_codec", "plain"):
+            file_downloader(["P00439"], fasta=True, storage="gzip")
+            self.assertEqual(c.storage_codecs, {"uniprot": "gzip"})
+            self.assertEqual(c.storage_codec, "plain")
+        self.assertEqual(listdir(self.tmp), ["P00439.fasta.gz"])
+
+
+class TestBenchmarks(unittest.TestCase):
+    """Smoke tests for the offline benchmark harness."""
+
+    @classmethod
+    def setUpClass(cls):
+        sys.path.insert(0, os.path.join(os.path.dirname(cwd), "benchmarks"))
+        import harness
+        import standin
+        cls.harness = harness
+        cls.standin = standin
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_profile_sizes(self):
+        profile = self.standin.Profile(sizes="lognormal:1000:0.5")
+        self.assertEqual(profile.size("/a"), profile.size("/a"))
+        self.assertEqual(self.standin.Profile(sizes="fixed:10").size("/a"), 10)
+        payload = self.standin.synthetic("/x.cif.gz", 5000)
+        self.assertEqual(len(gzip.decompress(payload)), 5000)
+
+    def test_run_benchmark(self):
+        report = self.harness.run_benchmark(
+            "default", jobs=2, file_formats=["mmcif", "sifts", "pfam"], ids=3,
+            latency=0.0)
+        self.assertEqual((report["files"], report["failed"]), (9, 0))
+        # SIFTS files come from the FTP stand-in
+        self.assertEqual(report["requests"], 9)
+        self.assertGreater(report["files_per_s"], 0)
+        self.assertIsNotNone(report["latency_p99_ms"])
+
+    def test_latency_is_client_side(self):
+        # the stand-in sleeps 0.2s before answering the client
+        report = self.harness.run_benchmark(
+            "default", jobs=2, file_formats=["pfam"], ids=2, latency=0.2)
+        self.assertGreaterEqual(report["latency_p50_ms"], 200)
+
+    def test_runs_start_from_fresh_state(self):
+        spent = retry.get_retry_policy()
+        spent.budget = 0
+        try:
+            report = self.harness.run_benchmark(
+                "rate-limited", jobs=2, file_formats=["pfam"], ids=5,
+                latency=0.0, rate_429=0.3)
+        finally:
+            retry.reset_retry_policy()
+        # retried from a new budget
+        self.assertEqual(report["failed"], 0)
+        self.assertGreater(report["throttled"], 0)
+        self.assertIsNot(retry.get_retry_policy(), spent)
+
+    def test_compare(self):
+        baseline = {"files_per_s": 100.0, "mb_per_s": 10.0, "peak_rss_mb": 50.0}
+        report = {"files_per_s": 80.0, "mb_per_s": 10.5, "peak_rss_mb": 52.0}
+        rows = {r[0]: r[-1] for r in self.harness.compare(report, baseline)}
+        self.assertEqual(rows, {"files_per_s": True, "mb_per_s": False,
+                                "peak_rss_mb": False})
+
+
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestBioDownloader)
     unittest.TextTestRunner(verbosity=2).run(suite)